@@ -4,6 +4,7 @@ from PyQt5.QtCore import QObject, pyqtSignal, QThread, pyqtSlot
 import websockets
 import ssl, time
 from datetime import datetime
+from ws_compression import build_connect_kwargs
 
 class FriendListBackend(QObject):
     """WebSocket-based backend for friend list management"""
@@ -201,10 +202,11 @@ class WebSocketThread(QThread):
     connection_failed = pyqtSignal(str)
     message_received = pyqtSignal(dict)
     
-    def __init__(self, websocket_url, auth_token):
+    def __init__(self, websocket_url, auth_token, compression_settings=None):
         super().__init__()
         self.websocket_url = websocket_url
         self.auth_token = auth_token
+        self.compression_settings = compression_settings  # See ws_compression.DEFAULT_COMPRESSION_SETTINGS
         self.websocket = None
         self.running = False
         
@@ -241,7 +243,8 @@ class WebSocketThread(QThread):
                 self.websocket_url,
                 ssl=ssl_context,
                 ping_interval=30,
-                ping_timeout=10
+                ping_timeout=10,
+                **build_connect_kwargs(self.compression_settings)
             ) as websocket:
                 self.websocket = websocket
                 self.running = True
@@ -1,9 +1,10 @@
 from PyQt5.QtWidgets import (QWidget, QVBoxLayout, QHBoxLayout, QLabel, 
                              QLineEdit, QPushButton, QFrame, QScrollArea, QTextEdit,
                              QFileDialog, QDialog, QGridLayout, QMessageBox)
-from PyQt5.QtCore import Qt, pyqtSignal, pyqtSlot, QTimer, QThread
+from PyQt5.QtCore import Qt, pyqtSignal, pyqtSlot, QTimer, QThread, QEvent
 from PyQt5.QtGui import QFont, QPixmap, QPainter, QColor, QIcon
 from navigation_sidebar import NavigationSidebar
+from ws_compression import build_connect_kwargs
 import datetime
 import json
 import asyncio
@@ -15,6 +16,12 @@ import os
 import mimetypes
 import tempfile
 import shutil
+import uuid
+
+try:
+    import msgpack  # Optional: enables compact binary frames with raw attachment bytes
+except ImportError:
+    msgpack = None
 
 # Configure logging
 logging.basicConfig(level=logging.INFO)
@@ -157,15 +164,155 @@ class WebSocketThread(QThread):
     new_message_received = pyqtSignal(dict)  # Define signal at top of class
     connection_lost = pyqtSignal()
     message_sent_confirmation = pyqtSignal(str, str, str, bool)
+    inbox_received = pyqtSignal(list)  # Compact per-room summaries, most recent first
+    read_receipts_received = pyqtSignal(list)  # [{room_id, reader_id, last_read_id}]
+    presence_received = pyqtSignal(list)  # [{user_id, state}] batched friend presence changes
+    older_messages_received = pyqtSignal(str, list, bool)  # friend_username, processed messages (oldest first), has_more
+    
+    HISTORY_PAGE_SIZE = 50  # messages per get_older_messages request
+    READ_ACK_FLUSH_DELAY = 1.0  # seconds; acks are coalesced per room before sending
+    HEARTBEAT_INTERVAL = 25  # seconds; tells the server we are still here (and whether the window is active)
+    UPLOAD_CHUNK_SIZE = 64 * 1024  # bytes per chunk frame, so text sends interleave with uploads
     
-    def __init__(self, auth_token):
+    def __init__(self, auth_token, compression_settings=None):
         super().__init__()
         self.auth_token = auth_token
+        self.compression_settings = compression_settings  # See ws_compression.DEFAULT_COMPRESSION_SETTINGS
         self.websocket = None
         self.running = False
         self.message_queue = []
         self.loop = None
         self.current_username = ""  # Track current username to avoid self-messages
+        self.protocol = "json"  # Negotiated wire protocol (server answers in auth_success)
+        self.unacked_messages = {}  # client_msg_id -> message_data, resent until the server acks it
+        self.latest_message_ids = {}  # friend_username -> (room_id, newest message_id seen)
+        self.pending_read_acks = {}   # room_id -> message_id, only touched on the thread loop
+        self.read_flush_handle = None
+        self.app_active = True  # Window focus, reported in heartbeats (online vs idle)
+        self.incoming_chunks = {}  # stream id -> {index: data}, for chunked bulk frames from the server
+        self.history_pages = {}  # friend_username -> {room_id, oldest_message_id, has_more} from the server
+        self.history_requests = set()  # friend usernames with a get_older_messages request in flight
+    
+    def uses_binary_frames(self):
+        """True when the server agreed to MessagePack binary frames"""
+        return self.protocol == "msgpack" and msgpack is not None
+    
+    def encode_frame(self, message_data):
+        """Encode outgoing message with the negotiated protocol"""
+        if self.uses_binary_frames():
+            return msgpack.packb(message_data, use_bin_type=True)
+        return json.dumps(message_data)
+    
+    def decode_frame(self, frame):
+        """Decode incoming frame: text frames are JSON, binary frames are MessagePack"""
+        if isinstance(frame, bytes) and msgpack is not None:
+            return msgpack.unpackb(frame, raw=False)
+        return json.loads(frame)
+    
+    def remember_latest_message(self, friend_username, msg):
+        """Track the newest message id per chat so read acks can point at it"""
+        room_id, message_id = msg.get("room_id"), msg.get("message_id")
+        if not friend_username or room_id is None or not message_id:
+            return
+        known = self.latest_message_ids.get(friend_username)
+        if known is None or message_id > known[1]:
+            self.latest_message_ids[friend_username] = (str(room_id), message_id)
+    
+    def mark_read(self, friend_username):
+        """Acknowledge everything seen in a chat (called from the UI thread)"""
+        latest = self.latest_message_ids.get(friend_username)
+        if latest and self.loop and self.loop.is_running():
+            self.loop.call_soon_threadsafe(self.queue_read_ack, *latest)
+    
+    def queue_read_ack(self, room_id, message_id):
+        """Coalesce acks per room; one read_up_to frame goes out per flush delay"""
+        if message_id <= self.pending_read_acks.get(room_id, 0):
+            return
+        self.pending_read_acks[room_id] = message_id
+        if self.read_flush_handle is None:
+            self.read_flush_handle = self.loop.call_later(
+                self.READ_ACK_FLUSH_DELAY, lambda: asyncio.ensure_future(self.flush_read_acks())
+            )
+    
+    async def flush_read_acks(self):
+        """Send all pending read acks in a single frame"""
+        self.read_flush_handle = None
+        if not self.pending_read_acks or not self.websocket:
+            return
+        acks, self.pending_read_acks = self.pending_read_acks, {}
+        try:
+            await self.websocket.send(self.encode_frame({"type": "read_up_to", "rooms": acks}))
+            logger.info(f"👁️ [WS] Sent read acks for {len(acks)} rooms")
+        except Exception as e:
+            logger.error(f"❌ [WS] Failed to send read acks: {e}")
+            for room_id, message_id in acks.items():
+                self.pending_read_acks[room_id] = max(message_id, self.pending_read_acks.get(room_id, 0))
+    
+    def add_chunk(self, chunk):
+        """Collect one chunk of a large server frame; returns the whole frame once complete"""
+        parts = self.incoming_chunks.setdefault(chunk["stream"], {})
+        parts[chunk["index"]] = chunk["data"]
+        if len(parts) < chunk["total"]:
+            return None
+        del self.incoming_chunks[chunk["stream"]]
+        pieces = [parts[i] for i in range(chunk["total"])]
+        return b"".join(pieces) if isinstance(pieces[0], bytes) else "".join(pieces)
+    
+    async def send_chunked(self, frame):
+        """Send a large frame as chunk envelopes; other sends on this loop interleave between chunks"""
+        stream_id = uuid.uuid4().hex[:12]
+        pieces = [frame[i:i + self.UPLOAD_CHUNK_SIZE] for i in range(0, len(frame), self.UPLOAD_CHUNK_SIZE)]
+        for index, piece in enumerate(pieces):
+            await self.websocket.send(self.encode_frame({
+                "type": "chunk", "stream": stream_id, "index": index, "total": len(pieces), "data": piece
+            }))
+    
+    def request_older_messages(self, friend_username):
+        """Ask for the page before the oldest message we have (called from the UI thread).
+        Returns False when there is nothing older or a request is already in flight."""
+        page = self.history_pages.get(friend_username)
+        if not page or not page.get("has_more") or friend_username in self.history_requests:
+            return False
+        if not (self.websocket and self.loop and self.loop.is_running()):
+            return False
+        self.history_requests.add(friend_username)
+        request = {
+            "type": "get_older_messages", "friend_username": friend_username,
+            "before_message_id": page["oldest_message_id"], "limit": self.HISTORY_PAGE_SIZE
+        }
+        asyncio.run_coroutine_threadsafe(self.websocket.send(self.encode_frame(request)), self.loop)
+        logger.info(f"📜 [WS] Requested messages before {page['oldest_message_id']} with {friend_username}")
+        return True
+    
+    async def handle_older_messages(self, data):
+        """One page of older history for a chat"""
+        friend_username = data.get("friend_username")
+        self.history_requests.discard(friend_username)
+        if data.get("status") == "error":
+            logger.error(f"❌ [WS] Older messages rejected: {data.get('message')}")
+            return
+        messages = data.get("messages", [])
+        page = self.history_pages.setdefault(friend_username, {"room_id": data.get("room_id")})
+        page["has_more"] = bool(data.get("has_more"))
+        if messages:
+            page["oldest_message_id"] = messages[0].get("message_id")
+        processed = [m for m in (self.process_message(msg, self.current_username) for msg in messages) if m]
+        logger.info(f"📜 [WS] Got {len(processed)} older messages with {friend_username} (more: {page['has_more']})")
+        self.older_messages_received.emit(friend_username, processed, page["has_more"])
+    
+    def set_active(self, active):
+        """Window focus changed; the next heartbeat reports it"""
+        self.app_active = active
+    
+    async def heartbeat_loop(self):
+        """Small periodic heartbeat so the server can tell online from idle"""
+        while self.running and self.websocket:
+            await asyncio.sleep(self.HEARTBEAT_INTERVAL)
+            try:
+                await self.websocket.send(self.encode_frame({"type": "heartbeat", "active": self.app_active}))
+            except Exception as e:
+                logger.info(f"💔 [WS] Heartbeat stopped: {e}")
+                return
     
     def set_current_username(self, username):
         """Set the current username for filtering self-messages"""
@@ -193,11 +340,14 @@ class WebSocketThread(QThread):
                     max_size=10 * 1024 * 1024,  # 10MB limit instead of default 1MB
                     ping_interval=30,
                     ping_timeout=10,
-                    compression=None  # Disable compression to save processing
+                    **build_connect_kwargs(self.compression_settings)  # permessage-deflate (server skips tiny/media frames)
                 )
                 
-                # Send authentication
-                auth_message = {"token": self.auth_token, "session_id": "home_chat"}
+                # Send authentication (offer binary protocol when msgpack is installed)
+                self.protocol = "json"
+                auth_message = {"token": self.auth_token, "session_id": "home_chat", "features": ["chunks", "batch"]}
+                if msgpack is not None:
+                    auth_message["protocols"] = ["msgpack", "json"]
                 await self.websocket.send(json.dumps(auth_message))
                 
                 logger.info("Successfully connected and authenticated")
@@ -206,8 +356,12 @@ class WebSocketThread(QThread):
                 # Send any queued messages
                 await self.send_queued_messages()
                 
-                # Listen for messages
-                await self.listen_for_messages()
+                # Listen for messages (heartbeats run alongside)
+                heartbeat_task = asyncio.ensure_future(self.heartbeat_loop())
+                try:
+                    await self.listen_for_messages()
+                finally:
+                    heartbeat_task.cancel()
                 
             except websockets.exceptions.ConnectionClosedError as e:
                 if "message too big" in str(e):
@@ -226,41 +380,75 @@ class WebSocketThread(QThread):
                     await asyncio.sleep(5)
     
     async def send_queued_messages(self):
-        """Send any queued messages"""
+        """Send any queued messages, then re-send sends that were never acknowledged"""
+        queued_ids = {m.get("client_msg_id") for m in self.message_queue}
+        self.message_queue.extend(m for cid, m in self.unacked_messages.items() if cid not in queued_ids)
         while self.message_queue and self.websocket:
             try:
                 message_data = self.message_queue.pop(0)
-                await self.websocket.send(json.dumps(message_data))
+                await self.websocket.send(self.encode_frame(message_data))
                 logger.info(f"📤 Sent queued message: {message_data}")
             except Exception as e:
                 logger.error(f"❌ Failed to send queued message: {e}")
                 self.message_queue.insert(0, message_data)
                 break
     
+    async def dispatch_message(self, data):
+        """Handle one decoded server message"""
+        message_type = data.get("type")
+        
+        logger.info(f"📨 [WS] Received message type: {message_type}")
+        
+        if message_type == "previous_conversations":
+            logger.info("📚 [WS] Processing previous_conversations message...")
+            await self.handle_previous_conversations(data)
+        elif message_type == "older_messages":
+            await self.handle_older_messages(data)
+        elif message_type == "new_message":
+            logger.info("📨 [WS] Processing new_message...")
+            await self.handle_new_message(data)
+        elif message_type == "message_sent":
+            logger.info("✅ [WS] Processing message_sent confirmation...")
+            await self.handle_message_sent(data)
+        elif message_type == "inbox":
+            logger.info(f"📥 [WS] Inbox with {len(data.get('rooms', []))} rooms")
+            for entry in data.get("rooms", []):
+                self.remember_latest_message(entry.get("peer_username"), {
+                    "room_id": entry.get("room_id"), "message_id": entry.get("last_message_id")
+                })
+            self.inbox_received.emit(data.get("rooms", []))
+        elif message_type == "presence":
+            self.presence_received.emit(data.get("updates", []))
+        elif message_type == "read_receipts":
+            logger.info(f"👁️ [WS] Read receipts: {len(data.get('receipts', []))}")
+            self.read_receipts_received.emit(data.get("receipts", []))
+        elif message_type == "auth_success":
+            self.protocol = data.get("protocol", "json")
+            logger.info(f"🔑 [WS] Authentication successful (protocol: {self.protocol})")
+        else:
+            logger.info(f"❓ [WS] Unhandled message type: {message_type}")
+    
     async def listen_for_messages(self):
         """Listen for incoming messages with improved error handling"""
         try:
             async for message in self.websocket:
                 try:
-                    print(f"DEBUG: Raw message fetched from server: {message[:200]}..." if len(message) > 200 else message)
-                    data = json.loads(message)
-                    message_type = data.get("type")
-                    
-                    logger.info(f"📨 [WS] Received message type: {message_type}")
-                    
-                    if message_type == "previous_conversations":
-                        logger.info("📚 [WS] Processing previous_conversations message...")
-                        await self.handle_previous_conversations(data)
-                    elif message_type == "new_message":
-                        logger.info("📨 [WS] Processing new_message...")
-                        await self.handle_new_message(data)
-                    elif message_type == "message_sent":
-                        logger.info("✅ [WS] Processing message_sent confirmation...")
-                        await self.handle_message_sent(data)
-                    elif message_type == "auth_success":
-                        logger.info("🔑 [WS] Authentication successful")
+                    if isinstance(message, bytes):
+                        logger.debug(f"[WS] Raw binary frame: {len(message)} bytes")
+                    else:
+                        logger.debug(f"[WS] Raw frame: {message[:200]}")
+                    data = self.decode_frame(message)
+                    if data.get("type") == "chunk":
+                        frame = self.add_chunk(data)
+                        if frame is None:
+                            continue
+                        data = self.decode_frame(frame)
+                    if data.get("type") == "batch":
+                        # Server coalesced several small frames into one
+                        for item in data.get("messages", []):
+                            await self.dispatch_message(item)
                     else:
-                        logger.info(f"❓ [WS] Unhandled message type: {message_type}")
+                        await self.dispatch_message(data)
                 
                 except json.JSONDecodeError as e:
                     logger.error(f"❌ [WS] Failed to decode JSON message: {e}")
@@ -293,6 +481,8 @@ class WebSocketThread(QThread):
             logger.info(f"📚 [WS] Conversations data: {conversations_data}")
             
             friend_conversations = {}
+            # Where each chat's history starts, so older pages can be requested (keyed by friend username)
+            self.history_pages.update(data.get("pagination") or {})
             # Use the current username from WebSocket thread if available, otherwise fallback
             current_username = self.current_username or "indira123"  # Use set username, fallback only if not set
             
@@ -351,6 +541,7 @@ class WebSocketThread(QThread):
                         
                         # Process messages
                         for msg in messages:
+                            self.remember_latest_message(friend_username, msg)
                             processed_msg = self.process_message(msg, current_username)
                             if processed_msg:
                                 friend_conversations[friend_username].append(processed_msg)
@@ -511,6 +702,8 @@ class WebSocketThread(QThread):
             print(f"  display_time: {display_time}")
             print(f"  file_data_present: {bool(file_data)}")
             
+            self.remember_latest_message(from_username, message_obj)
+            
             # FIXED: Always emit for non-self messages
             print(f"✅ [WS] EMITTING message from {from_username}")
             self.message_received.emit(from_username, message_text, display_time, message_type, file_data)
@@ -522,11 +715,12 @@ class WebSocketThread(QThread):
     
     async def handle_message_sent(self, data):
         """Handle message sent confirmation"""
-        original_msg = data.get("original", {})
+        original_msg = data.get("original") or data.get("message", {})
+        self.unacked_messages.pop(data.get("client_msg_id"), None)
         recipient_id = original_msg.get("recipient_id")
         message_text = original_msg.get("content")
         timestamp = data.get("server_timestamp")
-        delivered = data.get("status") == "delivered"
+        delivered = data.get("status") in ("delivered", "stored")
         
         display_time = self.format_timestamp(timestamp, is_timestamp=True)
         self.message_sent_confirmation.emit(str(recipient_id), message_text, display_time, delivered)
@@ -621,12 +815,14 @@ class WebSocketThread(QThread):
         if not recipient_id.strip() or not message_text.strip():
             return False
         
-        message_data = {"recipient_id": recipient_id, "message": message_text}
+        # client_msg_id makes retries idempotent: the server saves and fans out each id once
+        message_data = {"recipient_id": recipient_id, "message": message_text, "client_msg_id": uuid.uuid4().hex}
+        self.unacked_messages[message_data["client_msg_id"]] = message_data
         
         if self.websocket and self.loop:
             try:
                 future = asyncio.run_coroutine_threadsafe(
-                    self.websocket.send(json.dumps(message_data)), self.loop
+                    self.websocket.send(self.encode_frame(message_data)), self.loop
                 )
                 future.result(timeout=1.0)
                 logger.info("✅ Message sent successfully")
@@ -644,9 +840,11 @@ class WebSocketThread(QThread):
         if not message_data.get("recipient_id") or not message_data.get("file_data"):
             return False
         
+        message_data.setdefault("client_msg_id", uuid.uuid4().hex)
+        
         # Check message size before sending
-        message_json = json.dumps(message_data)
-        message_size = len(message_json.encode('utf-8'))
+        message_json = self.encode_frame(message_data)
+        message_size = len(message_json if isinstance(message_json, bytes) else message_json.encode('utf-8'))
         max_size = 8 * 1024 * 1024  # 8MB limit for safety (server has 10MB limit)
         
         print(f"📤 [WS] File message size: {message_size/1024/1024:.2f}MB")
@@ -655,10 +853,13 @@ class WebSocketThread(QThread):
             logger.error(f"❌ File message too large: {message_size/1024/1024:.1f}MB > {max_size/1024/1024:.1f}MB")
             return False
         
+        self.unacked_messages[message_data["client_msg_id"]] = message_data
+        
         if self.websocket and self.loop:
             try:
                 future = asyncio.run_coroutine_threadsafe(
-                    self.websocket.send(message_json), self.loop
+                    self.send_chunked(message_json) if message_size > self.UPLOAD_CHUNK_SIZE
+                    else self.websocket.send(message_json), self.loop
                 )
                 future.result(timeout=15.0)  # Longer timeout for large files
                 logger.info("✅ File message sent successfully")
@@ -670,6 +871,7 @@ class WebSocketThread(QThread):
             except websockets.exceptions.ConnectionClosedError as e:
                 if "message too big" in str(e):
                     logger.error(f"❌ File message rejected - too large: {e}")
+                    self.unacked_messages.pop(message_data["client_msg_id"], None)
                 else:
                     logger.error(f"❌ Connection closed while sending file: {e}")
                 return False
@@ -705,6 +907,9 @@ class HomePage(QWidget):
         self.auth_token = None
         self.current_user = None
         self.chat_history = {}  # Store all chat history
+        self.inbox = {}  # peer_username -> inbox entry from server (last message, unread count)
+        self.peer_read_up_to = {}  # room_id -> last message id the peer has read (from read receipts)
+        self.friend_presence = {}  # user_id -> 'online' | 'idle' | 'offline'
         self.websocket_client = None
         
         # Create navigation sidebar
@@ -784,6 +989,10 @@ class HomePage(QWidget):
         # Connect signals with debug
         print("🔗 [HOME] Connecting WebSocket signals...")
         self.websocket_client.previous_conversations_received.connect(self.handle_chat_history)
+        self.websocket_client.inbox_received.connect(self.handle_inbox)
+        self.websocket_client.read_receipts_received.connect(self.handle_read_receipts)
+        self.websocket_client.presence_received.connect(self.handle_presence)
+        self.websocket_client.older_messages_received.connect(self.handle_older_messages)
         self.websocket_client.message_received.connect(self.handle_incoming_message)
         self.websocket_client.connection_established.connect(self.on_websocket_connected)
         self.websocket_client.connection_lost.connect(self.on_websocket_disconnected)
@@ -843,6 +1052,24 @@ class HomePage(QWidget):
         
         print(f"📚 [HOME] *** CHAT HISTORY PROCESSING COMPLETE ***")
     
+    @pyqtSlot(str, list, bool)
+    def handle_older_messages(self, friend_username, messages, has_more):
+        """Prepend a page of older history, keeping the visible messages where they are"""
+        if messages:
+            self.chat_history[friend_username] = messages + self.chat_history.get(friend_username, [])
+        print(f"📜 [HOME] {len(messages)} older messages for {friend_username} (more: {has_more})")
+        if friend_username != self.current_chat_user or not messages:
+            return
+        scrollbar = self.messages_scroll.verticalScrollBar()
+        from_bottom = scrollbar.maximum() - scrollbar.value()
+        self.display_chat_messages(friend_username, scroll_to_end=False)
+        QTimer.singleShot(100, lambda: scrollbar.setValue(scrollbar.maximum() - from_bottom))
+    
+    def on_messages_scrolled(self, value):
+        """Reaching the top of a chat loads the page before it"""
+        if value == self.messages_scroll.verticalScrollBar().minimum() and self.current_chat_user and self.websocket_client:
+            self.websocket_client.request_older_messages(self.current_chat_user)
+    
     @pyqtSlot(str, str, str, str, dict)
     def handle_incoming_message(self, from_username, message_text, timestamp, message_type='text', file_data=None):
         """Handle incoming message with file/image support - FIXED VERSION"""
@@ -945,6 +1172,7 @@ class HomePage(QWidget):
         if self.current_chat_user == from_username:
             print(f"✅ [HOME] Chat with {from_username} is active. Adding bubble to display.")
             self.add_message_to_display_with_type(message_data)
+            self.websocket_client.mark_read(from_username)
         else:
             print(f"ℹ️ [HOME] Chat with {from_username} is not active. Message stored for later viewing.")
 
@@ -1072,12 +1300,12 @@ class HomePage(QWidget):
             
             timestamp = datetime.datetime.now().strftime("%H:%M")
             
-            # Create message data for WebSocket
+            # Create message data for WebSocket (raw bytes when binary frames are negotiated)
             message_data = {
                 "recipient_id": self.current_chat_user,
                 "message_type": file_type,
                 "file_name": file_name,
-                "file_data": file_base64,
+                "file_data": file_data if self.websocket_client.uses_binary_frames() else file_base64,
                 "file_size": file_size,
                 "mime_type": mime_type
             }
@@ -1557,8 +1785,46 @@ class HomePage(QWidget):
         
         return f"{size:.1f} {size_names[i]}"
     
+    @pyqtSlot(list)
+    def handle_inbox(self, rooms):
+        """Populate the chat sidebar from the server inbox (no history needed)"""
+        self.inbox = {}
+        for entry in rooms:
+            peer_username = entry.get('peer_username')
+            if peer_username:
+                self.inbox[peer_username] = entry
+        print(f"📥 [HOME] Inbox loaded: {len(self.inbox)} conversations")
+        
+        # Server sends entries most recent first; add oldest first so the newest ends up on top
+        for peer_username in reversed(list(self.inbox.keys())):
+            self.add_friend_to_chat_list(peer_username)
+    
+    def handle_read_receipts(self, receipts):
+        """Remember how far each peer has read (room_id -> last read message id)"""
+        for receipt in receipts:
+            room_id = str(receipt.get('room_id'))
+            self.peer_read_up_to[room_id] = max(receipt.get('last_read_id', 0), self.peer_read_up_to.get(room_id, 0))
+        print(f"👁️ [HOME] Read receipts updated for {len(receipts)} rooms")
+    
+    def handle_presence(self, updates):
+        """Apply a batch of friend presence changes"""
+        for update in updates:
+            self.friend_presence[update.get('user_id')] = update.get('state')
+        print(f"🟢 [HOME] Presence updated for {len(updates)} friends")
+    
+    def changeEvent(self, event):
+        """Report window focus to the server as online/idle"""
+        if event.type() == QEvent.ActivationChange and self.websocket_client:
+            self.websocket_client.set_active(self.isActiveWindow())
+        super().changeEvent(event)
+    
     def find_most_recent_chat(self, friend_conversations):
         """Find the friend with the most recent message"""
+        # Prefer the server inbox: it orders rooms by message id, no timestamp guessing
+        inbox_candidates = [name for name in self.inbox if name in friend_conversations]
+        if inbox_candidates:
+            return max(inbox_candidates, key=lambda name: self.inbox[name].get('last_message_id') or 0)
+        
         try:
             most_recent_friend = None
             latest_timestamp = None
@@ -1664,6 +1930,10 @@ class HomePage(QWidget):
             # No history, start fresh
             self.display_chat_messages(friend_username)
         
+        # Opening a chat reads it
+        if self.websocket_client:
+            self.websocket_client.mark_read(friend_username)
+        
         # Enable message input
         self.message_input.setPlaceholderText(f"Message {friend_username}...")
         self.message_input.setEnabled(True)
@@ -1696,7 +1966,7 @@ class HomePage(QWidget):
         layout.addWidget(message_label)
         return container
     
-    def display_chat_messages(self, friend_username):
+    def display_chat_messages(self, friend_username, scroll_to_end=True):
         """Display chat messages for friend with file/image support"""
         if not hasattr(self, 'messages_layout'):
             return
@@ -1724,7 +1994,8 @@ class HomePage(QWidget):
         self.messages_layout.addStretch()
         
         # Scroll to bottom
-        QTimer.singleShot(100, self.scroll_to_bottom)
+        if scroll_to_end:
+            QTimer.singleShot(100, self.scroll_to_bottom)
     
     def add_message_to_display(self, message_text, is_sent, timestamp):
         """Add message to chat display"""
@@ -2135,6 +2406,7 @@ class HomePage(QWidget):
         self.messages_layout.addStretch()
         
         self.messages_scroll.setWidget(self.messages_container)
+        self.messages_scroll.verticalScrollBar().valueChanged.connect(self.on_messages_scrolled)
         
         layout.addWidget(chat_header)
         layout.addWidget(self.messages_scroll)
@@ -2467,6 +2467,7 @@ import base64
 # --- Constants ---
 JWT_SECRET = 'your-secret-key-change-in-production'
 UPLOAD_DIR = 'uploads'
+HISTORY_PAGE_SIZE = 50  # Messages per room sent on connect / per "older messages" page
 
 # --- Database Functions ---
 def get_db_connection():
@@ -2492,6 +2493,8 @@ def init_database():
             cursor.execute("CREATE TABLE IF NOT EXISTS messages (message_id SERIAL PRIMARY KEY, room_id VARCHAR(255) NOT NULL, sender_id INTEGER NOT NULL, sender_username VARCHAR(255) NOT NULL, recipient_id VARCHAR(255), content TEXT, message_type VARCHAR(10) DEFAULT 'text', file_name VARCHAR(255), file_path TEXT, file_size INTEGER, mime_type VARCHAR(100), timestamp TIMESTAMPTZ DEFAULT CURRENT_TIMESTAMP, FOREIGN KEY (sender_id) REFERENCES users (user_id))")
             cursor.execute('CREATE INDEX IF NOT EXISTS idx_messages_room_id ON messages (room_id);')
             cursor.execute('CREATE INDEX IF NOT EXISTS idx_messages_sender_id ON messages (sender_id);')
+            # db_get_conversations unions rooms by recipient_id (same index as migration 002 of the main server)
+            cursor.execute('CREATE INDEX IF NOT EXISTS idx_messages_recipient_id ON messages (recipient_id);')
         conn.commit()
     finally:
         conn.close()
@@ -2596,48 +2599,96 @@ async def db_save_message(user_info, room_id, recipient_username, message_data):
     print(f"✅ [DB] Saved {message_type} message to DB: ID {message_id}")
     return full_message
 
-async def db_get_conversations(user_id, username):
+def _db_row_to_message(row):
+    message_id, recipient_name, sender, content, msg_type, ts, file_name, file_path, file_size = row
+    return {
+        "message_id": message_id, "sender_username": sender, "recipient_id": recipient_name,
+        "content": content, "message_type": msg_type, "timestamp": ts.isoformat(),
+        "file_name": file_name, "file_path": file_path, "file_size": file_size
+    }
+
+async def db_get_conversations(user_id, username, per_room=HISTORY_PAGE_SIZE):
+    """Last `per_room` messages of every room the user is in, in ONE round-trip.
+    Returns (conversations, pagination) where pagination tells the client how to page back."""
     print(f"📚 [DB] Getting all conversations for user_id: {user_id}")
     conn = get_db_connection()
-    if not conn: return {}
+    if not conn: return {}, {}
+
+    # One windowed query instead of DISTINCT room_id + one SELECT per room (N+1).
+    # rn <= per_room + 1 fetches a single extra row per room to know if older pages exist.
+    query = """
+        WITH user_rooms AS (
+            SELECT room_id FROM messages WHERE sender_id = %s
+            UNION
+            SELECT room_id FROM messages WHERE recipient_id = %s
+        ), ranked AS (
+            SELECT m.room_id, m.message_id, m.recipient_id, m.sender_username, m.content, m.message_type,
+                   m.timestamp, m.file_name, m.file_path, m.file_size,
+                   ROW_NUMBER() OVER (PARTITION BY m.room_id ORDER BY m.message_id DESC) AS rn
+            FROM messages m
+            JOIN user_rooms ur ON ur.room_id = m.room_id
+        )
+        SELECT room_id, rn, message_id, recipient_id, sender_username, content, message_type,
+               timestamp, file_name, file_path, file_size
+        FROM ranked
+        WHERE rn <= %s
+        ORDER BY room_id, message_id ASC;
+    """
 
-    # --- FIX: This query now correctly compares sender ID (int) and recipient ID (text) ---
-    query = "SELECT DISTINCT room_id FROM messages WHERE sender_id = %s OR recipient_id = %s;"
-    
     try:
         with conn.cursor() as cursor:
-            cursor.execute(query, (user_id, username))
-            room_ids = [row[0] for row in cursor.fetchall()]
-        
-        print(f"📚 [DB] Found {len(room_ids)} rooms involving user {username}: {room_ids}")
-        if not room_ids: return {}
+            cursor.execute(query, (user_id, username, per_room + 1))
+            rows = cursor.fetchall()
+    finally:
+        conn.close()
 
-        conversations = {}
+    rooms = {}
+    for row in rows:
+        room_id, rn = row[0], row[1]
+        room = rooms.setdefault(room_id, {'messages': [], 'has_more': False, 'friend_username': None})
+        if rn > per_room:
+            room['has_more'] = True  # the extra row only signals that an older page exists
+            continue
+        message = _db_row_to_message(row[2:])
+        if room['friend_username'] is None:
+            if message['sender_username'] != username: room['friend_username'] = message['sender_username']
+            elif message['recipient_id'] != username: room['friend_username'] = message['recipient_id']
+        room['messages'].append(message)
+
+    print(f"📚 [DB] Found {len(rooms)} rooms involving user {username}: {list(rooms)}")
+    conversations, pagination = {}, {}
+    for room_id, room in rooms.items():
+        key = room['friend_username'] or username
+        if not room['messages']: continue
+        conversations[key] = room['messages']
+        pagination[key] = {
+            'room_id': room_id,
+            'oldest_message_id': room['messages'][0]['message_id'],
+            'has_more': room['has_more']
+        }
+    return conversations, pagination
+
+async def db_get_messages_page(room_id, before_message_id=None, limit=HISTORY_PAGE_SIZE):
+    """Older messages of one room, newest `limit` before `before_message_id` (keyset pagination).
+    Ordered by message_id, the keyset column, so pages never skip or repeat rows."""
+    conn = get_db_connection()
+    if not conn: return [], False
+    try:
         with conn.cursor() as cursor:
-            for room_id in room_ids:
-                cursor.execute("SELECT recipient_id, sender_username, content, message_type, timestamp, file_name, file_path, file_size FROM messages WHERE room_id = %s ORDER BY timestamp ASC", (room_id,))
-                
-                messages, friend_username = [], None
-                for row in cursor.fetchall():
-                    recipient_name, sender, content, msg_type, ts, file_name, file_path, file_size = row
-                    
-                    if friend_username is None:
-                        if sender != username: friend_username = sender
-                        elif recipient_name != username: friend_username = recipient_name
-
-                    messages.append({
-                        "sender_username": sender, "content": content, "message_type": msg_type,
-                        "timestamp": ts.isoformat(), "file_name": file_name, "file_path": file_path,
-                        "file_size": file_size
-                    })
-                
-                if friend_username:
-                    conversations[friend_username] = messages
-                elif messages:
-                    conversations[username] = messages
-        return conversations
+            cursor.execute("""
+                SELECT message_id, recipient_id, sender_username, content, message_type, timestamp,
+                       file_name, file_path, file_size
+                FROM messages
+                WHERE room_id = %s AND (%s::int IS NULL OR message_id < %s)
+                ORDER BY message_id DESC
+                LIMIT %s
+            """, (room_id, before_message_id, before_message_id, limit + 1))
+            rows = cursor.fetchall()
     finally:
         conn.close()
+    has_more = len(rows) > limit
+    messages = [_db_row_to_message(row) for row in reversed(rows[:limit])]
+    return messages, has_more
 
 async def db_get_friends(user_id):
     print(f"👥 [DB] Getting friend list for user_id: {user_id}")
@@ -2720,8 +2771,8 @@ async def websocket_handler(request):
         await ws.send_json({'type': 'friends_list_response', 'status': 'success', 'friends': friends, 'count': len(friends)})
         print(f"  -> Sent {len(friends)} friends.")
 
-        conversations = await db_get_conversations(user_info['user_id'], user_info['username'])
-        await ws.send_json({"type": "previous_conversations", "conversations": conversations})
+        conversations, pagination = await db_get_conversations(user_info['user_id'], user_info['username'])
+        await ws.send_json({"type": "previous_conversations", "conversations": conversations, "pagination": pagination})
         print(f"  -> Sent {len(conversations)} conversations.")
 
         async for msg in ws:
@@ -2744,6 +2795,28 @@ async def websocket_handler(request):
                     if recipient_id_int:
                         await auth_bridge.send_to_user_websockets(recipient_id_int, {'type': 'new_message', 'message': new_message})
 
+                elif action == 'get_older_messages':
+                    # Page back through one conversation: {friend_username, before_message_id, limit}
+                    friend_username = data.get('friend_username')
+                    room_id, _ = get_or_create_room_id(user_info['user_id'], friend_username) if friend_username else (None, None)
+                    if not room_id: continue
+                    try:
+                        limit = max(1, min(int(data.get('limit') or HISTORY_PAGE_SIZE), 200))
+                        before_message_id = data.get('before_message_id')
+                        if before_message_id is not None:
+                            before_message_id = int(before_message_id)
+                    except (TypeError, ValueError):
+                        await ws.send_json({
+                            'type': 'older_messages', 'status': 'error', 'friend_username': friend_username,
+                            'message': 'limit and before_message_id must be integers.'
+                        })
+                        continue
+                    messages, has_more = await db_get_messages_page(room_id, before_message_id, limit)
+                    await ws.send_json({
+                        'type': 'older_messages', 'friend_username': friend_username, 'room_id': room_id,
+                        'messages': messages, 'has_more': has_more
+                    })
+
     except Exception as e:
         print(f"WebSocket Error for {user_info['username'] if user_info else 'Initial Connection'}: {e}")
     finally:
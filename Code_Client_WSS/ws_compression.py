@@ -0,0 +1,32 @@
+"""Permessage-deflate settings shared by the client WebSocket threads."""
+
+from websockets.extensions.permessage_deflate import ClientPerMessageDeflateFactory
+
+# Default compression settings for chat connections.
+# Context takeover keeps the deflate window between frames, which is what makes
+# repetitive JSON (same keys, usernames, timestamps) compress well.
+DEFAULT_COMPRESSION_SETTINGS = {
+    'enabled': True,
+    'server_no_context_takeover': False,
+    'client_no_context_takeover': False,
+    'server_max_window_bits': None,   # None = let the server pick (15)
+    'client_max_window_bits': 15,
+    'mem_level': 5,                   # Lower memLevel = less RAM per connection
+}
+
+
+def build_connect_kwargs(settings=None):
+    """Build the compression/extensions kwargs for websockets.connect()"""
+    config = {**DEFAULT_COMPRESSION_SETTINGS, **(settings or {})}
+    if not config['enabled']:
+        return {'compression': None}
+
+    factory = ClientPerMessageDeflateFactory(
+        server_no_context_takeover=config['server_no_context_takeover'],
+        client_no_context_takeover=config['client_no_context_takeover'],
+        server_max_window_bits=config['server_max_window_bits'],
+        client_max_window_bits=config['client_max_window_bits'],
+        compress_settings={'memLevel': config['mem_level']},
+    )
+    # compression=None turns off the default extension so ours is the only offer
+    return {'compression': None, 'extensions': [factory]}
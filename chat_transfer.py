@@ -0,0 +1,420 @@
+"""Streaming NDJSON export/import of chat history (backups, and chat_log.json -> PostgreSQL migration).
+
+    python chat_transfer.py export --source json --out backup.ndjson [--room ID ...] [--user ID]
+    python chat_transfer.py import backup.ndjson --target postgres
+    python chat_transfer.py migrate                      # chat_log.json -> messages table via COPY
+
+One message per line, in room order and chronological within a room. Both directions keep
+one batch in memory at a time; chat_log.json is parsed incrementally, never loaded whole.
+PostgreSQL uses DB_HOST/DB_PORT/DB_NAME/DB_USER/DB_PASSWORD/DB_SSLMODE, like the server.
+"""
+
+import argparse
+import itertools
+import json
+import os
+import sys
+import time
+
+from cold_archive import ColdArchive
+from message_store import (SegmentMessageStore, SqliteMessageStore, PostgresMessageStore,
+                           create_message_store, encode_record, _message_to_row)
+
+COPY_COLUMNS = ("room_id, sender_id, sender_username, recipient_id, content, "
+                "message_type, file_name, timestamp, seq, client_msg_id")
+IMPORT_BATCH_SIZE = 5000
+
+
+def db_config_from_env():
+    return {
+        'host': os.environ.get('DB_HOST', 'localhost'),
+        'port': int(os.environ.get('DB_PORT', '5432')),
+        'database': os.environ.get('DB_NAME', 'postgres'),
+        'user': os.environ.get('DB_USER', 'postgres'),
+        'password': os.environ.get('DB_PASSWORD', ''),
+        'sslmode': os.environ.get('DB_SSLMODE', 'prefer'),
+    }
+
+
+class Progress:
+    """Prints a running count to stderr every `interval` seconds"""
+
+    def __init__(self, label, interval=2.0):
+        self.label = label
+        self.interval = interval
+        self.count = 0
+        self.skipped = 0
+        self.started = self.last = time.perf_counter()
+
+    def tick(self, amount=1):
+        self.count += amount
+        now = time.perf_counter()
+        if now - self.last >= self.interval:
+            self.last = now
+            print(f"⏳ [Transfer] {self.label}: {self.count} messages "
+                  f"({self.count / (now - self.started):.0f}/s)", file=sys.stderr)
+
+    def done(self):
+        elapsed = time.perf_counter() - self.started
+        print(f"✅ [Transfer] {self.label}: {self.count} messages in {elapsed:.1f}s "
+              f"({self.count / max(elapsed, 1e-9):.0f}/s)", file=sys.stderr)
+        if self.skipped:
+            print(f"⚠️ [Transfer] {self.label}: skipped {self.skipped} messages without sender_id/sender_username",
+                  file=sys.stderr)
+
+
+# --- chat_log.json, parsed incrementally ---
+
+class _JsonStream:
+    """Reads one JSON value at a time from a file with a bounded buffer"""
+
+    def __init__(self, f, chunk_size=64 * 1024):
+        self.f = f
+        self.chunk_size = chunk_size
+        self.buf = ''
+        self.pos = 0
+        self._decoder = json.JSONDecoder()
+
+    def _fill(self):
+        # Read at least as much as is buffered, so one huge value costs O(n) retries, not O(n^2)
+        data = self.f.read(max(self.chunk_size, len(self.buf) - self.pos))
+        if not data:
+            return False
+        self.buf = self.buf[self.pos:] + data
+        self.pos = 0
+        return True
+
+    def peek(self):
+        while True:
+            while self.pos < len(self.buf) and self.buf[self.pos] in ' \t\r\n':
+                self.pos += 1
+            if self.pos < len(self.buf):
+                return self.buf[self.pos]
+            if not self._fill():
+                return ''
+
+    def expect(self, char):
+        if self.peek() != char:
+            raise ValueError(f"Expected {char!r} in chat log at offset {self.f.tell()}")
+        self.pos += 1
+
+    def skip_comma(self):
+        if self.peek() == ',':
+            self.pos += 1
+            return True
+        return False
+
+    def value(self):
+        self.peek()
+        while True:
+            try:
+                value, end = self._decoder.raw_decode(self.buf, self.pos)
+            except json.JSONDecodeError:
+                if not self._fill():
+                    raise
+                continue
+            # A number ending exactly at the buffer edge may continue in the next chunk
+            if end == len(self.buf) and self._fill():
+                continue
+            self.pos = end
+            return value
+
+
+def _scan_json_log(path):
+    """Yield (room_id, message) from {"conversations": {room_id: [message, ...]}, ...}"""
+    with open(path, 'r', encoding='utf-8') as f:
+        stream = _JsonStream(f)
+        stream.expect('{')
+        if stream.peek() == '}':
+            return
+        while True:
+            key = stream.value()
+            stream.expect(':')
+            if key != 'conversations':
+                stream.value()  # read_cursors and friends are small
+            else:
+                stream.expect('{')
+                while stream.peek() != '}':
+                    room_id = stream.value()
+                    stream.expect(':')
+                    stream.expect('[')
+                    while stream.peek() != ']':
+                        yield str(room_id), stream.value()
+                        stream.skip_comma()
+                    stream.expect(']')
+                    stream.skip_comma()
+                stream.expect('}')
+            if not stream.skip_comma():
+                break
+
+
+def iter_json_log(path, rooms=None):
+    """chat_log.json records with message_id/seq filled in the way JsonMessageStore numbers them.
+
+    Two streaming passes: the first only finds the highest message_id.
+    """
+    next_id = max((m.get('message_id') or 0 for _, m in _scan_json_log(path)), default=0) + 1
+    for room_id, messages in itertools.groupby(_scan_json_log(path), key=lambda record: record[0]):
+        seq = 0
+        for _, message in messages:
+            if not message.get('message_id'):
+                # Ids are assigned in file order, only to messages that lack one
+                message['message_id'] = next_id
+                next_id += 1
+            seq = message['seq'] if message.get('seq') else seq + 1
+            message['seq'] = seq
+            if rooms is None or room_id in rooms:
+                yield room_id, message
+
+
+# --- sources ---
+
+def iter_store(store, rooms=None):
+    for room_id in (sorted(rooms) if rooms is not None else store.list_rooms()):
+        for message in store.iter_room(room_id):
+            yield str(room_id), message
+
+
+def with_archive(records, archive, rooms=None):
+    """Put each room's archived history in front of its hot records (rooms only archived come last)"""
+    seen = set()
+    for room_id, group in itertools.groupby(records, key=lambda record: record[0]):
+        seen.add(room_id)
+        archived_through = 0
+        for message in archive.iter_room(room_id):
+            archived_through = message['message_id']
+            yield room_id, message
+        for _, message in group:
+            if (message.get('message_id') or 0) > archived_through:
+                yield room_id, message
+    for room_id in archive.room_ids():
+        if room_id not in seen and (rooms is None or room_id in rooms):
+            for message in archive.iter_room(room_id):
+                yield room_id, message
+
+
+def rooms_of_user(user_id):
+    """Room ids the user is a member of (from room_members)"""
+    from query_catalog import QueryCatalog
+    catalog = QueryCatalog(db_config_from_env(), prepare=False, maxconn=1)
+    try:
+        return {str(row[0]) for row in catalog.fetchall('rooms.inbox_of_user', (user_id,))}
+    finally:
+        catalog.close()
+
+
+def open_source(args, rooms):
+    if args.source == 'json':
+        records = iter_json_log(args.json_path, rooms)
+    else:
+        store = create_message_store(args.source, sqlite_path=args.sqlite_path,
+                                     db_config=db_config_from_env(), segment_dir=args.segment_dir)
+        records = iter_store(store, rooms)
+    if args.archive_dir and os.path.isdir(args.archive_dir):
+        records = with_archive(records, ColdArchive(args.archive_dir), rooms)
+    return records
+
+
+# --- export ---
+
+def export_records(records, out, progress):
+    for room_id, message in records:
+        out.write(encode_record({**message, 'room_id': room_id}))
+        out.write('\n')
+        progress.tick()
+    progress.done()
+
+
+# --- import ---
+
+def read_ndjson(path):
+    with open(path, 'r', encoding='utf-8') as f:
+        for line in f:
+            if line.strip():
+                message = json.loads(line)
+                yield str(message.get('room_id')), message
+
+
+def _copy_field(value):
+    if value is None:
+        return '\\N'
+    return str(value).replace('\\', '\\\\').replace('\t', '\\t').replace('\n', '\\n').replace('\r', '\\r')
+
+
+class _CopyReader:
+    """File-like object feeding COPY FROM STDIN from a record iterator, a few rows at a time"""
+
+    def __init__(self, records, keep_ids, progress):
+        self.records = records
+        self.keep_ids = keep_ids
+        self.progress = progress
+        self.buffer = ''
+
+    def _row(self, room_id, message):
+        row = _message_to_row(room_id, message)
+        if self.keep_ids:
+            row = (message['message_id'],) + row
+        return '\t'.join(_copy_field(value) for value in row) + '\n'
+
+    def read(self, size=-1):
+        parts, length = [self.buffer], len(self.buffer)
+        while size < 0 or length < size:
+            record = next(self.records, None)
+            if record is None:
+                break
+            row = self._row(*record)
+            parts.append(row)
+            length += len(row)
+            self.progress.tick()
+        data = ''.join(parts)
+        if size < 0 or len(data) <= size:
+            self.buffer = ''
+            return data
+        self.buffer = data[size:]
+        return data[:size]
+
+
+
+def migrate_postgres():
+    """Apply pending schema migrations, like the server does on start (no DDL when current)"""
+    import psycopg2
+    from migrations import run_migrations
+    conn = psycopg2.connect(**db_config_from_env())
+    try:
+        run_migrations(conn)
+    finally:
+        conn.close()
+
+
+def import_postgres(records, progress, keep_ids=True):
+    """COPY into `messages` in one transaction, then fix up the id sequence and room sequences"""
+    migrate_postgres()
+    store = PostgresMessageStore(db_config_from_env(), maxconn=1)
+    columns = f"message_id, {COPY_COLUMNS}" if keep_ids else COPY_COLUMNS
+
+    def copy(cursor):
+        cursor.copy_expert(f"COPY messages ({columns}) FROM STDIN", _CopyReader(records, keep_ids, progress), size=256 * 1024)
+        if keep_ids:
+            cursor.execute("SELECT setval(pg_get_serial_sequence('messages', 'message_id'), "
+                           "GREATEST((SELECT MAX(message_id) FROM messages), 1))")
+        cursor.execute('''
+            INSERT INTO room_sequences (room_id, last_seq)
+            SELECT room_id, MAX(seq) FROM messages WHERE seq IS NOT NULL GROUP BY room_id
+            ON CONFLICT (room_id) DO UPDATE SET last_seq = GREATEST(room_sequences.last_seq, excluded.last_seq)
+        ''')
+    try:
+        store._run(copy)
+    finally:
+        store.close()
+    progress.done()
+
+
+def import_sqlite(records, progress, path, keep_ids=True):
+    """Batched executemany, one transaction per IMPORT_BATCH_SIZE rows"""
+    store = SqliteMessageStore(path)
+    columns = f"message_id, {COPY_COLUMNS}" if keep_ids else COPY_COLUMNS
+    placeholders = ', '.join('?' for _ in columns.split(','))
+    try:
+        while True:
+            batch = list(itertools.islice(records, IMPORT_BATCH_SIZE))
+            if not batch:
+                break
+            rows = [((m['message_id'],) if keep_ids else ()) + _message_to_row(room_id, m) for room_id, m in batch]
+            with store._lock:
+                store.conn.executemany(f"INSERT INTO messages ({columns}) VALUES ({placeholders})", rows)
+                store.conn.commit()
+            progress.tick(len(batch))
+        with store._lock:
+            store.conn.execute('''
+                INSERT INTO room_sequences (room_id, last_seq)
+                SELECT room_id, MAX(seq) FROM messages WHERE seq IS NOT NULL GROUP BY room_id
+                ON CONFLICT (room_id) DO UPDATE SET last_seq = MAX(last_seq, excluded.last_seq)
+            ''')
+            store.conn.commit()
+    finally:
+        store.close()
+    progress.done()
+
+
+def import_segment(records, progress, directory):
+    """Appends batches straight into segment files, keeping message ids and seqs"""
+    store = SegmentMessageStore(directory)
+    try:
+        while True:
+            batch = list(itertools.islice(records, IMPORT_BATCH_SIZE))
+            if not batch:
+                break
+            with store._lock:
+                store._append(batch)
+            progress.tick(len(batch))
+    finally:
+        store.close()
+    progress.done()
+
+
+def _importable(records, progress):
+    """Drop legacy records the messages table cannot hold (sender columns are NOT NULL)"""
+    for room_id, message in records:
+        if message.get('sender_id') is None or message.get('sender_username') is None:
+            progress.skipped += 1
+            continue
+        yield room_id, message
+
+
+def import_records(records, args, label):
+    progress = Progress(label)
+    records = _importable(records, progress)
+    if args.target == 'postgres':
+        import_postgres(records, progress, keep_ids=not args.new_ids)
+    elif args.target == 'sqlite':
+        import_sqlite(records, progress, args.sqlite_path, keep_ids=not args.new_ids)
+    elif args.target == 'segment':
+        import_segment(records, progress, args.segment_dir)
+    else:
+        raise ValueError(f"Unknown import target: {args.target}")
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument('--json-path', default='chat_log.json')
+    parser.add_argument('--sqlite-path', default='chat_messages.db')
+    parser.add_argument('--segment-dir', default='chat_segments')
+    parser.add_argument('--archive-dir', default='chat_archive', help="cold archive merged into exports ('' = skip)")
+    commands = parser.add_subparsers(dest='command', required=True)
+
+    export = commands.add_parser('export', help='write history as NDJSON')
+    export.add_argument('--source', default='json', choices=['json', 'sqlite', 'postgres', 'segment'])
+    export.add_argument('--out', default='-', help="output file ('-' = stdout)")
+    export.add_argument('--room', action='append', help='only these rooms (repeatable)')
+    export.add_argument('--user', type=int, help="only rooms this user is a member of")
+
+    load = commands.add_parser('import', help='bulk-load an NDJSON export')
+    load.add_argument('path')
+    load.add_argument('--target', default='postgres', choices=['postgres', 'sqlite', 'segment'])
+    load.add_argument('--new-ids', action='store_true', help='let the target assign message ids')
+
+    migrate = commands.add_parser('migrate', help='chat_log.json -> target in one streaming pass')
+    migrate.add_argument('--target', default='postgres', choices=['postgres', 'sqlite', 'segment'])
+    migrate.add_argument('--new-ids', action='store_true')
+
+    args = parser.parse_args(argv)
+    if args.command == 'export':
+        rooms = set(args.room) if args.room else None
+        if args.user is not None:
+            user_rooms = rooms_of_user(args.user)
+            rooms = user_rooms if rooms is None else rooms & user_rooms
+        records = open_source(args, rooms)
+        if args.out == '-':
+            export_records(records, sys.stdout, Progress('export'))
+        else:
+            with open(args.out, 'w', encoding='utf-8') as out:
+                export_records(records, out, Progress('export'))
+    elif args.command == 'import':
+        import_records(read_ndjson(args.path), args, f"import {args.path} -> {args.target}")
+    else:
+        args.source = 'json'
+        import_records(open_source(args, None), args, f"migrate {args.json_path} -> {args.target}")
+
+
+if __name__ == '__main__':
+    main()
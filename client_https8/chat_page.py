@@ -234,12 +234,11 @@ class ChatPage(QWidget):
         
         # --- FIX: Add timestamp to all bubble types ---
         timestamp_str = message_data.get('timestamp', '')
-        # Handle full ISO format from server poll vs. pre-formatted from history/optimistic
-        if 'T' in timestamp_str and 'Z' in timestamp_str:
+        # Server history/poll send full ISO timestamps (Z or +hh:mm); optimistic ones are pre-formatted
+        if 'T' in timestamp_str:
             try:
-                # Naively convert UTC to local time. For accuracy, pytz would be needed here too.
-                ts_utc = datetime.fromisoformat(timestamp_str.replace('Z', '+00:00'))
-                timestamp_str = ts_utc.astimezone().strftime("%I:%M %p").lower()
+                ts = datetime.fromisoformat(timestamp_str.replace('Z', '+00:00'))
+                timestamp_str = ts.astimezone().strftime("%I:%M %p").lower()
             except ValueError:
                 pass # Use the string as is if parsing fails
         
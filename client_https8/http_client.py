@@ -64,6 +64,7 @@ class HttpClient(QObject):
         self.session.verify = False
         self.token = None
         self.workers = []
+        self.mailbox_cursor = 0  # Last mailbox_seq processed; sent back so the server can drop it
 
     def start_polling_for_messages(self):
         """Starts the long polling loop in a background thread."""
@@ -90,7 +91,10 @@ class HttpClient(QObject):
                     break # Exit loop if not authenticated or stopped
                 
                 # This is a blocking request with a long timeout
-                response = self.session.get(f"{SERVER_URL}/api/receive?poll=true", timeout=35)
+                # The cursor acks everything already processed and returns anything queued while offline
+                response = self.session.get(
+                    f"{SERVER_URL}/api/receive?poll=true&after={self.mailbox_cursor}", timeout=35
+                )
                 
                 if not self.is_polling:
                     break # Exit immediately if polling was stopped during the request
@@ -101,6 +105,8 @@ class HttpClient(QObject):
                     if messages:
                         print(f"CLIENT (Poll): Received {len(messages)} new message(s).")
                         self.new_messages_received.emit(messages)
+                    if data.get("next_cursor") is not None:
+                        self.mailbox_cursor = max(self.mailbox_cursor, data["next_cursor"])
                 else:
                     # If there's an error, wait a bit before retrying
                     time.sleep(5)
@@ -0,0 +1,77 @@
+"""Content-addressed attachment storage: message rows keep metadata, file bytes live on disk."""
+
+import base64
+import binascii
+import hashlib
+import os
+import tempfile
+
+
+class BlobStore:
+    """Files named by the SHA-256 of their bytes, sharded as <directory>/<ab>/<key>.
+
+    Blobs are immutable: the same bytes always map to the same key, so re-sending a
+    file stores it once and a key can be served with long-lived cache headers.
+    """
+
+    def __init__(self, directory='blobs'):
+        self.directory = directory
+        os.makedirs(directory, exist_ok=True)
+        self.stats = {'blobs_written': 0, 'bytes_written': 0, 'dedup_hits': 0, 'reads': 0}
+
+    @staticmethod
+    def is_key(key):
+        return isinstance(key, str) and len(key) == 64 and all(c in '0123456789abcdef' for c in key)
+
+    def path(self, key):
+        return os.path.join(self.directory, key[:2], key)
+
+    def put(self, data):
+        """Store bytes, returns their key"""
+        key = hashlib.sha256(data).hexdigest()
+        path = self.path(key)
+        if os.path.exists(path):
+            self.stats['dedup_hits'] += 1
+            return key
+
+        os.makedirs(os.path.dirname(path), exist_ok=True)
+        # Write-then-rename so a crash never leaves a truncated blob under a valid key
+        fd, tmp_path = tempfile.mkstemp(dir=os.path.dirname(path), suffix='.tmp')
+        try:
+            with os.fdopen(fd, 'wb') as f:
+                f.write(data)
+                f.flush()
+                os.fsync(f.fileno())
+            os.replace(tmp_path, path)
+        except BaseException:
+            if os.path.exists(tmp_path):
+                os.remove(tmp_path)
+            raise
+        self.stats['blobs_written'] += 1
+        self.stats['bytes_written'] += len(data)
+        return key
+
+    def put_base64(self, encoded):
+        """Store a base64 payload as sent by clients, returns (key, size in bytes)"""
+        try:
+            data = base64.b64decode(encoded, validate=True)
+        except (binascii.Error, ValueError) as e:
+            raise ValueError(f"file_data is not valid base64: {e}")
+        return self.put(data), len(data)
+
+    def open_path(self, key):
+        """Path of an existing blob, or None"""
+        if not self.is_key(key):
+            return None
+        path = self.path(key)
+        if not os.path.exists(path):
+            return None
+        self.stats['reads'] += 1
+        return path
+
+    def read(self, key):
+        path = self.open_path(key)
+        if path is None:
+            return None
+        with open(path, 'rb') as f:
+            return f.read()
@@ -16,6 +16,8 @@ import psycopg2
 import pytz
 import base64
 
+from blob_store import BlobStore
+
 # Database setup
 DATABASE_FILE = 'auth_bridge.db'
 JWT_SECRET = 'your-secret-key-change-in-production'  # Change this in production!
@@ -24,6 +26,11 @@ JWT_SECRET = 'your-secret-key-change-in-production'  # Change this in production
 CHAT_LOG_FILE = 'chat_log.json'
 chat_log_lock = asyncio.Lock()
 
+# Attachment bytes live in the blob store; messages rows only keep metadata + blob_key
+BLOB_DIR = os.environ.get('BLOB_DIR', 'blobs')
+BLOB_MIGRATION_BATCH = int(os.environ.get('BLOB_MIGRATION_BATCH', '50'))
+blob_store = BlobStore(BLOB_DIR)
+
 def load_chat_log():
     """Memuat data chat dari file JSON."""
     try:
@@ -122,7 +129,8 @@ def init_database():
             content TEXT,
             message_type VARCHAR(10) DEFAULT 'text',
             file_name VARCHAR(255),
-            file_data TEXT,  -- Base64 encoded file data
+            file_data TEXT,  -- Legacy base64 data, moved to the blob store on startup
+            blob_key VARCHAR(64),  -- SHA-256 of the file bytes in the blob store
             file_size INTEGER,
             mime_type VARCHAR(100),
             timestamp TIMESTAMPTZ DEFAULT CURRENT_TIMESTAMP,
@@ -141,10 +149,57 @@ def init_database():
     cursor.execute('''
         CREATE INDEX IF NOT EXISTS idx_messages_sender ON messages (sender_id);
     ''')
+
+    # Tables created before the blob store
+    cursor.execute('''
+        ALTER TABLE messages ADD COLUMN IF NOT EXISTS blob_key VARCHAR(64);
+    ''')
+    cursor.execute('''
+        CREATE INDEX IF NOT EXISTS idx_messages_blob_key ON messages (blob_key) WHERE blob_key IS NOT NULL;
+    ''')
     
     conn.commit()
     conn.close()
 
+    migrate_file_data_to_blobs()
+
+def migrate_file_data_to_blobs():
+    """Move base64 file_data of old rows into the blob store, a small batch per transaction"""
+    moved = 0
+    conn = get_db_connection()
+    try:
+        cursor = conn.cursor()
+        while True:
+            cursor.execute("""
+                SELECT message_id, file_data FROM messages
+                WHERE file_data IS NOT NULL
+                ORDER BY message_id
+                LIMIT %s
+            """, (BLOB_MIGRATION_BATCH,))
+            rows = cursor.fetchall()
+            if not rows:
+                break
+            for message_id, file_data in rows:
+                try:
+                    blob_key, size = blob_store.put_base64(file_data)
+                except ValueError as e:
+                    # Unreadable payload: keep nothing rather than re-scanning it forever
+                    print(f"⚠️ [Blob] Message {message_id}: {e}, dropping file data")
+                    blob_key, size = None, None
+                cursor.execute("""
+                    UPDATE messages SET blob_key = %s, file_size = COALESCE(%s, file_size), file_data = NULL
+                    WHERE message_id = %s
+                """, (blob_key, size, message_id))
+            conn.commit()
+            moved += len(rows)
+    finally:
+        conn.close()
+    if moved:
+        print(f"📦 [Blob] Moved file data of {moved} messages into {BLOB_DIR} (VACUUM messages to reclaim space)")
+
+def file_url(blob_key):
+    return f"/api/files/{blob_key}" if blob_key else None
+
 def verify_password(password, password_hash):
     """Verify password against hash"""
     return password == password_hash
@@ -510,17 +565,22 @@ async def save_message_to_database(user_info, message_data):
         file_data = message_data.get("file_data")  # Base64 encoded
         file_size = message_data.get("file_size")
         mime_type = message_data.get("mime_type")
+
+        # The bytes go to the blob store; the row only references them
+        blob_key = None
+        if message_type in ['image', 'file'] and file_data:
+            blob_key, file_size = blob_store.put_base64(file_data)
         
         # Insert message into database
         cursor.execute("""
             INSERT INTO messages (
                 room_id, sender_id, sender_username, recipient_id, 
-                content, message_type, file_name, file_data, file_size, mime_type
+                content, message_type, file_name, blob_key, file_size, mime_type
             ) VALUES (%s, %s, %s, %s, %s, %s, %s, %s, %s, %s)
             RETURNING message_id, timestamp
         """, (
             room_id, user_info['user_id'], user_info['username'], recipient_id,
-            content, message_type, file_name, file_data, file_size, mime_type
+            content, message_type, file_name, blob_key, file_size, mime_type
         ))
         
         result = cursor.fetchone()
@@ -541,13 +601,16 @@ async def save_message_to_database(user_info, message_data):
             "recipient_id": recipient_id
         }
         
-        # Add file info if present
+        # Add file info if present. Live delivery still carries the bytes the sender just
+        # uploaded; history only carries file_url.
         if message_type in ['image', 'file']:
             enhanced_message.update({
                 "file_name": file_name,
                 "file_data": file_data,
                 "file_size": file_size,
-                "mime_type": mime_type
+                "mime_type": mime_type,
+                "blob_key": blob_key,
+                "file_url": file_url(blob_key)
             })
         
         print(f"✅ [DB] Saved {message_type} message to database: ID {message_id}")
@@ -571,7 +634,7 @@ async def get_messages_from_database(room_id, limit=100):
         
         cursor.execute("""
             SELECT message_id, sender_id, sender_username, recipient_id, content, 
-                   message_type, file_name, file_data, file_size, mime_type, timestamp
+                   message_type, file_name, blob_key, file_size, mime_type, timestamp
             FROM messages 
             WHERE room_id = %s 
             ORDER BY timestamp ASC 
@@ -591,11 +654,12 @@ async def get_messages_from_database(room_id, limit=100):
                 "room_id": room_id
             }
             
-            # Add file data if present
+            # File metadata only; clients fetch the bytes from file_url when shown
             if row[5] in ['image', 'file']:  # message_type
                 message.update({
                     "file_name": row[6],
-                    "file_data": row[7],
+                    "blob_key": row[7],
+                    "file_url": file_url(row[7]),
                     "file_size": row[8],
                     "mime_type": row[9]
                 })
@@ -723,6 +787,44 @@ async def api_get_messages(request):
         print(f"❌ [API Get Messages] Error: {e}")
         return web.json_response({'status': 'error', 'message': 'Internal server error'}, status=500)
 
+async def api_get_file(request):
+    """Stream one attachment from the blob store to a participant of a message that references it"""
+    user_info = get_user_from_token(request)
+    if not user_info:
+        return web.json_response({'status': 'error', 'message': 'Authentication required'}, status=401)
+
+    blob_key = request.match_info.get('blob_key', '')
+    if not BlobStore.is_key(blob_key):
+        return web.json_response({'status': 'error', 'message': 'Invalid file id'}, status=400)
+
+    try:
+        conn = get_db_connection()
+        cursor = conn.cursor()
+        cursor.execute("""
+            SELECT file_name, mime_type FROM messages
+            WHERE blob_key = %s AND (sender_id = %s OR recipient_id = %s)
+            LIMIT 1
+        """, (blob_key, user_info['user_id'], str(user_info['user_id'])))
+        row = cursor.fetchone()
+        conn.close()
+    except Exception as e:
+        print(f"❌ [API Get File] Error: {e}")
+        return web.json_response({'status': 'error', 'message': 'Internal server error'}, status=500)
+
+    path = blob_store.open_path(blob_key) if row else None
+    if path is None:
+        return web.json_response({'status': 'error', 'message': 'File not found'}, status=404)
+
+    file_name, mime_type = row
+    # Streamed from disk by aiohttp; blobs never change, so clients may cache them for good
+    response = web.FileResponse(path, headers={
+        'Content-Type': mime_type or 'application/octet-stream',
+        'Content-Disposition': f'inline; filename="{(file_name or blob_key).replace(chr(34), "")}"',
+        'Cache-Control': 'private, max-age=31536000, immutable',
+        'ETag': f'"{blob_key}"'
+    })
+    return response
+
 async def api_send_authenticated_message(request):
     """HTTP endpoint untuk mengirim message dengan authentication"""
     user_info = get_user_from_token(request)
@@ -1848,7 +1950,7 @@ async def api_get_stats(request):
     
     response_data = {
         "status": "success",
-        "stats": auth_bridge.stats,
+        "stats": dict(auth_bridge.stats, blobs=blob_store.stats),
         "timestamp": time.time()
     }
     
@@ -1913,6 +2015,7 @@ async def create_app():
     # NEW: Chat messaging routes
     app.router.add_post('/api/chat/send', api_send_message)
     app.router.add_get('/api/chat/messages/{room_id}', api_get_messages)
+    app.router.add_get('/api/files/{blob_key}', api_get_file)
     
     # Web interface
     #app.router.add_get('/', serve_auth_interface)
@@ -2005,6 +2108,7 @@ def main():
         print("📊 Stats: GET https://localhost:8443/api/stats")
         print("💬 Send Chat: POST https://localhost:8443/api/chat/send")
         print("📜 Get Messages: GET https://localhost:8443/api/chat/messages/{room_id}")
+        print("📎 Files: GET https://localhost:8443/api/files/{blob_key}")
         print("📎 Supports: Text, Images, and Files via WebSocket & Database")
         print("⚠️  Note: Accept self-signed certificate warning in browser")
         print("🛑 Press Ctrl+C to stop\n")
@@ -0,0 +1,294 @@
+"""Cold tier for old history: compressed, immutable archive segments behind the hot message store."""
+
+import json
+import os
+import threading
+import zlib
+from collections import OrderedDict
+from datetime import datetime, timedelta, timezone
+
+from message_store import MessageStore, encode_record
+
+
+class ColdArchive:
+    """Append-only archive files holding zlib-compressed blocks of encoded records.
+
+    A block is one run of consecutive messages of one room, stored as "<message_id>\t<record>"
+    lines; it is written once and never rewritten. The index has one entry per block:
+    {room_id: [[first_id, last_id, count, segment, offset, length], ...]} in id order.
+    """
+
+    def __init__(self, directory='chat_archive', segment_max_bytes=64 * 1024 * 1024, cached_blocks=32):
+        self.directory = directory
+        self.segment_max_bytes = segment_max_bytes
+        os.makedirs(directory, exist_ok=True)
+        self._lock = threading.Lock()
+        self._index_path = os.path.join(directory, 'archive_index.json')
+        self._index = self._load_index()
+        self._active = max((block[3] for blocks in self._index.values() for block in blocks), default=1)
+        self._file = open(self._segment_path(self._active), 'ab')
+        self._blocks = OrderedDict()  # (segment, offset) -> [(message_id, fragment)], decompressed LRU
+        self._cached_blocks = cached_blocks
+        self.stats = {
+            'rooms': len(self._index),
+            'blocks': sum(len(blocks) for blocks in self._index.values()),
+            'messages': sum(block[2] for blocks in self._index.values() for block in blocks),
+            'bytes_compressed': sum(block[5] for blocks in self._index.values() for block in blocks),
+            'block_reads': 0
+        }
+
+    def _segment_path(self, number):
+        return os.path.join(self.directory, f"archive-{number:06d}.z")
+
+    def _load_index(self):
+        try:
+            with open(self._index_path, 'r') as f:
+                return json.load(f)
+        except (FileNotFoundError, json.JSONDecodeError):
+            return {}
+
+    def _save_index(self):
+        tmp_path = f"{self._index_path}.tmp"
+        with open(tmp_path, 'w') as f:
+            json.dump(self._index, f)
+            f.flush()
+            os.fsync(f.fileno())
+        os.replace(tmp_path, self._index_path)
+
+    def last_id(self, room_id):
+        """Highest archived message_id of a room (0 if none)"""
+        with self._lock:
+            blocks = self._index.get(str(room_id))
+            return blocks[-1][1] if blocks else 0
+
+    def has_room(self, room_id):
+        return str(room_id) in self._index
+
+    def room_ids(self):
+        with self._lock:
+            return list(self._index)
+
+    def append(self, room_id, messages):
+        """Archive one block (messages in id order); ids already archived are skipped, so a
+        crash between archiving and trimming the hot store never duplicates history"""
+        room_id = str(room_id)
+        with self._lock:
+            blocks = self._index.setdefault(room_id, [])
+            archived_through = blocks[-1][1] if blocks else 0
+            messages = [m for m in messages if m['message_id'] > archived_through]
+            if not messages:
+                if not blocks:
+                    del self._index[room_id]
+                return 0
+
+            if self._file.tell() >= self.segment_max_bytes:
+                self._file.close()
+                self._active += 1
+                self._file = open(self._segment_path(self._active), 'ab')
+            lines = '\n'.join(f"{m['message_id']}\t{encode_record(m)}" for m in messages)
+            payload = zlib.compress(lines.encode('utf-8'), 9)
+            offset = self._file.tell()
+            self._file.write(payload)
+            self._file.flush()
+            os.fsync(self._file.fileno())
+
+            blocks.append([messages[0]['message_id'], messages[-1]['message_id'], len(messages),
+                           self._active, offset, len(payload)])
+            self._save_index()
+            self.stats['rooms'] = len(self._index)
+            self.stats['blocks'] += 1
+            self.stats['messages'] += len(messages)
+            self.stats['bytes_compressed'] += len(payload)
+            return len(messages)
+
+    def _read_block(self, block):
+        key = (block[3], block[4])
+        fragments = self._blocks.get(key)
+        if fragments is not None:
+            self._blocks.move_to_end(key)
+            return fragments
+        with open(self._segment_path(block[3]), 'rb') as f:
+            f.seek(block[4])
+            payload = f.read(block[5])
+        fragments = []
+        for line in zlib.decompress(payload).decode('utf-8').split('\n'):
+            message_id, _, fragment = line.partition('\t')
+            fragments.append((int(message_id), fragment))
+        self.stats['block_reads'] += 1
+        self._blocks[key] = fragments
+        while len(self._blocks) > self._cached_blocks:
+            self._blocks.popitem(last=False)
+        return fragments
+
+    def get_room_fragments(self, room_id, limit=None, before_id=None):
+        """[(message_id, fragment)] newest-first block walk, returned in chronological order"""
+        with self._lock:
+            blocks = list(self._index.get(str(room_id), ()))
+        page = []
+        for block in reversed(blocks):
+            if before_id is not None and block[0] >= before_id:
+                continue
+            with self._lock:
+                fragments = self._read_block(block)
+            for message_id, fragment in reversed(fragments):
+                if before_id is not None and message_id >= before_id:
+                    continue
+                page.append((message_id, fragment))
+                if limit is not None and len(page) >= limit:
+                    return page[::-1]
+        return page[::-1]
+
+    def get_room_messages(self, room_id, limit=None, before_id=None):
+        return [json.loads(fragment) for _, fragment in self.get_room_fragments(room_id, limit, before_id)]
+
+    def iter_room(self, room_id):
+        """Archived messages of a room in chronological order, one block in memory at a time"""
+        with self._lock:
+            blocks = list(self._index.get(str(room_id), ()))
+        for block in blocks:
+            with self._lock:
+                fragments = self._read_block(block)
+            for _, fragment in fragments:
+                yield json.loads(fragment)
+
+    def close(self):
+        with self._lock:
+            self._file.close()
+
+
+def _older_than(message, cutoff):
+    try:
+        timestamp = datetime.fromisoformat(str(message.get('timestamp')).replace('Z', '+00:00'))
+    except ValueError:
+        return False
+    if timestamp.tzinfo is None:
+        timestamp = timestamp.replace(tzinfo=timezone.utc)
+    return timestamp < cutoff
+
+
+class TieredMessageStore(MessageStore):
+    """Hot store for recent history, ColdArchive for the rest.
+
+    Writes and latest pages go to the hot store; a page that runs past the oldest hot
+    message is completed from the archive, so paging back is transparent to clients.
+    """
+
+    def __init__(self, hot, archive):
+        self.hot = hot
+        self.archive = archive
+        self.name = f"{hot.name}+archive"
+        self.stats = archive.stats
+        self.stats.update({'archive_runs': 0, 'archived_last_run': 0, 'archive_fallthroughs': 0})
+
+    def save_many(self, records):
+        return self.hot.save_many(records)
+
+    def _complete(self, room_id, page, limit, before_id, read_archive):
+        """Prepend archived records when the hot page is short"""
+        if (limit is not None and len(page) >= limit) or not self.archive.has_room(room_id):
+            return page
+        older_than = page[0][0] if page else before_id
+        older = read_archive(room_id, None if limit is None else limit - len(page), older_than)
+        if older:
+            self.stats['archive_fallthroughs'] += 1
+        return older + page
+
+    def get_room_fragments(self, room_id, limit=None, before_id=None):
+        page = self.hot.get_room_fragments(room_id, limit=limit, before_id=before_id)
+        return self._complete(str(room_id), page, limit, before_id, self.archive.get_room_fragments)
+
+    def get_room_messages(self, room_id, limit=None, before_id=None):
+        page = [(m['message_id'], m) for m in self.hot.get_room_messages(room_id, limit=limit, before_id=before_id)]
+        read_archive = lambda *args: [(m['message_id'], m) for m in self.archive.get_room_messages(*args)]
+        return [m for _, m in self._complete(str(room_id), page, limit, before_id, read_archive)]
+
+    def get_conversations(self, room_ids, limit_per_room=None):
+        conversations = self.hot.get_conversations(room_ids, limit_per_room=limit_per_room)
+        for room_id in map(str, room_ids):
+            messages = conversations.get(room_id, [])
+            if self.archive.has_room(room_id) and (limit_per_room is None or len(messages) < limit_per_room):
+                messages = self.get_room_messages(room_id, limit=limit_per_room)
+                if messages:
+                    conversations[room_id] = messages
+        return conversations
+
+    def get_conversation_fragments(self, room_ids, limit_per_room=None):
+        conversations = self.hot.get_conversation_fragments(room_ids, limit_per_room=limit_per_room)
+        for room_id in map(str, room_ids):
+            fragments = conversations.get(room_id, [])
+            if self.archive.has_room(room_id) and (limit_per_room is None or len(fragments) < limit_per_room):
+                fragments = [fragment for _, fragment in self.get_room_fragments(room_id, limit=limit_per_room)]
+                if fragments:
+                    conversations[room_id] = fragments
+        return conversations
+
+    def archive_old(self, keep_recent=200, max_age_seconds=30 * 86400, max_hot=5000, block_size=500):
+        """Move old history of every room to the archive; returns the number of messages moved.
+
+        The newest `keep_recent` messages of a room always stay hot. Older ones move when they
+        are older than `max_age_seconds` or when the room holds more than `max_hot` messages.
+        """
+        keep_recent = max(keep_recent, 1)
+        cutoff = datetime.now(timezone.utc) - timedelta(seconds=max_age_seconds)
+        moved = 0
+        for room_id in self.hot.list_rooms():
+            total = self.hot.count_room(room_id)
+            eligible = total - keep_recent
+            if eligible <= 0:
+                continue
+            forced = min(max(total - max_hot, 0), eligible)
+            # Stream the oldest messages a block at a time; stop at the first one that stays hot
+            block, count, archived_through = [], 0, None
+            for message in self.hot.iter_room(room_id, block_size):
+                if count >= eligible or (count >= forced and not _older_than(message, cutoff)):
+                    break
+                block.append(message)
+                count += 1
+                if len(block) == block_size:
+                    moved += self.archive.append(room_id, block)
+                    archived_through, block = block[-1]['message_id'], []
+            if block:
+                moved += self.archive.append(room_id, block)
+                archived_through = block[-1]['message_id']
+            if archived_through is None:
+                continue
+            # Only after the archive blocks are durable
+            self.hot.delete_through(room_id, archived_through)
+        self.stats['archive_runs'] += 1
+        self.stats['archived_last_run'] = moved
+        return moved
+
+    def list_rooms(self):
+        rooms = self.hot.list_rooms()
+        known = set(rooms)
+        return rooms + [room_id for room_id in self.archive.room_ids() if room_id not in known]
+
+    def iter_room(self, room_id, batch_size=1000):
+        archived_through = 0
+        for message in self.archive.iter_room(room_id):
+            archived_through = message['message_id']
+            yield message
+        for message in self.hot.iter_room(room_id, batch_size):
+            if message['message_id'] > archived_through:
+                yield message
+
+    def delete_through(self, room_id, message_id):
+        return self.hot.delete_through(room_id, message_id)
+
+    def find_by_client_msg_id(self, sender_id, client_msg_id):
+        # Retried sends are recent, never archived
+        return self.hot.find_by_client_msg_id(sender_id, client_msg_id)
+
+    def load_read_cursors(self, user_id):
+        return self.hot.load_read_cursors(user_id)
+
+    def save_read_cursors(self, cursors):
+        return self.hot.save_read_cursors(cursors)
+
+    def count_unread(self, user_id, cursors):
+        # Archived history is older than any realistic read cursor; only hot messages count
+        return self.hot.count_unread(user_id, cursors)
+
+    def close(self):
+        self.hot.close()
+        self.archive.close()
@@ -0,0 +1,103 @@
+"""Per-user inbox index: last message + unread count per room, updated in O(1) per message."""
+
+import threading
+from collections import OrderedDict
+
+
+class InboxIndex:
+    """In-memory inbox for each user: {room_id: entry}.
+
+    Entries are built once from storage (load_user) and afterwards kept current by
+    record_message(), which touches one entry per room member.
+    """
+
+    def __init__(self, preview_length=80, max_users=10000):
+        self.preview_length = preview_length
+        self.max_users = max_users
+        self._inboxes = OrderedDict()  # user_id -> {room_id: entry}, LRU by last access
+        self._lock = threading.Lock()
+
+    def _preview(self, message):
+        if message.get('type', 'text') in ('image', 'file'):
+            return f"[{message.get('type')}] {message.get('filename') or ''}".strip()
+        content = message.get('content') or ''
+        return content[:self.preview_length]
+
+    def _touch(self, user_id):
+        self._inboxes.move_to_end(user_id)
+        while len(self._inboxes) > self.max_users:
+            self._inboxes.popitem(last=False)
+
+    def is_loaded(self, user_id):
+        return user_id in self._inboxes
+
+    def make_entry(self, room_id, peer_id, peer_username, last_message=None, unread_count=0):
+        entry = {
+            'room_id': str(room_id),
+            'peer_id': peer_id,
+            'peer_username': peer_username,
+            'last_message': None,
+            'last_sender_id': None,
+            'last_timestamp': None,
+            'last_message_id': None,
+            'unread_count': unread_count
+        }
+        if last_message:
+            self._apply_message(entry, last_message)
+        return entry
+
+    def _apply_message(self, entry, message):
+        entry['last_message'] = self._preview(message)
+        entry['last_sender_id'] = message.get('sender_id')
+        entry['last_timestamp'] = message.get('timestamp')
+        entry['last_message_id'] = message.get('message_id')
+
+    def load_user(self, user_id, entries):
+        """Install a freshly built inbox for a user (list of make_entry() dicts)"""
+        with self._lock:
+            self._inboxes[user_id] = {entry['room_id']: entry for entry in entries}
+            self._touch(user_id)
+
+    def record_message(self, room_id, message, members):
+        """Update every loaded member's entry for this room.
+
+        members: {user_id: username}. Unread counts go up for everyone but the sender.
+        """
+        room_id = str(room_id)
+        sender_id = message.get('sender_id')
+        with self._lock:
+            for user_id in members:
+                inbox = self._inboxes.get(user_id)
+                if inbox is None:
+                    continue  # not loaded: it is rebuilt from storage on next access
+                entry = inbox.get(room_id)
+                if entry is None:
+                    # Only 1-on-1 rooms have a peer; skip the scan for group rooms
+                    peers = [(uid, name) for uid, name in members.items() if uid != user_id] if len(members) == 2 else []
+                    peer_id, peer_username = peers[0] if len(peers) == 1 else (None, None)
+                    entry = inbox[room_id] = self.make_entry(room_id, peer_id, peer_username)
+                self._apply_message(entry, message)
+                if user_id != sender_id:
+                    entry['unread_count'] += 1
+
+    def mark_read(self, user_id, room_id, unread_count=0):
+        """Set a room's unread counter (0 = fully read)"""
+        with self._lock:
+            entry = self._inboxes.get(user_id, {}).get(str(room_id))
+            if entry is not None:
+                entry['unread_count'] = unread_count
+
+    def get_inbox(self, user_id):
+        """Inbox entries, most recent first"""
+        with self._lock:
+            inbox = self._inboxes.get(user_id)
+            if inbox is None:
+                return None
+            self._touch(user_id)
+            entries = [dict(entry) for entry in inbox.values()]
+        entries.sort(key=lambda e: (e['last_message_id'] or 0), reverse=True)
+        return entries
+
+    def forget_user(self, user_id):
+        with self._lock:
+            self._inboxes.pop(user_id, None)
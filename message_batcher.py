@@ -0,0 +1,90 @@
+"""Group-commit (write-behind) batcher untuk penyimpanan pesan."""
+
+import asyncio
+import time
+
+
+class MessageWriteBatcher:
+    """Collects records for a short window (or until max_batch) and persists them together.
+
+    ``persist_fn`` is a blocking callable that receives a list of records and
+    returns a list of saved records in the same order (or None to echo the input).
+    It runs in the default executor so the event loop keeps serving sockets.
+    Each ``submit()`` resolves only after the batch containing it is durable.
+    """
+
+    def __init__(self, persist_fn, window_ms=5, max_batch=100):
+        self.persist_fn = persist_fn
+        self.window = max(window_ms, 0) / 1000.0
+        self.max_batch = max(max_batch, 1)
+        self._pending = []  # [(record, future)]
+        self._timer = None
+        self._flush_task = None
+        self.stats = {
+            'batches': 0,
+            'records': 0,
+            'max_batch_size': 0,
+            'avg_batch_size': 0.0,
+            'last_flush_ms': 0.0,
+            'errors': 0
+        }
+
+    async def submit(self, record):
+        """Queue a record and wait until it has been persisted"""
+        loop = asyncio.get_running_loop()
+        future = loop.create_future()
+        self._pending.append((record, future))
+
+        if len(self._pending) >= self.max_batch or self.window == 0:
+            self._start_flush()
+        elif self._timer is None:
+            self._timer = loop.call_later(self.window, self._start_flush)
+
+        return await future
+
+    def _start_flush(self):
+        if self._timer is not None:
+            self._timer.cancel()
+            self._timer = None
+        if self._flush_task is None or self._flush_task.done():
+            self._flush_task = asyncio.ensure_future(self._flush_loop())
+
+    async def _flush_loop(self):
+        """Persist batches back-to-back; records that arrive during a flush join the next one"""
+        loop = asyncio.get_running_loop()
+        while self._pending:
+            batch = self._pending[:self.max_batch]
+            del self._pending[:len(batch)]
+            records = [record for record, _ in batch]
+
+            started = time.perf_counter()
+            try:
+                saved = await loop.run_in_executor(None, self.persist_fn, records)
+            except Exception as e:
+                self.stats['errors'] += 1
+                print(f"❌ [Batcher] Failed to persist batch of {len(records)}: {e}")
+                for _, future in batch:
+                    if not future.done():
+                        future.set_exception(e)
+                continue
+
+            if saved is None:
+                saved = records
+            self._record_stats(len(records), (time.perf_counter() - started) * 1000)
+            for (_, future), result in zip(batch, saved):
+                if not future.done():
+                    future.set_result(result)
+
+    def _record_stats(self, size, elapsed_ms):
+        self.stats['batches'] += 1
+        self.stats['records'] += size
+        self.stats['max_batch_size'] = max(self.stats['max_batch_size'], size)
+        self.stats['avg_batch_size'] = round(self.stats['records'] / self.stats['batches'], 2)
+        self.stats['last_flush_ms'] = round(elapsed_ms, 2)
+
+    async def flush(self):
+        """Persist everything still pending (used on shutdown)"""
+        if self._pending:
+            self._start_flush()
+        if self._flush_task is not None:
+            await self._flush_task
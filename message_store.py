@@ -0,0 +1,1204 @@
+"""Pluggable message storage: JSON (chat_log.json compatible), SQLite (WAL), pooled PostgreSQL and mmap segments."""
+
+import bisect
+import json
+import mmap
+import os
+import re
+import sqlite3
+import struct
+import threading
+import time
+from array import array
+from collections import OrderedDict, deque
+
+
+def _message_to_row(room_id, message):
+    """Map a chat message dict onto the shared `messages` table columns"""
+    recipient_id = message.get('recipient_id')
+    return (
+        str(room_id),
+        message.get('sender_id'),
+        message.get('sender_username'),
+        str(recipient_id) if recipient_id is not None else None,
+        message.get('content'),
+        message.get('type', 'text'),
+        message.get('filename'),
+        message.get('timestamp'),
+        message.get('seq'),
+        message.get('client_msg_id'),
+    )
+
+
+def _row_to_message(row):
+    """Inverse of _message_to_row; row = (message_id, room_id, sender_id, sender_username,
+    recipient_id, content, message_type, file_name, timestamp, seq, client_msg_id)"""
+    (message_id, room_id, sender_id, sender_username, recipient_id, content,
+     message_type, file_name, timestamp, seq, client_msg_id) = row
+    if isinstance(recipient_id, str) and recipient_id.isdigit():
+        recipient_id = int(recipient_id)
+    return {
+        "message_id": message_id,
+        "sender_id": sender_id,
+        "sender_username": sender_username,
+        "timestamp": timestamp.isoformat() if hasattr(timestamp, 'isoformat') else timestamp,
+        "type": message_type,
+        "content": content,
+        "filename": file_name,
+        "room_id": room_id,
+        "recipient_id": recipient_id,
+        "seq": seq,
+        "client_msg_id": client_msg_id
+    }
+
+
+def encode_record(message):
+    """Canonical wire encoding of a stored message (compact JSON), produced once per record"""
+    return json.dumps(message, separators=(',', ':'), default=str)
+
+
+def _room_counts(records):
+    """{room_id: number of records} in sorted room order (stable lock order for sequence rows)"""
+    counts = {}
+    for room_id, _ in records:
+        counts[str(room_id)] = counts.get(str(room_id), 0) + 1
+    return dict(sorted(counts.items()))
+
+
+def _assign_seqs(records, last_seqs):
+    """Give each record the next per-room seq; last_seqs = {room_id: seq after this batch}"""
+    next_seqs = {room_id: last_seq - sum(1 for r, _ in records if str(r) == room_id) + 1
+                 for room_id, last_seq in last_seqs.items()}
+    assigned = []
+    for room_id, message in records:
+        seq = next_seqs[str(room_id)]
+        next_seqs[str(room_id)] = seq + 1
+        assigned.append((room_id, {**message, 'seq': seq}))
+    return assigned
+
+
+class MessageStore:
+    """Interface for chat message storage backends.
+
+    Records passed to save_many() are (room_id, message) tuples; backends assign
+    `message_id` (global) and `seq` (gapless per room) and return the saved
+    messages in the same order.
+    """
+
+    name = 'base'
+
+    def save_many(self, records):
+        raise NotImplementedError
+
+    def get_room_messages(self, room_id, limit=None, before_id=None):
+        """Messages of one room in chronological order (the newest `limit` ones before `before_id`)"""
+        raise NotImplementedError
+
+    def get_conversations(self, room_ids, limit_per_room=None):
+        """{room_id: [messages]} for several rooms in one call; rooms without messages are omitted"""
+        raise NotImplementedError
+
+    def get_room_fragments(self, room_id, limit=None, before_id=None):
+        """Like get_room_messages, but [(message_id, encoded record)] ready to splice into a response"""
+        return [(m.get('message_id'), encode_record(m))
+                for m in self.get_room_messages(room_id, limit=limit, before_id=before_id)]
+
+    def get_conversation_fragments(self, room_ids, limit_per_room=None):
+        """Like get_conversations, but {room_id: [encoded record]}"""
+        return {room_id: [encode_record(m) for m in messages]
+                for room_id, messages in self.get_conversations(room_ids, limit_per_room=limit_per_room).items()}
+
+    def list_rooms(self):
+        """Every room id that has messages in this store"""
+        raise NotImplementedError
+
+    def count_room(self, room_id):
+        """Number of messages stored for a room"""
+        return sum(1 for _ in self.iter_room(room_id))
+
+    def iter_room(self, room_id, batch_size=1000):
+        """All messages of a room in chronological order; backends on disk read in batches"""
+        yield from self.get_room_messages(room_id)
+
+    def find_by_client_msg_id(self, sender_id, client_msg_id):
+        """The stored message a sender sent with this client_msg_id, or None (send retries after a restart)"""
+        return None
+
+    def delete_through(self, room_id, message_id):
+        """Remove a room's messages with id <= message_id (after they were archived elsewhere)"""
+        raise NotImplementedError
+
+    def load_read_cursors(self, user_id):
+        """{room_id: last_read_message_id} for one user"""
+        raise NotImplementedError
+
+    def save_read_cursors(self, cursors):
+        """Upsert [(user_id, room_id, last_read_message_id), ...] in one go"""
+        raise NotImplementedError
+
+    def count_unread(self, user_id, cursors):
+        """{room_id: unread} for messages from others after each cursor ({room_id: last_read_id})"""
+        raise NotImplementedError
+
+    def close(self):
+        pass
+
+
+class JsonMessageStore(MessageStore):
+    """chat_log.json compatible store: {"conversations": {room_id: [messages]}} kept in memory"""
+
+    name = 'json'
+
+    def __init__(self, path='chat_log.json'):
+        self.path = path
+        self._lock = threading.Lock()
+        self._data = self._load()
+        self._conversations = self._data.setdefault("conversations", {})
+        # Cursors change every few seconds; they live in their own small file, not in the log
+        self.cursors_path = f"{os.path.splitext(path)[0]}.read_cursors.json"
+        self._read_cursors = self._load_cursors()  # {user_id: {room_id: last_read_id}}
+        self._next_id = self._assign_missing_ids()
+        self._room_seqs = self._assign_missing_seqs()
+        self._client_ids = {
+            (m.get('sender_id'), m['client_msg_id']): m
+            for messages in self._conversations.values() for m in messages if m.get('client_msg_id')
+        }
+
+    def _load(self):
+        try:
+            with open(self.path, 'r') as f:
+                return json.load(f)
+        except (FileNotFoundError, json.JSONDecodeError):
+            # Jika file tidak ada atau rusak, kembalikan struktur default
+            return {"conversations": {}}
+
+    def _load_cursors(self):
+        try:
+            with open(self.cursors_path, 'r') as f:
+                cursors = json.load(f)
+        except (FileNotFoundError, json.JSONDecodeError):
+            cursors = {}
+        # Older logs kept the cursors inline; move them out (the log drops them on its next save)
+        legacy = self._data.pop("read_cursors", None)
+        if legacy:
+            for user_id, rooms in legacy.items():
+                user_cursors = cursors.setdefault(user_id, {})
+                for room_id, last_read_id in rooms.items():
+                    user_cursors[room_id] = max(user_cursors.get(room_id, 0), last_read_id)
+            self._save_cursors(cursors)
+        return cursors
+
+    def _save_cursors(self, cursors):
+        tmp_path = f"{self.cursors_path}.tmp"
+        with open(tmp_path, 'w') as f:
+            json.dump(cursors, f, separators=(',', ':'))
+            f.flush()
+            os.fsync(f.fileno())
+        os.replace(tmp_path, self.cursors_path)
+
+    def _assign_missing_ids(self):
+        """Older logs have no message ids; number them once so paging by id works"""
+        max_id = 0
+        for messages in self._conversations.values():
+            for message in messages:
+                max_id = max(max_id, message.get('message_id') or 0)
+        for messages in self._conversations.values():
+            for message in messages:
+                if not message.get('message_id'):
+                    max_id += 1
+                    message['message_id'] = max_id
+        return max_id + 1
+
+    def _assign_missing_seqs(self):
+        """Number older messages per room (log order) and return {room_id: last seq}"""
+        room_seqs = {}
+        archived = self._data.get("archived_seqs", {})
+        for room_id, messages in self._conversations.items():
+            seq = archived.get(room_id, 0)
+            for message in messages:
+                seq = message['seq'] if message.get('seq') else seq + 1
+                message['seq'] = seq
+            room_seqs[room_id] = seq
+        return room_seqs
+
+    def _save(self):
+        """Atomic replace + fsync so a crash never leaves a half-written log"""
+        tmp_path = f"{self.path}.tmp"
+        with open(tmp_path, 'w') as f:
+            json.dump(self._data, f, indent=4)
+            f.flush()
+            os.fsync(f.fileno())
+        os.replace(tmp_path, self.path)
+
+    def save_many(self, records):
+        with self._lock:
+            saved = []
+            for room_id, message in records:
+                seq = self._room_seqs.get(str(room_id), 0) + 1
+                self._room_seqs[str(room_id)] = seq
+                message = {**message, 'message_id': self._next_id, 'seq': seq}
+                self._next_id += 1
+                self._conversations.setdefault(str(room_id), []).append(message)
+                if message.get('client_msg_id'):
+                    self._client_ids[(message.get('sender_id'), message['client_msg_id'])] = message
+                saved.append(message)
+            self._save()
+        return saved
+
+    def find_by_client_msg_id(self, sender_id, client_msg_id):
+        with self._lock:
+            message = self._client_ids.get((sender_id, client_msg_id))
+            return dict(message) if message is not None else None
+
+    def get_room_messages(self, room_id, limit=None, before_id=None):
+        with self._lock:
+            messages = self._conversations.get(str(room_id), [])
+            if before_id is not None:
+                messages = [m for m in messages if m.get('message_id', 0) < before_id]
+            if limit is not None:
+                messages = messages[-limit:] if limit > 0 else []
+            return [dict(m) for m in messages]
+
+    def get_conversations(self, room_ids, limit_per_room=None):
+        conversations = {}
+        for room_id in room_ids:
+            messages = self.get_room_messages(room_id, limit=limit_per_room)
+            if messages:
+                conversations[str(room_id)] = messages
+        return conversations
+
+    def list_rooms(self):
+        with self._lock:
+            return [room_id for room_id, messages in self._conversations.items() if messages]
+
+    def count_room(self, room_id):
+        with self._lock:
+            return len(self._conversations.get(str(room_id), []))
+
+    def delete_through(self, room_id, message_id):
+        with self._lock:
+            messages = self._conversations.get(str(room_id), [])
+            removed = [m for m in messages if m.get('message_id', 0) <= message_id]
+            if not removed:
+                return 0
+            self._conversations[str(room_id)] = [m for m in messages if m.get('message_id', 0) > message_id]
+            for m in removed:
+                if m.get('client_msg_id'):
+                    self._client_ids.pop((m.get('sender_id'), m['client_msg_id']), None)
+            # Seqs continue after the removed range even if the room is reloaded empty
+            archived = self._data.setdefault("archived_seqs", {})
+            archived[str(room_id)] = max(archived.get(str(room_id), 0), max(m.get('seq', 0) for m in removed))
+            self._save()
+            return len(removed)
+
+    def load_read_cursors(self, user_id):
+        with self._lock:
+            return dict(self._read_cursors.get(str(user_id), {}))
+
+    def save_read_cursors(self, cursors):
+        with self._lock:
+            for user_id, room_id, last_read_id in cursors:
+                self._read_cursors.setdefault(str(user_id), {})[str(room_id)] = last_read_id
+            self._save_cursors(self._read_cursors)
+
+    def count_unread(self, user_id, cursors):
+        unread = {}
+        with self._lock:
+            for room_id, last_read_id in cursors.items():
+                unread[str(room_id)] = sum(
+                    1 for m in self._conversations.get(str(room_id), [])
+                    if m.get('message_id', 0) > last_read_id and m.get('sender_id') != user_id
+                )
+        return unread
+
+
+MESSAGES_COLUMNS = ("message_id, room_id, sender_id, sender_username, recipient_id, content, "
+                    "message_type, file_name, timestamp, seq, client_msg_id")
+
+
+class SqliteMessageStore(MessageStore):
+    """Embedded SQLite store in WAL mode (single node / offline benchmarks)"""
+
+    name = 'sqlite'
+
+    def __init__(self, path='chat_messages.db'):
+        self.path = path
+        self._lock = threading.Lock()
+        self.conn = sqlite3.connect(path, check_same_thread=False)
+        self.conn.execute("PRAGMA journal_mode=WAL")
+        self.conn.execute("PRAGMA synchronous=NORMAL")
+        self._init_schema()
+
+    def _init_schema(self):
+        with self._lock:
+            self.conn.execute('''
+                CREATE TABLE IF NOT EXISTS messages (
+                    message_id INTEGER PRIMARY KEY AUTOINCREMENT,
+                    room_id TEXT NOT NULL,
+                    sender_id INTEGER NOT NULL,
+                    sender_username TEXT NOT NULL,
+                    recipient_id TEXT,
+                    content TEXT,
+                    message_type TEXT DEFAULT 'text',
+                    file_name TEXT,
+                    timestamp TEXT,
+                    seq INTEGER,
+                    client_msg_id TEXT
+                )
+            ''')
+            columns = {row[1] for row in self.conn.execute("PRAGMA table_info(messages)")}
+            for column, column_type in (('seq', 'INTEGER'), ('client_msg_id', 'TEXT')):
+                if column not in columns:
+                    self.conn.execute(f"ALTER TABLE messages ADD COLUMN {column} {column_type}")
+            self.conn.execute("CREATE INDEX IF NOT EXISTS idx_messages_room_id ON messages (room_id, message_id)")
+            self.conn.execute("CREATE INDEX IF NOT EXISTS idx_messages_client_msg_id ON messages (sender_id, client_msg_id) "
+                              "WHERE client_msg_id IS NOT NULL")
+            self.conn.execute('''
+                CREATE TABLE IF NOT EXISTS room_sequences (
+                    room_id TEXT PRIMARY KEY,
+                    last_seq INTEGER NOT NULL
+                )
+            ''')
+            self.conn.execute('''
+                CREATE TABLE IF NOT EXISTS read_cursors (
+                    user_id INTEGER NOT NULL,
+                    room_id TEXT NOT NULL,
+                    last_read_id INTEGER NOT NULL,
+                    PRIMARY KEY (user_id, room_id)
+                )
+            ''')
+            self.conn.commit()
+
+    def save_many(self, records):
+        saved = []
+        with self._lock:
+            cursor = self.conn.cursor()
+            cursor.execute("BEGIN IMMEDIATE")
+            try:
+                last_seqs = {}
+                for room_id, count in _room_counts(records).items():
+                    row = cursor.execute("SELECT last_seq FROM room_sequences WHERE room_id = ?", (room_id,)).fetchone()
+                    if row is None:
+                        # First batch for this room since sequences existed: continue after older rows
+                        row = cursor.execute(
+                            "SELECT COALESCE(MAX(seq), 0) FROM messages WHERE room_id = ?", (room_id,)
+                        ).fetchone()
+                    last_seqs[room_id] = row[0] + count
+                    cursor.execute(
+                        "INSERT INTO room_sequences (room_id, last_seq) VALUES (?, ?) "
+                        "ON CONFLICT (room_id) DO UPDATE SET last_seq = excluded.last_seq",
+                        (room_id, last_seqs[room_id])
+                    )
+                records = _assign_seqs(records, last_seqs)
+                for room_id, message in records:
+                    cursor.execute(
+                        "INSERT INTO messages (room_id, sender_id, sender_username, recipient_id, content, "
+                        "message_type, file_name, timestamp, seq, client_msg_id) VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?, ?)",
+                        _message_to_row(room_id, message)
+                    )
+                    saved.append({**message, 'message_id': cursor.lastrowid})
+                self.conn.commit()
+            except Exception:
+                self.conn.rollback()
+                raise
+        return saved
+
+    def get_room_messages(self, room_id, limit=None, before_id=None):
+        query = f"SELECT {MESSAGES_COLUMNS} FROM messages WHERE room_id = ?"
+        params = [str(room_id)]
+        if before_id is not None:
+            query += " AND message_id < ?"
+            params.append(before_id)
+        query += " ORDER BY message_id DESC"
+        if limit is not None:
+            query += " LIMIT ?"
+            params.append(limit)
+        with self._lock:
+            rows = self.conn.execute(query, params).fetchall()
+        return [_row_to_message(row) for row in reversed(rows)]
+
+    def get_conversations(self, room_ids, limit_per_room=None):
+        room_ids = [str(room_id) for room_id in room_ids]
+        if not room_ids:
+            return {}
+        placeholders = ",".join("?" for _ in room_ids)
+        query = f"""
+            SELECT {MESSAGES_COLUMNS} FROM (
+                SELECT *, ROW_NUMBER() OVER (PARTITION BY room_id ORDER BY message_id DESC) AS rn
+                FROM messages WHERE room_id IN ({placeholders})
+            ) WHERE (? IS NULL OR rn <= ?)
+            ORDER BY room_id, message_id
+        """
+        with self._lock:
+            rows = self.conn.execute(query, [*room_ids, limit_per_room, limit_per_room]).fetchall()
+        conversations = {}
+        for row in rows:
+            conversations.setdefault(row[1], []).append(_row_to_message(row))
+        return conversations
+
+    def iter_room(self, room_id, batch_size=1000):
+        last_id = 0
+        while True:
+            with self._lock:
+                rows = self.conn.execute(
+                    f"SELECT {MESSAGES_COLUMNS} FROM messages WHERE room_id = ? AND message_id > ? "
+                    "ORDER BY message_id LIMIT ?", (str(room_id), last_id, batch_size)
+                ).fetchall()
+            if not rows:
+                return
+            for row in rows:
+                yield _row_to_message(row)
+            last_id = rows[-1][0]
+
+    def list_rooms(self):
+        with self._lock:
+            return [row[0] for row in self.conn.execute("SELECT DISTINCT room_id FROM messages")]
+
+    def count_room(self, room_id):
+        with self._lock:
+            return self.conn.execute("SELECT COUNT(*) FROM messages WHERE room_id = ?", (str(room_id),)).fetchone()[0]
+
+    def find_by_client_msg_id(self, sender_id, client_msg_id):
+        with self._lock:
+            row = self.conn.execute(
+                f"SELECT {MESSAGES_COLUMNS} FROM messages WHERE sender_id = ? AND client_msg_id = ? LIMIT 1",
+                (sender_id, client_msg_id)
+            ).fetchone()
+        return _row_to_message(row) if row else None
+
+    def delete_through(self, room_id, message_id):
+        with self._lock:
+            cursor = self.conn.execute(
+                "DELETE FROM messages WHERE room_id = ? AND message_id <= ?", (str(room_id), message_id)
+            )
+            self.conn.commit()
+            return cursor.rowcount
+
+    def load_read_cursors(self, user_id):
+        with self._lock:
+            rows = self.conn.execute(
+                "SELECT room_id, last_read_id FROM read_cursors WHERE user_id = ?", (user_id,)
+            ).fetchall()
+        return {room_id: last_read_id for room_id, last_read_id in rows}
+
+    def save_read_cursors(self, cursors):
+        with self._lock:
+            self.conn.executemany('''
+                INSERT INTO read_cursors (user_id, room_id, last_read_id) VALUES (?, ?, ?)
+                ON CONFLICT (user_id, room_id) DO UPDATE SET last_read_id = MAX(last_read_id, excluded.last_read_id)
+            ''', [(user_id, str(room_id), last_read_id) for user_id, room_id, last_read_id in cursors])
+            self.conn.commit()
+
+    def count_unread(self, user_id, cursors):
+        if not cursors:
+            return {}
+        values = ",".join("(?, ?)" for _ in cursors)
+        params = [value for room_id, last_read_id in cursors.items() for value in (str(room_id), last_read_id)]
+        query = f'''
+            WITH c(room_id, last_read_id) AS (VALUES {values})
+            SELECT c.room_id, COUNT(m.message_id)
+            FROM c LEFT JOIN messages m
+              ON m.room_id = c.room_id AND m.message_id > c.last_read_id AND m.sender_id <> ?
+            GROUP BY c.room_id
+        '''
+        with self._lock:
+            rows = self.conn.execute(query, [*params, user_id]).fetchall()
+        return {room_id: count for room_id, count in rows}
+
+    def close(self):
+        self.conn.close()
+
+
+class PostgresMessageStore(MessageStore):
+    """PostgreSQL store on a connection pool, sharing the `messages` table layout"""
+
+    name = 'postgres'
+
+    def __init__(self, db_config, minconn=1, maxconn=10):
+        from psycopg2 import pool
+        self.pool = pool.ThreadedConnectionPool(minconn, maxconn, **db_config)
+        # Callers beyond maxconn wait for a connection instead of getting PoolError
+        self._slots = threading.BoundedSemaphore(maxconn)
+        # Checked on first use: the server builds the store at import, before it runs migrations
+        self._schema_checked = False
+
+    def _run(self, fn):
+        with self._slots:
+            conn = self.pool.getconn()
+            try:
+                if not self._schema_checked:
+                    self._check_schema(conn)
+                with conn.cursor() as cursor:
+                    result = fn(cursor)
+                conn.commit()
+                return result
+            except Exception:
+                conn.rollback()
+                raise
+            finally:
+                self.pool.putconn(conn)
+
+    def _check_schema(self, conn):
+        """The schema is owned by migrations.py; refuse to run on a database they have not brought up to date"""
+        from migrations import MESSAGE_STORE_SCHEMA_VERSION, schema_version
+        version = schema_version(conn)
+        if version < MESSAGE_STORE_SCHEMA_VERSION:
+            raise RuntimeError(
+                f"Database schema is at version {version}, the message store needs "
+                f"{MESSAGE_STORE_SCHEMA_VERSION}: run the migrations first (server start or chat_transfer import)"
+            )
+        self._schema_checked = True
+
+    def save_many(self, records):
+        from psycopg2.extras import execute_values
+
+        def insert(cursor):
+            counts = _room_counts(records)
+            room_ids, sizes = list(counts), list(counts.values())
+            # Seed sequence rows for rooms that predate seq, then reserve ranges for the whole
+            # batch in one UPDATE; its row locks serialise concurrent writers of a room
+            cursor.execute('''
+                INSERT INTO room_sequences (room_id, last_seq)
+                SELECT c.room_id, COALESCE((SELECT MAX(m.seq) FROM messages m WHERE m.room_id = c.room_id), 0)
+                FROM unnest(%s::varchar[]) AS c(room_id)
+                WHERE NOT EXISTS (SELECT 1 FROM room_sequences s WHERE s.room_id = c.room_id)
+                ON CONFLICT (room_id) DO NOTHING
+            ''', (room_ids,))
+            cursor.execute('''
+                UPDATE room_sequences s SET last_seq = s.last_seq + c.n
+                FROM unnest(%s::varchar[], %s::int[]) AS c(room_id, n)
+                WHERE s.room_id = c.room_id
+                RETURNING s.room_id, s.last_seq
+            ''', (room_ids, sizes))
+            seq_records = _assign_seqs(records, dict(cursor.fetchall()))
+            rows = execute_values(
+                cursor,
+                "INSERT INTO messages (room_id, sender_id, sender_username, recipient_id, content, "
+                "message_type, file_name, timestamp, seq, client_msg_id) VALUES %s RETURNING message_id",
+                [_message_to_row(room_id, message) for room_id, message in seq_records],
+                fetch=True
+            )
+            return [{**message, 'message_id': row[0]} for (_, message), row in zip(seq_records, rows)]
+        return self._run(insert)
+
+    def get_room_messages(self, room_id, limit=None, before_id=None):
+        def select(cursor):
+            cursor.execute(f"""
+                SELECT {MESSAGES_COLUMNS} FROM messages
+                WHERE room_id = %s AND (%s::int IS NULL OR message_id < %s)
+                ORDER BY message_id DESC
+                LIMIT %s
+            """, (str(room_id), before_id, before_id, limit))
+            return cursor.fetchall()
+        return [_row_to_message(row) for row in reversed(self._run(select))]
+
+    def get_conversations(self, room_ids, limit_per_room=None):
+        room_ids = [str(room_id) for room_id in room_ids]
+        if not room_ids:
+            return {}
+
+        def select(cursor):
+            cursor.execute(f"""
+                SELECT {MESSAGES_COLUMNS} FROM (
+                    SELECT m.*, ROW_NUMBER() OVER (PARTITION BY room_id ORDER BY message_id DESC) AS rn
+                    FROM messages m WHERE room_id = ANY(%s)
+                ) recent
+                WHERE (%s::int IS NULL OR rn <= %s)
+                ORDER BY room_id, message_id
+            """, (room_ids, limit_per_room, limit_per_room))
+            return cursor.fetchall()
+
+        conversations = {}
+        for row in self._run(select):
+            conversations.setdefault(row[1], []).append(_row_to_message(row))
+        return conversations
+
+    def iter_room(self, room_id, batch_size=1000):
+        last_id = 0
+        while True:
+            def select(cursor):
+                cursor.execute(
+                    f"SELECT {MESSAGES_COLUMNS} FROM messages WHERE room_id = %s AND message_id > %s "
+                    "ORDER BY message_id LIMIT %s", (str(room_id), last_id, batch_size)
+                )
+                return cursor.fetchall()
+            rows = self._run(select)
+            if not rows:
+                return
+            for row in rows:
+                yield _row_to_message(row)
+            last_id = rows[-1][0]
+
+    def list_rooms(self):
+        def select(cursor):
+            cursor.execute("SELECT DISTINCT room_id FROM messages")
+            return cursor.fetchall()
+        return [row[0] for row in self._run(select)]
+
+    def count_room(self, room_id):
+        def select(cursor):
+            cursor.execute("SELECT COUNT(*) FROM messages WHERE room_id = %s", (str(room_id),))
+            return cursor.fetchone()[0]
+        return self._run(select)
+
+    def find_by_client_msg_id(self, sender_id, client_msg_id):
+        def select(cursor):
+            cursor.execute(f"""
+                SELECT {MESSAGES_COLUMNS} FROM messages
+                WHERE sender_id = %s AND client_msg_id = %s
+                LIMIT 1
+            """, (sender_id, client_msg_id))
+            return cursor.fetchone()
+        row = self._run(select)
+        return _row_to_message(row) if row else None
+
+    def delete_through(self, room_id, message_id):
+        def delete(cursor):
+            # Pin the room's sequence first so seqs keep counting after the removed rows
+            cursor.execute('''
+                INSERT INTO room_sequences (room_id, last_seq)
+                SELECT %s, COALESCE(MAX(seq), 0) FROM messages WHERE room_id = %s
+                ON CONFLICT (room_id) DO NOTHING
+            ''', (str(room_id), str(room_id)))
+            cursor.execute("DELETE FROM messages WHERE room_id = %s AND message_id <= %s", (str(room_id), message_id))
+            return cursor.rowcount
+        return self._run(delete)
+
+    def load_read_cursors(self, user_id):
+        def select(cursor):
+            cursor.execute("SELECT room_id, last_read_id FROM read_cursors WHERE user_id = %s", (user_id,))
+            return cursor.fetchall()
+        return {room_id: last_read_id for room_id, last_read_id in self._run(select)}
+
+    def save_read_cursors(self, cursors):
+        from psycopg2.extras import execute_values
+
+        def upsert(cursor):
+            execute_values(cursor, '''
+                INSERT INTO read_cursors (user_id, room_id, last_read_id) VALUES %s
+                ON CONFLICT (user_id, room_id)
+                DO UPDATE SET last_read_id = GREATEST(read_cursors.last_read_id, EXCLUDED.last_read_id)
+            ''', [(user_id, str(room_id), last_read_id) for user_id, room_id, last_read_id in cursors])
+        self._run(upsert)
+
+    def count_unread(self, user_id, cursors):
+        if not cursors:
+            return {}
+        room_ids = [str(room_id) for room_id in cursors]
+        last_read_ids = [cursors[room_id] for room_id in cursors]
+
+        def select(cursor):
+            cursor.execute('''
+                SELECT c.room_id, COUNT(m.message_id)
+                FROM unnest(%s::varchar[], %s::int[]) AS c(room_id, last_read_id)
+                LEFT JOIN messages m
+                  ON m.room_id = c.room_id AND m.message_id > c.last_read_id AND m.sender_id <> %s
+                GROUP BY c.room_id
+            ''', (room_ids, last_read_ids, user_id))
+            return cursor.fetchall()
+        return {room_id: count for room_id, count in self._run(select)}
+
+    def close(self):
+        self.pool.closeall()
+
+
+# Index record: message_id, seq, sender_id (-1 = none), segment, offset, length, room_id byte length
+SEGMENT_INDEX_RECORD = struct.Struct('<QQqIQIH')
+SEGMENT_FILE_PATTERN = re.compile(r'^segment-(\d{6})\.ndjson$')
+# Newest messages whose client_msg_id is remembered (send retries only ever target recent sends)
+SEGMENT_CLIENT_ID_WINDOW = 50000
+
+
+class SegmentMessageStore(MessageStore):
+    """Append-only NDJSON segment files plus a binary offset index.
+
+    Every message is written once as "<room_id>\t<encoded record>" (one line in the active
+    segment) and indexed by (segment, offset, length) of the record, so the index can be
+    rebuilt from the segments alone. The per-room index lives in memory as compact arrays;
+    a page is located with a bisect and sliced out of the memory-mapped segment as raw bytes,
+    so reading 50 messages costs the same whatever the size of the log.
+    """
+
+    name = 'segment'
+
+    def __init__(self, directory='chat_segments', segment_max_bytes=64 * 1024 * 1024, import_json_path=None):
+        self.directory = directory
+        self.segment_max_bytes = segment_max_bytes
+        os.makedirs(directory, exist_ok=True)
+        self._lock = threading.Lock()
+        # room_id -> parallel arrays, ordered by message_id
+        self._rooms = {}
+        self._room_seqs = {}
+        self._next_id = 1
+        self._maps = {}  # segment number -> mmap (re-mapped when the active segment has grown)
+        self._segment_live = {}  # segment number -> indexed messages not yet trimmed
+        self._index_path = os.path.join(directory, 'messages.idx')
+        self._cursors_path = os.path.join(directory, 'read_cursors.json')
+        self._trimmed_path = os.path.join(directory, 'trimmed.json')
+        self._read_cursors = self._load_json(self._cursors_path)
+        self._trimmed = self._load_json(self._trimmed_path)  # room_id -> highest removed message_id
+        self._client_ids = OrderedDict()  # (sender_id, client_msg_id) -> (room_id, message_id), newest last
+        self._recent_entries = deque(maxlen=SEGMENT_CLIENT_ID_WINDOW)  # filled while loading only
+        self._active, self._active_size = self._load_index()
+        self._load_client_ids()
+        self._segment_file = open(self._segment_path(self._active), 'ab')
+        self._index_file = open(self._index_path, 'ab')
+        if not self._rooms and import_json_path and os.path.exists(import_json_path):
+            self._import_json(import_json_path)
+
+    def _segment_path(self, number):
+        return os.path.join(self.directory, f"segment-{number:06d}.ndjson")
+
+    def _room(self, room_id):
+        room = self._rooms.get(room_id)
+        if room is None:
+            room = self._rooms[room_id] = {
+                'ids': array('Q'), 'senders': array('q'), 'segments': array('I'),
+                'offsets': array('Q'), 'lengths': array('I')
+            }
+        return room
+
+    def _segment_numbers(self):
+        return sorted(int(match.group(1)) for match in map(SEGMENT_FILE_PATTERN.match, os.listdir(self.directory))
+                      if match)
+
+    @staticmethod
+    def _index_record(room_id, message_id, seq, sender_id, segment, offset, length):
+        room_bytes = room_id.encode('utf-8')
+        return SEGMENT_INDEX_RECORD.pack(message_id, seq, sender_id, segment, offset, length,
+                                         len(room_bytes)) + room_bytes
+
+    def _index_entry(self, room_id, message_id, seq, sender_id, segment, offset, length):
+        self._room_seqs[room_id] = max(self._room_seqs.get(room_id, 0), seq)
+        self._next_id = max(self._next_id, message_id + 1)
+        if message_id <= self._trimmed.get(room_id, 0):
+            return
+        if self._recent_entries is not None and sender_id >= 0:
+            self._recent_entries.append((room_id, message_id, segment, offset, length))
+        self._segment_live[segment] = self._segment_live.get(segment, 0) + 1
+        room = self._room(room_id)
+        room['ids'].append(message_id)
+        room['senders'].append(sender_id)
+        room['segments'].append(segment)
+        room['offsets'].append(offset)
+        room['lengths'].append(length)
+
+    def _load_index(self):
+        """Rebuild the in-memory index and return (active segment, its size).
+
+        A torn index tail is dropped; a missing or empty index is rebuilt from the segment files.
+        Segment bytes past the last indexed line were never acknowledged and are removed.
+        """
+        try:
+            with open(self._index_path, 'rb') as f:
+                data = f.read()
+        except FileNotFoundError:
+            data = b''
+        segment_sizes = {}
+        ends = {}
+        position = 0
+        while position + SEGMENT_INDEX_RECORD.size <= len(data):
+            message_id, seq, sender_id, segment, offset, length, room_length = \
+                SEGMENT_INDEX_RECORD.unpack_from(data, position)
+            record_end = position + SEGMENT_INDEX_RECORD.size + room_length
+            if record_end > len(data):
+                break
+            room_id = data[position + SEGMENT_INDEX_RECORD.size:record_end].decode('utf-8')
+            # Entries removed after archiving may point into segment files that are already gone
+            trimmed = message_id <= self._trimmed.get(room_id, 0)
+            if segment not in segment_sizes:
+                path = self._segment_path(segment)
+                segment_sizes[segment] = os.path.getsize(path) if os.path.exists(path) else 0
+            if offset + length <= segment_sizes[segment]:
+                ends[segment] = max(ends.get(segment, 0), offset + length + 1)
+            elif not trimmed:
+                break
+            self._index_entry(room_id, message_id, seq, sender_id, segment, offset, length)
+            position = record_end
+        if position < len(data):
+            with open(self._index_path, 'r+b') as f:
+                f.truncate(position)
+        if position == 0:
+            ends = self._rebuild_index()
+
+        for room in self._rooms.values():
+            if any(a > b for a, b in zip(room['ids'], room['ids'][1:])):
+                order = sorted(range(len(room['ids'])), key=room['ids'].__getitem__)
+                for key, values in room.items():
+                    room[key] = array(values.typecode, (values[i] for i in order))
+
+        numbers = self._segment_numbers()
+        if not ends:
+            # Nothing indexed: leave every existing segment alone and write to a fresh one
+            last = numbers[-1] if numbers else 0
+            empty = last and os.path.getsize(self._segment_path(last)) == 0
+            active = last if empty else last + 1
+            return active, 0
+
+        active = max(ends)
+        # Bytes after the last indexed line were never acknowledged to anyone: the tail of the
+        # active segment, and whole segments a roll created before its index records were written
+        for number in numbers:
+            if number > active:
+                os.remove(self._segment_path(number))
+                print(f"⚠️ [SegmentStore] Removed unindexed segment {number} left by a crash")
+        path = self._segment_path(active)
+        if os.path.exists(path) and os.path.getsize(path) > ends[active]:
+            with open(path, 'r+b') as f:
+                f.truncate(ends[active])
+        return active, os.path.getsize(path) if os.path.exists(path) else 0
+
+    def _rebuild_index(self):
+        """Re-create messages.idx by scanning every segment; returns {segment: end of last line}"""
+        ends, index, skipped = {}, [], 0
+        for number in self._segment_numbers():
+            with open(self._segment_path(number), 'rb') as f:
+                data = f.read()
+            position = 0
+            while True:
+                newline = data.find(b'\n', position)
+                if newline < 0:
+                    break  # a half-written last line
+                line = data[position:newline]
+                # Lines without a room prefix come from before it existed; use the record's own room_id
+                room_bytes, tab, record = line.rpartition(b'\t')
+                offset = position + (len(room_bytes) + 1 if tab else 0)
+                try:
+                    message = json.loads(record)
+                    room_id = room_bytes.decode('utf-8') if tab else message.get('room_id')
+                except ValueError:
+                    message = room_id = None
+                if room_id is not None and 'message_id' in message:
+                    sender_id = message.get('sender_id')
+                    entry = (str(room_id), message['message_id'], message.get('seq', 0),
+                             int(sender_id) if sender_id is not None else -1, number, offset, len(record))
+                    index.append(self._index_record(*entry))
+                    self._index_entry(*entry)
+                else:
+                    skipped += 1
+                    if isinstance(message, dict) and isinstance(message.get('message_id'), int):
+                        # Never hand out an id that is already on disk
+                        self._next_id = max(self._next_id, message['message_id'] + 1)
+                position = newline + 1
+            if position:
+                ends[number] = position
+        if not ends:
+            return ends
+
+        tmp_path = f"{self._index_path}.tmp"
+        with open(tmp_path, 'wb') as f:
+            f.write(b''.join(index))
+            f.flush()
+            os.fsync(f.fileno())
+        os.replace(tmp_path, self._index_path)
+        print(f"🔧 [SegmentStore] Rebuilt index from {len(ends)} segments: {len(index)} messages"
+              + (f", {skipped} unreadable lines skipped" if skipped else ""))
+        return ends
+
+    def _remember_client_id(self, sender_id, client_msg_id, room_id, message_id):
+        self._client_ids[(sender_id, client_msg_id)] = (room_id, message_id)
+        while len(self._client_ids) > SEGMENT_CLIENT_ID_WINDOW:
+            self._client_ids.popitem(last=False)
+
+    def _load_client_ids(self):
+        """client_msg_ids of the newest indexed messages (their records are read once at startup)"""
+        for room_id, message_id, segment, offset, length in self._recent_entries:
+            try:
+                message = json.loads(self._map(segment, offset + length)[offset:offset + length])
+            except (OSError, ValueError):
+                continue
+            if message.get('client_msg_id'):
+                self._remember_client_id(message.get('sender_id'), message['client_msg_id'], room_id, message_id)
+        self._recent_entries = None
+
+    def _load_json(self, path):
+        try:
+            with open(path, 'r') as f:
+                return json.load(f)
+        except (FileNotFoundError, json.JSONDecodeError):
+            return {}
+
+    def _save_json(self, path, data):
+        tmp_path = f"{path}.tmp"
+        with open(tmp_path, 'w') as f:
+            json.dump(data, f)
+            f.flush()
+            os.fsync(f.fileno())
+        os.replace(tmp_path, path)
+
+    def _import_json(self, path):
+        """One-time migration from chat_log.json, keeping message ids, seqs and read cursors"""
+        source = JsonMessageStore(path)
+        for room_id, messages in source._conversations.items():
+            self._append([(str(room_id), message) for message in messages])
+        self._read_cursors = source._read_cursors
+        self._save_json(self._cursors_path, self._read_cursors)
+        print(f"📦 [SegmentStore] Imported {self._next_id - 1} messages from {path}")
+
+    def _append(self, records):
+        """Write (room_id, message-with-ids) records: segment lines first, then index records"""
+        if not records:
+            return
+        if self._active_size >= self.segment_max_bytes:
+            self._segment_file.close()
+            self._active += 1
+            self._segment_file = open(self._segment_path(self._active), 'ab')
+            self._active_size = os.fstat(self._segment_file.fileno()).st_size
+
+        lines, index, entries = [], [], []
+        offset = self._active_size
+        for room_id, message in records:
+            record = encode_record(message).encode('utf-8')
+            prefix = room_id.encode('utf-8') + b'\t'
+            sender_id = message.get('sender_id')
+            entry = (room_id, message['message_id'], message['seq'],
+                     int(sender_id) if sender_id is not None else -1, self._active, offset + len(prefix), len(record))
+            index.append(self._index_record(*entry))
+            lines.append(prefix + record)
+            entries.append(entry)
+            offset += len(prefix) + len(record) + 1
+
+        self._segment_file.write(b'\n'.join(lines) + b'\n')
+        self._segment_file.flush()
+        os.fsync(self._segment_file.fileno())
+        self._index_file.write(b''.join(index))
+        self._index_file.flush()
+        os.fsync(self._index_file.fileno())
+        self._active_size = offset
+        for entry, (_, message) in zip(entries, records):
+            self._index_entry(*entry)
+            if message.get('client_msg_id'):
+                self._remember_client_id(message.get('sender_id'), message['client_msg_id'], entry[0], entry[1])
+
+    def _page(self, room_id, limit, before_id):
+        """[(message_id, mmap, offset, length)] of the requested page"""
+        room = self._rooms.get(str(room_id))
+        if room is None:
+            return []
+        ids = room['ids']
+        end = bisect.bisect_left(ids, before_id) if before_id is not None else len(ids)
+        start = 0 if limit is None else max(end - limit, 0)
+        page = []
+        for i in range(start, end):
+            segment, offset, length = room['segments'][i], room['offsets'][i], room['lengths'][i]
+            page.append((ids[i], self._map(segment, offset + length), offset, length))
+        return page
+
+    def _map(self, segment, needed):
+        mapped = self._maps.get(segment)
+        if mapped is None or len(mapped) < needed:
+            # Old maps are not closed here: a concurrent reader may still be slicing one
+            with open(self._segment_path(segment), 'rb') as f:
+                mapped = self._maps[segment] = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+        return mapped
+
+    def save_many(self, records):
+        with self._lock:
+            next_id, room_seqs, stored = self._next_id, {}, []
+            for room_id, message in records:
+                room_id = str(room_id)
+                seq = room_seqs.get(room_id, self._room_seqs.get(room_id, 0)) + 1
+                room_seqs[room_id] = seq
+                stored.append((room_id, {**message, 'message_id': next_id, 'seq': seq}))
+                next_id += 1
+            self._append(stored)
+        return [message for _, message in stored]
+
+    def get_room_fragments(self, room_id, limit=None, before_id=None):
+        with self._lock:
+            page = self._page(room_id, limit, before_id)
+        return [(message_id, mapped[offset:offset + length].decode('utf-8'))
+                for message_id, mapped, offset, length in page]
+
+    def get_room_messages(self, room_id, limit=None, before_id=None):
+        with self._lock:
+            page = self._page(room_id, limit, before_id)
+        return [json.loads(mapped[offset:offset + length]) for _, mapped, offset, length in page]
+
+    def get_conversation_fragments(self, room_ids, limit_per_room=None):
+        conversations = {}
+        for room_id in room_ids:
+            fragments = [fragment for _, fragment in self.get_room_fragments(room_id, limit=limit_per_room)]
+            if fragments:
+                conversations[str(room_id)] = fragments
+        return conversations
+
+    def get_conversations(self, room_ids, limit_per_room=None):
+        conversations = {}
+        for room_id in room_ids:
+            messages = self.get_room_messages(room_id, limit=limit_per_room)
+            if messages:
+                conversations[str(room_id)] = messages
+        return conversations
+
+    def load_read_cursors(self, user_id):
+        with self._lock:
+            return dict(self._read_cursors.get(str(user_id), {}))
+
+    def save_read_cursors(self, cursors):
+        with self._lock:
+            for user_id, room_id, last_read_id in cursors:
+                self._read_cursors.setdefault(str(user_id), {})[str(room_id)] = last_read_id
+            self._save_json(self._cursors_path, self._read_cursors)
+
+    def iter_room(self, room_id, batch_size=1000):
+        last_id = 0
+        while True:
+            with self._lock:
+                room = self._rooms.get(str(room_id))
+                if room is None:
+                    return
+                start = bisect.bisect_right(room['ids'], last_id)
+                page = []
+                for i in range(start, min(start + batch_size, len(room['ids']))):
+                    segment, offset, length = room['segments'][i], room['offsets'][i], room['lengths'][i]
+                    page.append((room['ids'][i], self._map(segment, offset + length), offset, length))
+            if not page:
+                return
+            for _, mapped, offset, length in page:
+                yield json.loads(mapped[offset:offset + length])
+            last_id = page[-1][0]
+
+    def list_rooms(self):
+        with self._lock:
+            return [room_id for room_id, room in self._rooms.items() if room['ids']]
+
+    def count_room(self, room_id):
+        with self._lock:
+            room = self._rooms.get(str(room_id))
+            return len(room['ids']) if room else 0
+
+    def find_by_client_msg_id(self, sender_id, client_msg_id):
+        with self._lock:
+            found = self._client_ids.get((sender_id, client_msg_id))
+            room = self._rooms.get(found[0]) if found else None
+            if room is None:
+                return None
+            i = bisect.bisect_left(room['ids'], found[1])
+            if i == len(room['ids']) or room['ids'][i] != found[1]:
+                return None  # trimmed since
+            segment, offset, length = room['segments'][i], room['offsets'][i], room['lengths'][i]
+            mapped = self._map(segment, offset + length)
+        return json.loads(mapped[offset:offset + length])
+
+    def delete_through(self, room_id, message_id):
+        """Drop index entries up to message_id; sealed segments with nothing left are deleted"""
+        room_id = str(room_id)
+        with self._lock:
+            room = self._rooms.get(room_id)
+            if room is None:
+                return 0
+            cut = bisect.bisect_right(room['ids'], message_id)
+            if cut == 0:
+                return 0
+            # Watermark first: a restart must never resurrect removed entries
+            self._trimmed[room_id] = max(self._trimmed.get(room_id, 0), message_id)
+            self._save_json(self._trimmed_path, self._trimmed)
+            for segment in room['segments'][:cut]:
+                self._segment_live[segment] -= 1
+            for key in room:
+                del room[key][:cut]
+            for segment in [n for n, live in self._segment_live.items() if live <= 0 and n != self._active]:
+                del self._segment_live[segment]
+                self._maps.pop(segment, None)
+                os.remove(self._segment_path(segment))
+            return cut
+
+    def count_unread(self, user_id, cursors):
+        """Counted from the index alone (sender ids are indexed), no segment reads"""
+        unread = {}
+        with self._lock:
+            for room_id, last_read_id in cursors.items():
+                room = self._rooms.get(str(room_id))
+                if room is None:
+                    unread[str(room_id)] = 0
+                    continue
+                start = bisect.bisect_right(room['ids'], last_read_id)
+                unread[str(room_id)] = sum(1 for sender in room['senders'][start:] if sender != user_id)
+        return unread
+
+    def close(self):
+        with self._lock:
+            self._segment_file.close()
+            self._index_file.close()
+            self._maps.clear()
+
+
+def create_message_store(backend, json_path='chat_log.json', sqlite_path='chat_messages.db', db_config=None,
+                         segment_dir='chat_segments'):
+    """Build the configured store ('json', 'sqlite', 'postgres' or 'segment')"""
+    if backend == 'json':
+        return JsonMessageStore(json_path)
+    if backend == 'segment':
+        # An empty segment directory is seeded once from chat_log.json
+        return SegmentMessageStore(segment_dir, import_json_path=json_path)
+    if backend == 'sqlite':
+        return SqliteMessageStore(sqlite_path)
+    if backend == 'postgres':
+        return PostgresMessageStore(db_config or {})
+    raise ValueError(f"Unknown message store backend: {backend}")
+
+
+def benchmark_store(store, total_messages=20000, rooms=200, batch_size=50, page_size=50):
+    """Write/read micro-benchmark for one store; returns timings in seconds"""
+    started = time.perf_counter()
+    batch = []
+    for i in range(total_messages):
+        room_id = f"bench_{i % rooms}"
+        batch.append((room_id, {
+            "sender_id": 1,
+            "sender_username": "bench",
+            "timestamp": f"2025-01-01T00:00:{i % 60:02d}+00:00",
+            "type": "text",
+            "content": f"benchmark message {i}",
+            "room_id": room_id,
+            "recipient_id": 2
+        }))
+        if len(batch) == batch_size:
+            store.save_many(batch)
+            batch = []
+    if batch:
+        store.save_many(batch)
+    write_seconds = time.perf_counter() - started
+
+    started = time.perf_counter()
+    for i in range(rooms):
+        store.get_room_messages(f"bench_{i}", limit=page_size)
+    read_seconds = time.perf_counter() - started
+
+    started = time.perf_counter()
+    store.get_conversations([f"bench_{i}" for i in range(rooms)], limit_per_room=page_size)
+    sync_seconds = time.perf_counter() - started
+
+    return {'write': write_seconds, 'read_pages': read_seconds, 'initial_sync': sync_seconds}
+
+
+if __name__ == '__main__':
+    # Local comparison: python message_store.py [json sqlite postgres segment]
+    # Postgres uses BENCH_PG_HOST/BENCH_PG_PORT/BENCH_PG_DB/BENCH_PG_USER/BENCH_PG_PASSWORD
+    import sys
+    import tempfile
+
+    backends = sys.argv[1:] or ['json', 'sqlite']
+    workdir = tempfile.mkdtemp(prefix='store_bench_')
+    for backend in backends:
+        db_config = {
+            'host': os.environ.get('BENCH_PG_HOST', 'localhost'),
+            'port': int(os.environ.get('BENCH_PG_PORT', '5432')),
+            'database': os.environ.get('BENCH_PG_DB', 'postgres'),
+            'user': os.environ.get('BENCH_PG_USER', 'postgres'),
+            'password': os.environ.get('BENCH_PG_PASSWORD', ''),
+        }
+        store = create_message_store(
+            backend,
+            json_path=os.path.join(workdir, 'chat_log.json'),
+            sqlite_path=os.path.join(workdir, 'chat_messages.db'),
+            db_config=db_config,
+            segment_dir=os.path.join(workdir, 'chat_segments')
+        )
+        try:
+            timings = benchmark_store(store)
+        finally:
+            store.close()
+        print(f"📊 [{backend}] write={timings['write']:.3f}s "
+              f"read_pages={timings['read_pages']:.3f}s initial_sync={timings['initial_sync']:.3f}s")
@@ -0,0 +1,175 @@
+"""Forward-only PostgreSQL schema migrations with a version table."""
+
+# Any constant works; it only has to be the same in every process that migrates this database
+MIGRATION_LOCK_ID = 724201
+
+MIGRATIONS = [
+    (1, 'baseline_tables', [
+        '''
+        CREATE TABLE IF NOT EXISTS users (
+            user_id SERIAL PRIMARY KEY,
+            username TEXT UNIQUE NOT NULL,
+            password_hash TEXT NOT NULL
+        )
+        ''',
+        '''
+        CREATE TABLE IF NOT EXISTS friendships (
+            user_id INTEGER NOT NULL,
+            friend_id INTEGER NOT NULL,
+            status TEXT NOT NULL,
+            created_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP,
+            PRIMARY KEY (user_id, friend_id),
+            FOREIGN KEY (user_id) REFERENCES users (user_id),
+            FOREIGN KEY (friend_id) REFERENCES users (user_id)
+        )
+        ''',
+        '''
+        CREATE TABLE IF NOT EXISTS rooms (
+            room_id SERIAL PRIMARY KEY,
+            type VARCHAR(50) NOT NULL, -- 'private' untuk 1-on-1, 'group' untuk grup
+            room_name VARCHAR(255),
+            created_at TIMESTAMPTZ DEFAULT CURRENT_TIMESTAMP
+        )
+        ''',
+        '''
+        CREATE TABLE IF NOT EXISTS room_members (
+            room_id INTEGER NOT NULL,
+            user_id INTEGER NOT NULL,
+            role VARCHAR(50) DEFAULT 'member', -- bisa 'admin' atau 'member'
+            PRIMARY KEY (room_id, user_id),
+            FOREIGN KEY (room_id) REFERENCES rooms (room_id) ON DELETE CASCADE,
+            FOREIGN KEY (user_id) REFERENCES users (user_id) ON DELETE CASCADE
+        )
+        ''',
+        # Shared with the Code_Client_WSS server and the PostgreSQL message store
+        '''
+        CREATE TABLE IF NOT EXISTS messages (
+            message_id SERIAL PRIMARY KEY,
+            room_id VARCHAR(255) NOT NULL,
+            sender_id INTEGER NOT NULL,
+            sender_username VARCHAR(255) NOT NULL,
+            recipient_id VARCHAR(255),
+            content TEXT,
+            message_type VARCHAR(10) DEFAULT 'text',
+            file_name VARCHAR(255),
+            file_path TEXT,
+            file_size INTEGER,
+            mime_type VARCHAR(100),
+            timestamp TIMESTAMPTZ DEFAULT CURRENT_TIMESTAMP,
+            FOREIGN KEY (sender_id) REFERENCES users (user_id)
+        )
+        ''',
+        "CREATE INDEX IF NOT EXISTS idx_messages_room_id ON messages (room_id)",
+        "CREATE INDEX IF NOT EXISTS idx_messages_sender_id ON messages (sender_id)",
+    ]),
+    (2, 'hot_path_indexes_and_private_pair', [
+        # "Who added me" / reverse friendship lookups
+        "CREATE INDEX IF NOT EXISTS idx_friendships_friend_id ON friendships (friend_id, status)",
+        # Every "rooms of user X" query (inbox, private room lookup) filters room_members by user_id
+        "CREATE INDEX IF NOT EXISTS idx_room_members_user_id ON room_members (user_id, room_id)",
+        # db_get_conversations (Code_Client_WSS server) unions rooms by recipient_id
+        "CREATE INDEX IF NOT EXISTS idx_messages_recipient_id ON messages (recipient_id)",
+        # One private room per user pair: 'min_id:max_id', NULL for groups
+        "ALTER TABLE rooms ADD COLUMN IF NOT EXISTS private_pair VARCHAR(64)",
+        # Backfill; if a pair already has several rooms only the oldest gets the key
+        '''
+        UPDATE rooms r SET private_pair = p.pair
+        FROM (
+            SELECT DISTINCT ON (pair) room_id, pair
+            FROM (
+                SELECT rm.room_id, MIN(rm.user_id) || ':' || MAX(rm.user_id) AS pair
+                FROM room_members rm
+                JOIN rooms pr ON pr.room_id = rm.room_id AND pr.type = 'private'
+                GROUP BY rm.room_id
+                HAVING COUNT(*) = 2
+            ) pairs
+            ORDER BY pair, room_id
+        ) p
+        WHERE r.room_id = p.room_id AND r.private_pair IS NULL
+        ''',
+        "CREATE UNIQUE INDEX IF NOT EXISTS uq_rooms_private_pair ON rooms (private_pair) WHERE private_pair IS NOT NULL",
+    ]),
+    (3, 'message_store_sequences_and_cursors', [
+        # Per-room ordering and retry dedup for the PostgreSQL message store
+        "ALTER TABLE messages ADD COLUMN IF NOT EXISTS seq INTEGER",
+        "ALTER TABLE messages ADD COLUMN IF NOT EXISTS client_msg_id VARCHAR(64)",
+        "CREATE INDEX IF NOT EXISTS idx_messages_client_msg_id ON messages (sender_id, client_msg_id) "
+        "WHERE client_msg_id IS NOT NULL",
+        '''
+        CREATE TABLE IF NOT EXISTS room_sequences (
+            room_id VARCHAR(255) PRIMARY KEY,
+            last_seq INTEGER NOT NULL
+        )
+        ''',
+        '''
+        CREATE TABLE IF NOT EXISTS read_cursors (
+            user_id INTEGER NOT NULL,
+            room_id VARCHAR(255) NOT NULL,
+            last_read_id INTEGER NOT NULL,
+            PRIMARY KEY (user_id, room_id)
+        )
+        ''',
+    ]),
+]
+
+# Oldest schema the PostgreSQL message store can run on
+MESSAGE_STORE_SCHEMA_VERSION = 3
+
+LATEST_VERSION = MIGRATIONS[-1][0]
+
+
+def private_pair_key(user_a, user_b):
+    """rooms.private_pair value for two users (order-independent)"""
+    low, high = sorted((int(user_a), int(user_b)))
+    return f"{low}:{high}"
+
+
+def schema_version(conn):
+    """Highest applied migration (0 for a database that never ran the runner)"""
+    with conn.cursor() as cursor:
+        cursor.execute("SELECT to_regclass('schema_migrations')")
+        if cursor.fetchone()[0] is None:
+            return 0
+        cursor.execute("SELECT COALESCE(MAX(version), 0) FROM schema_migrations")
+        return cursor.fetchone()[0]
+
+
+def run_migrations(conn):
+    """Apply pending migrations in order, each in its own transaction; returns the applied versions.
+
+    A current schema costs two catalog reads and no DDL. Concurrent starters serialise on an
+    advisory lock and re-check the version table, so every migration runs exactly once.
+    """
+    current = schema_version(conn)
+    conn.commit()
+    if current >= LATEST_VERSION:
+        return []
+
+    applied = []
+    for version, name, statements in MIGRATIONS:
+        if version <= current:
+            continue
+        try:
+            with conn.cursor() as cursor:
+                cursor.execute("SELECT pg_advisory_xact_lock(%s)", (MIGRATION_LOCK_ID,))
+                cursor.execute('''
+                    CREATE TABLE IF NOT EXISTS schema_migrations (
+                        version INTEGER PRIMARY KEY,
+                        name TEXT NOT NULL,
+                        applied_at TIMESTAMPTZ DEFAULT CURRENT_TIMESTAMP
+                    )
+                ''')
+                cursor.execute("SELECT 1 FROM schema_migrations WHERE version = %s", (version,))
+                if cursor.fetchone() is None:
+                    for statement in statements:
+                        cursor.execute(statement)
+                    cursor.execute("INSERT INTO schema_migrations (version, name) VALUES (%s, %s)", (version, name))
+                    applied.append(version)
+            conn.commit()
+        except Exception as e:
+            conn.rollback()
+            print(f"❌ [Migrations] {version:03d}_{name} failed: {e}")
+            raise
+        if applied and applied[-1] == version:
+            print(f"✅ [Migrations] Applied {version:03d}_{name}")
+    return applied
@@ -0,0 +1,216 @@
+"""Durable per-user offline mailbox (SQLite) with an in-memory tail cache and cursor drains."""
+
+import json
+import sqlite3
+import threading
+import time
+import zlib
+from collections import deque
+
+# Payloads above this size are zlib-compressed on disk
+COMPRESS_MIN_BYTES = 256
+
+
+def _encode(message):
+    raw = json.dumps(message, separators=(',', ':'), default=str).encode('utf-8')
+    if len(raw) >= COMPRESS_MIN_BYTES:
+        return zlib.compress(raw, 6), 1
+    return raw, 0
+
+
+def _decode(payload, compressed):
+    raw = zlib.decompress(payload) if compressed else payload
+    return json.loads(raw)
+
+
+class UserMailbox:
+    """Per-user message queue that survives restarts.
+
+    Each message gets a per-user, monotonically increasing `mailbox_seq`. Clients drain
+    with a cursor (the last seq they processed); everything at or below an acknowledged
+    cursor is deleted. Retention and per-user count/byte budgets drop the oldest entries.
+    """
+
+    def __init__(self, path='auth_bridge.db', retention_seconds=7 * 24 * 3600,
+                 max_messages_per_user=5000, max_bytes_per_user=5 * 1024 * 1024, tail_size=100):
+        self.path = path
+        self.retention_seconds = retention_seconds
+        self.max_messages_per_user = max_messages_per_user
+        self.max_bytes_per_user = max_bytes_per_user
+        self.tail_size = tail_size
+        self._lock = threading.Lock()
+        self._tails = {}   # user_id -> deque[(seq, message)], newest last
+        self._meta = {}    # user_id -> {'last_seq', 'count', 'bytes'}
+        self.stats = {'appended': 0, 'acked': 0, 'dropped_budget': 0, 'expired': 0,
+                      'tail_hits': 0, 'disk_reads': 0}
+        self.conn = sqlite3.connect(path, check_same_thread=False)
+        self.conn.execute("PRAGMA journal_mode=WAL")
+        self.conn.execute("PRAGMA synchronous=NORMAL")
+        self.conn.execute('''
+            CREATE TABLE IF NOT EXISTS mailbox (
+                user_id INTEGER NOT NULL,
+                seq INTEGER NOT NULL,
+                created_at REAL NOT NULL,
+                size INTEGER NOT NULL,
+                compressed INTEGER NOT NULL DEFAULT 0,
+                payload BLOB NOT NULL,
+                PRIMARY KEY (user_id, seq)
+            ) WITHOUT ROWID
+        ''')
+        self.conn.execute("CREATE INDEX IF NOT EXISTS idx_mailbox_created_at ON mailbox (created_at)")
+        # Last issued seq per user, kept even when the mailbox is empty so cursors never go back
+        self.conn.execute('''
+            CREATE TABLE IF NOT EXISTS mailbox_seqs (
+                user_id INTEGER PRIMARY KEY,
+                last_seq INTEGER NOT NULL
+            )
+        ''')
+        self.conn.commit()
+
+    def _load_meta(self, user_id):
+        meta = self._meta.get(user_id)
+        if meta is None:
+            count, size = self.conn.execute(
+                "SELECT COUNT(*), COALESCE(SUM(size), 0) FROM mailbox WHERE user_id = ?", (user_id,)
+            ).fetchone()
+            row = self.conn.execute("SELECT last_seq FROM mailbox_seqs WHERE user_id = ?", (user_id,)).fetchone()
+            last_seq = row[0] if row else 0
+            meta = self._meta[user_id] = {'last_seq': last_seq, 'count': count, 'bytes': size}
+        return meta
+
+    def append(self, user_id, message):
+        """Persist one message for a user; returns its mailbox_seq"""
+        with self._lock:
+            meta = self._load_meta(user_id)
+            seq = meta['last_seq'] + 1
+            message = {**message, 'mailbox_seq': seq}
+            payload, compressed = _encode(message)
+            self.conn.execute(
+                "INSERT INTO mailbox (user_id, seq, created_at, size, compressed, payload) VALUES (?, ?, ?, ?, ?, ?)",
+                (user_id, seq, time.time(), len(payload), compressed, payload)
+            )
+            self.conn.execute(
+                "INSERT INTO mailbox_seqs (user_id, last_seq) VALUES (?, ?) "
+                "ON CONFLICT (user_id) DO UPDATE SET last_seq = excluded.last_seq",
+                (user_id, seq)
+            )
+            meta['last_seq'] = seq
+            meta['count'] += 1
+            meta['bytes'] += len(payload)
+            self._enforce_budget(user_id, meta)
+            self.conn.commit()
+            self.stats['appended'] += 1
+
+            tail = self._tails.setdefault(user_id, deque(maxlen=self.tail_size))
+            tail.append((seq, message))
+        return seq
+
+    def append_many(self, user_ids, message):
+        """Persist one message for many users in a single transaction; returns {user_id: mailbox_seq}.
+
+        The payload is encoded once; each user's mailbox_seq is attached when it is read back.
+        """
+        payload, compressed = _encode(message)
+        now = time.time()
+        seqs = {}
+        with self._lock:
+            rows = []
+            for user_id in user_ids:
+                meta = self._load_meta(user_id)
+                seq = meta['last_seq'] = meta['last_seq'] + 1
+                meta['count'] += 1
+                meta['bytes'] += len(payload)
+                seqs[user_id] = seq
+                rows.append((user_id, seq, now, len(payload), compressed, payload))
+            self.conn.executemany(
+                "INSERT INTO mailbox (user_id, seq, created_at, size, compressed, payload) VALUES (?, ?, ?, ?, ?, ?)", rows
+            )
+            self.conn.executemany(
+                "INSERT INTO mailbox_seqs (user_id, last_seq) VALUES (?, ?) "
+                "ON CONFLICT (user_id) DO UPDATE SET last_seq = excluded.last_seq",
+                list(seqs.items())
+            )
+            for user_id in seqs:
+                self._enforce_budget(user_id, self._meta[user_id])
+            self.conn.commit()
+            self.stats['appended'] += len(seqs)
+
+            for user_id, seq in seqs.items():
+                tail = self._tails.setdefault(user_id, deque(maxlen=self.tail_size))
+                tail.append((seq, {**message, 'mailbox_seq': seq}))
+        return seqs
+
+    def _enforce_budget(self, user_id, meta):
+        """Drop the oldest messages until the user is within count and byte budgets.
+
+        Dropped messages also leave the tail cache, so reads never serve them.
+        """
+        tail = self._tails.get(user_id)
+        while meta['count'] > self.max_messages_per_user or (meta['bytes'] > self.max_bytes_per_user and meta['count'] > 1):
+            row = self.conn.execute(
+                "SELECT seq, size FROM mailbox WHERE user_id = ? ORDER BY seq LIMIT 1", (user_id,)
+            ).fetchone()
+            if row is None:
+                break
+            self.conn.execute("DELETE FROM mailbox WHERE user_id = ? AND seq = ?", (user_id, row[0]))
+            while tail and tail[0][0] <= row[0]:
+                tail.popleft()
+            meta['count'] -= 1
+            meta['bytes'] -= row[1]
+            self.stats['dropped_budget'] += 1
+            print(f"⚠️ [Mailbox] Budget exceeded for user {user_id}, dropped mailbox_seq {row[0]}")
+
+    def read(self, user_id, after_seq=0, limit=500):
+        """Messages with mailbox_seq > after_seq (oldest first); served from the tail when it covers the range"""
+        with self._lock:
+            tail = self._tails.get(user_id)
+            if tail and tail[0][0] <= after_seq + 1:
+                self.stats['tail_hits'] += 1
+                return [message for seq, message in tail if seq > after_seq][:limit]
+            self.stats['disk_reads'] += 1
+            rows = self.conn.execute(
+                "SELECT seq, payload, compressed FROM mailbox WHERE user_id = ? AND seq > ? ORDER BY seq LIMIT ?",
+                (user_id, after_seq, limit)
+            ).fetchall()
+        # Bulk-appended payloads are shared between users, so the seq comes from the row
+        return [{**_decode(payload, compressed), 'mailbox_seq': seq} for seq, payload, compressed in rows]
+
+    def ack(self, user_id, up_to_seq):
+        """Delete everything a client has confirmed (mailbox_seq <= up_to_seq)"""
+        with self._lock:
+            meta = self._load_meta(user_id)
+            count, size = self.conn.execute(
+                "SELECT COUNT(*), COALESCE(SUM(size), 0) FROM mailbox WHERE user_id = ? AND seq <= ?",
+                (user_id, up_to_seq)
+            ).fetchone()
+            if not count:
+                return 0
+            self.conn.execute("DELETE FROM mailbox WHERE user_id = ? AND seq <= ?", (user_id, up_to_seq))
+            self.conn.commit()
+            meta['count'] -= count
+            meta['bytes'] -= size
+            tail = self._tails.get(user_id)
+            while tail and tail[0][0] <= up_to_seq:
+                tail.popleft()
+            self.stats['acked'] += count
+        return count
+
+    def last_seq(self, user_id):
+        with self._lock:
+            return self._load_meta(user_id)['last_seq']
+
+    def purge_expired(self):
+        """Drop messages older than the retention period (run periodically in an executor)"""
+        cutoff = time.time() - self.retention_seconds
+        with self._lock:
+            deleted = self.conn.execute("DELETE FROM mailbox WHERE created_at < ?", (cutoff,)).rowcount
+            self.conn.commit()
+            if deleted:
+                # Counters and tails are cheap to rebuild lazily
+                self._meta.clear()
+                self._tails.clear()
+                self.stats['expired'] += deleted
+        return deleted
+
+    def close(self):
+        self.conn.close()
@@ -0,0 +1,197 @@
+"""Per-connection outbound priority lanes (control > chat > bulk) and frame chunking."""
+
+import asyncio
+import time
+import uuid
+from collections import deque
+
+LANE_CONTROL = 0
+LANE_CHAT = 1
+LANE_BULK = 2
+LANE_NAMES = ('control', 'chat', 'bulk')
+
+
+def split_frame(frame, chunk_size):
+    """Split an encoded frame into chunk envelopes: {"type": "chunk", "stream", "index", "total", "data"}.
+
+    `data` is a str slice for JSON text frames and a bytes slice for binary frames;
+    the receiver concatenates the slices in index order and decodes the result.
+    """
+    stream_id = uuid.uuid4().hex[:12]
+    pieces = [frame[i:i + chunk_size] for i in range(0, len(frame), chunk_size)]
+    return [
+        {"type": "chunk", "stream": stream_id, "index": index, "total": len(pieces), "data": piece}
+        for index, piece in enumerate(pieces)
+    ]
+
+
+class ChunkAssembler:
+    """Reassembles inbound chunk envelopes; bounded in streams, bytes and age"""
+
+    def __init__(self, max_streams=4, max_bytes=32 * 1024 * 1024, timeout=120):
+        self.max_streams = max_streams
+        self.max_bytes = max_bytes
+        self.timeout = timeout
+        self._streams = {}  # stream_id -> {'parts': {index: data}, 'total', 'bytes', 'started'}
+
+    def feed(self, chunk):
+        """Add one chunk; returns the complete frame (str or bytes) or None while incomplete"""
+        now = time.time()
+        for stream_id in [s for s, info in self._streams.items() if now - info['started'] > self.timeout]:
+            del self._streams[stream_id]
+
+        stream_id, index, total, data = chunk.get('stream'), chunk.get('index'), chunk.get('total'), chunk.get('data')
+        if stream_id is None or not isinstance(index, int) or not isinstance(total, int) or data is None:
+            raise ValueError("Malformed chunk")
+        stream = self._streams.get(stream_id)
+        if stream is None:
+            if len(self._streams) >= self.max_streams:
+                raise ValueError("Too many concurrent chunked uploads")
+            stream = self._streams[stream_id] = {'parts': {}, 'total': total, 'bytes': 0, 'started': now}
+        stream['parts'][index] = data
+        stream['bytes'] += len(data)
+        if stream['bytes'] > self.max_bytes:
+            del self._streams[stream_id]
+            raise ValueError("Chunked upload too large")
+        if len(stream['parts']) < stream['total']:
+            return None
+
+        del self._streams[stream_id]
+        parts = [stream['parts'][i] for i in range(stream['total'])]
+        return b''.join(parts) if isinstance(parts[0], (bytes, bytearray)) else ''.join(parts)
+
+
+class OutboundScheduler:
+    """One writer task per connection that always drains higher lanes first.
+
+    Bulk frames larger than `chunk_size` are split into chunk envelopes (when the client
+    supports them) and written one chunk at a time, so control and chat frames queued
+    meanwhile go out between chunks instead of waiting for the whole transfer.
+
+    With `batch_fn` set (client supports batch frames), small control/chat frames that
+    pile up within `batch_window` seconds are written as one batch frame.
+    """
+
+    def __init__(self, write_fn, encode_fn, chunk_size=64 * 1024, chunking=False,
+                 max_queued_bytes=32 * 1024 * 1024, on_failure=None, stats=None,
+                 batch_fn=None, batch_window=0.005, batch_max_frames=64, batch_max_bytes=64 * 1024):
+        self.write_fn = write_fn      # async (frame, compressible) -> None
+        self.encode_fn = encode_fn    # message dict -> frame (connection protocol)
+        self.batch_fn = batch_fn      # [frame, ...] -> single batch frame, None = no batching
+        self.batch_window = batch_window
+        self.batch_max_frames = batch_max_frames
+        self.batch_max_bytes = batch_max_bytes
+        self.chunk_size = chunk_size
+        self.chunking = chunking
+        self.max_queued_bytes = max_queued_bytes
+        self.on_failure = on_failure
+        self.stats = stats if stats is not None else {}
+        self._lanes = (deque(), deque(), deque())  # bulk items are deques of frames (a chunk stream)
+        self._queued_bytes = 0
+        self._wakeup = asyncio.Event()
+        self._task = asyncio.ensure_future(self._writer())
+        self.closed = False
+
+    def _count(self, key, amount=1):
+        self.stats[key] = self.stats.get(key, 0) + amount
+
+    def enqueue(self, lane, frame, compressible=True):
+        """Queue an encoded frame; returns immediately"""
+        if self.closed:
+            return
+        self._queued_bytes += len(frame)
+        if self._queued_bytes > self.max_queued_bytes:
+            # Slow consumer: dropping the connection beats buffering without bound
+            self._count('slow_consumer_drops')
+            self.close()
+            if self.on_failure:
+                self.on_failure()
+            return
+
+        self._count(f'{LANE_NAMES[lane]}_frames')
+        if lane == LANE_BULK:
+            if self.chunking and len(frame) > self.chunk_size:
+                chunks = [self.encode_fn(chunk) for chunk in split_frame(frame, self.chunk_size)]
+                self._count('chunks', len(chunks))
+                # Account for envelope overhead so the byte budget stays honest
+                self._queued_bytes += sum(len(chunk) for chunk in chunks) - len(frame)
+                self._lanes[LANE_BULK].append(deque((chunk, compressible) for chunk in chunks))
+            else:
+                self._lanes[LANE_BULK].append(deque([(frame, compressible)]))
+        else:
+            self._lanes[lane].append((frame, compressible))
+        self._wakeup.set()
+
+    def _next(self):
+        for lane in (LANE_CONTROL, LANE_CHAT):
+            if self._lanes[lane]:
+                return self._lanes[lane].popleft()
+        bulk = self._lanes[LANE_BULK]
+        if bulk:
+            stream = bulk[0]
+            item = stream.popleft()
+            if not stream:
+                bulk.popleft()
+            return item
+        return None
+
+    def _has_small(self):
+        return bool(self._lanes[LANE_CONTROL] or self._lanes[LANE_CHAT])
+
+    def _next_batch(self):
+        """Pop queued control/chat frames (control first) up to the batch limits"""
+        frames, compressible, size = [], False, 0
+        for lane in (LANE_CONTROL, LANE_CHAT):
+            queue = self._lanes[lane]
+            while queue and len(frames) < self.batch_max_frames:
+                frame, frame_compressible = queue[0]
+                if frames and size + len(frame) > self.batch_max_bytes:
+                    break
+                queue.popleft()
+                frames.append(frame)
+                compressible = compressible or frame_compressible
+                size += len(frame)
+        self._queued_bytes -= size
+        if len(frames) == 1:
+            return frames[0], compressible
+        self._count('batches')
+        self._count('batched_frames', len(frames))
+        return self.batch_fn(frames), compressible
+
+    async def _writer(self):
+        idle = False
+        while True:
+            if self.batch_fn and self._has_small():
+                if idle and self.batch_window > 0:
+                    # First frame after a quiet period: give the burst a few ms to build up
+                    await asyncio.sleep(self.batch_window)
+                    if self.closed:
+                        return
+                item = self._next_batch()
+            else:
+                item = self._next()
+                if item is None:
+                    self._wakeup.clear()
+                    idle = True
+                    await self._wakeup.wait()
+                    continue
+                self._queued_bytes -= len(item[0])
+            idle = False
+            frame, compressible = item
+            try:
+                await self.write_fn(frame, compressible)
+            except Exception as e:
+                print(f"❌ [Outbound] Write failed, closing lane writer: {e}")
+                self._count('write_errors')
+                self.closed = True
+                if self.on_failure:
+                    self.on_failure()
+                return
+
+    def close(self):
+        self.closed = True
+        for lane in self._lanes:
+            lane.clear()
+        self._queued_bytes = 0
+        if not self._task.done():
+            self._task.cancel()
@@ -0,0 +1,124 @@
+"""Presence tracking (online / idle / offline) with coalesced change batches."""
+
+import threading
+import time
+
+ONLINE = 'online'
+IDLE = 'idle'
+OFFLINE = 'offline'
+
+
+class PresenceTracker:
+    """Derives each user's state from WebSocket connections, heartbeats and long-poll activity.
+
+    - online:  a live connection (or recent poll) with activity in the last `idle_after` seconds
+    - idle:    still connected / polling, but no activity for `idle_after` seconds
+    - offline: no connection and no poll for `poll_grace` seconds
+
+    State changes are not pushed immediately; sweep() folds them into a pending set that
+    drain_changes() hands out once per broadcast interval (last state wins).
+    """
+
+    def __init__(self, idle_after=120, poll_grace=45):
+        self.idle_after = idle_after
+        self.poll_grace = poll_grace
+        self._connections = {}     # user_id -> open WebSocket count
+        self._last_activity = {}   # user_id -> last client activity (message, active heartbeat)
+        self._last_poll = {}       # user_id -> last HTTP long-poll
+        self._states = {}          # user_id -> published-or-pending state
+        self._pending = {}         # user_id -> state changed since last drain
+        self._published = {}       # user_id -> last state handed out by drain_changes()
+        self._lock = threading.Lock()
+        self.stats = {'changes': 0, 'coalesced': 0, 'batches': 0, 'tracked_users': 0}
+
+    def _set_state(self, user_id, state):
+        if self._states.get(user_id, OFFLINE) == state:
+            return
+        self._states[user_id] = state
+        if user_id in self._pending:
+            self.stats['coalesced'] += 1
+        self._pending[user_id] = state
+        self.stats['changes'] += 1
+
+    def _compute(self, user_id, now):
+        polling = now - self._last_poll.get(user_id, 0) < self.poll_grace
+        if not self._connections.get(user_id) and not polling:
+            return OFFLINE
+        if now - self._last_activity.get(user_id, 0) < self.idle_after:
+            return ONLINE
+        return IDLE
+
+    def connect(self, user_id):
+        with self._lock:
+            self._connections[user_id] = self._connections.get(user_id, 0) + 1
+            self._last_activity[user_id] = time.time()
+            self._set_state(user_id, ONLINE)
+
+    def disconnect(self, user_id):
+        with self._lock:
+            remaining = self._connections.get(user_id, 0) - 1
+            if remaining > 0:
+                self._connections[user_id] = remaining
+            else:
+                self._connections.pop(user_id, None)
+            self._set_state(user_id, self._compute(user_id, time.time()))
+
+    def touch(self, user_id, active=True):
+        """Heartbeat/message from a connected client; active=False = app in background"""
+        with self._lock:
+            now = time.time()
+            if active:
+                self._last_activity[user_id] = now
+                self._set_state(user_id, self._compute(user_id, now))
+            elif self._states.get(user_id) == ONLINE:
+                self._set_state(user_id, IDLE)
+                self._last_activity[user_id] = 0
+
+    def touch_poll(self, user_id):
+        """Long-poll request counts as both presence and activity"""
+        with self._lock:
+            now = time.time()
+            self._last_poll[user_id] = now
+            self._last_activity[user_id] = now
+            self._set_state(user_id, ONLINE)
+
+    def is_polling(self, user_id):
+        """True if the user has an HTTP long-poll client (a poll within `poll_grace` seconds)"""
+        with self._lock:
+            return time.time() - self._last_poll.get(user_id, 0) < self.poll_grace
+
+    def sweep(self):
+        """Apply time-based transitions (online -> idle -> offline) for every tracked user"""
+        now = time.time()
+        with self._lock:
+            for user_id in list(self._states):
+                state = self._compute(user_id, now)
+                self._set_state(user_id, state)
+                if state == OFFLINE:
+                    # Nothing left to time out; keep the maps bounded by live users
+                    self._states.pop(user_id, None)
+                    self._last_activity.pop(user_id, None)
+                    self._last_poll.pop(user_id, None)
+            self.stats['tracked_users'] = len(self._states)
+
+    def drain_changes(self):
+        """{user_id: state} changed since the last drain (flaps that end where they started are dropped)"""
+        with self._lock:
+            pending, self._pending = self._pending, {}
+            changes = {}
+            for user_id, state in pending.items():
+                if self._published.get(user_id, OFFLINE) == state:
+                    self.stats['coalesced'] += 1
+                    continue
+                changes[user_id] = state
+                if state == OFFLINE:
+                    self._published.pop(user_id, None)
+                else:
+                    self._published[user_id] = state
+        if changes:
+            self.stats['batches'] += 1
+        return changes
+
+    def get_state(self, user_id):
+        with self._lock:
+            return self._states.get(user_id, OFFLINE)
@@ -0,0 +1,254 @@
+"""Named SQL catalog: statements are prepared once per pooled connection and executed by name."""
+
+import contextlib
+import itertools
+import re
+import threading
+import time
+
+import psycopg2
+import psycopg2.extensions
+
+# Every statement the server runs on the hot path, by name. Placeholders are psycopg2 %s;
+# they are rewritten to $1..$n for PREPARE.
+QUERIES = {
+    # users
+    'users.count': "SELECT COUNT(*) FROM users",
+    'users.list': "SELECT user_id, username FROM users ORDER BY username",
+    'users.insert': "INSERT INTO users (username, password_hash) VALUES (%s, %s) RETURNING user_id",
+    'users.login': "SELECT user_id, username, password_hash FROM users WHERE username = %s",
+    'users.by_username': "SELECT user_id, username FROM users WHERE username = %s",
+    'users.id_by_username': "SELECT user_id FROM users WHERE username = %s",
+    'users.username_by_id': "SELECT username FROM users WHERE user_id = %s",
+    # NOT EXISTS plans as an anti-join on the friendships primary key (NOT IN cannot, because of NULLs)
+    'users.not_friends': """
+        SELECT u.user_id, u.username
+        FROM users u
+        WHERE u.user_id != %s
+          AND NOT EXISTS (
+            SELECT 1 FROM friendships f
+            WHERE f.user_id = %s AND f.friend_id = u.user_id AND f.status = 'accepted'
+          )
+        ORDER BY u.username
+    """,
+
+    # friendships
+    'friends.list': """
+        SELECT f.friend_id, u.username, f.created_at
+        FROM friendships f
+        JOIN users u ON f.friend_id = u.user_id
+        WHERE f.user_id = %s AND f.status = 'accepted'
+        ORDER BY u.username
+    """,
+    'friends.ids': "SELECT friend_id FROM friendships WHERE user_id = %s AND status = 'accepted'",
+    'friends.status': "SELECT status FROM friendships WHERE user_id = %s AND friend_id = %s",
+    'friends.insert_pair': """
+        INSERT INTO friendships (user_id, friend_id, status)
+        VALUES (%s, %s, 'accepted'), (%s, %s, 'accepted')
+    """,
+
+    # rooms & members
+    'rooms.by_private_pair': "SELECT room_id FROM rooms WHERE private_pair = %s",
+    'rooms.insert_private': """
+        INSERT INTO rooms (type, private_pair) VALUES ('private', %s)
+        ON CONFLICT (private_pair) WHERE private_pair IS NOT NULL DO NOTHING
+        RETURNING room_id
+    """,
+    'rooms.insert_group': "INSERT INTO rooms (type, room_name) VALUES ('group', %s) RETURNING room_id",
+    'rooms.private_of_user': """
+        SELECT r.room_id
+        FROM rooms r
+        JOIN room_members rm ON r.room_id = rm.room_id
+        WHERE rm.user_id = %s AND r.type = 'private'
+    """,
+    # Peers are only joined for private rooms, so group rooms cost one row each
+    'rooms.inbox_of_user': """
+        SELECT rm.room_id, r.type, r.room_name, peer.user_id, u.username
+        FROM room_members rm
+        JOIN rooms r ON r.room_id = rm.room_id
+        LEFT JOIN room_members peer
+               ON peer.room_id = rm.room_id AND peer.user_id <> rm.user_id AND r.type = 'private'
+        LEFT JOIN users u ON u.user_id = peer.user_id
+        WHERE rm.user_id = %s
+    """,
+    'rooms.member_details': """
+        SELECT r.type, r.room_name, rm.user_id, u.username, rm.role
+        FROM rooms r
+        JOIN room_members rm ON rm.room_id = r.room_id
+        JOIN users u ON u.user_id = rm.user_id
+        WHERE r.room_id = %s
+        ORDER BY u.username
+    """,
+    'room_members.by_room': """
+        SELECT rm.user_id, u.username
+        FROM room_members rm
+        JOIN users u ON u.user_id = rm.user_id
+        WHERE rm.room_id = %s
+    """,
+    'room_members.role': "SELECT role FROM room_members WHERE room_id = %s AND user_id = %s",
+    'room_members.insert_pair': "INSERT INTO room_members (room_id, user_id) VALUES (%s, %s), (%s, %s)",
+    'room_members.insert_admin': "INSERT INTO room_members (room_id, user_id, role) VALUES (%s, %s, 'admin')",
+    'room_members.insert_many': """
+        INSERT INTO room_members (room_id, user_id, role)
+        SELECT %s, user_id, 'member' FROM users WHERE user_id = ANY(%s)
+        ON CONFLICT (room_id, user_id) DO NOTHING
+        RETURNING user_id
+    """,
+    'room_members.delete': "DELETE FROM room_members WHERE room_id = %s AND user_id = %s",
+}
+
+
+def to_positional(sql):
+    """Rewrite %s placeholders to $1..$n; returns (sql, parameter count)"""
+    counter = itertools.count(1)
+    positional = re.sub(r'%s', lambda match: f"${next(counter)}", sql)
+    return positional, next(counter) - 1
+
+
+def statement_name(name):
+    """SQL identifier for a catalog name ('users.login' -> 'q_users_login')"""
+    return 'q_' + re.sub(r'\W', '_', name)
+
+
+class CatalogConnection(psycopg2.extensions.connection):
+    """psycopg2 connection that remembers which catalog statements it has prepared"""
+
+    def __init__(self, *args, **kwargs):
+        super().__init__(*args, **kwargs)
+        self.prepared = set()
+
+
+class CatalogSession:
+    """One transaction on one pooled connection; statements are run by catalog name"""
+
+    def __init__(self, catalog, conn, cursor):
+        self.catalog = catalog
+        self.conn = conn
+        self.cursor = cursor
+
+    def execute(self, name, params=()):
+        """Run a catalog statement; returns the cursor (fetchone/fetchall/rowcount)"""
+        sql, positional, param_count = self.catalog.statements[name]
+        started = time.perf_counter()
+        try:
+            if self.catalog.prepare:
+                if name not in self.conn.prepared:
+                    self.cursor.execute(f"PREPARE {statement_name(name)} AS {positional}")
+                    self.conn.prepared.add(name)
+                    self.catalog.record_prepare()
+                placeholders = f" ({', '.join(['%s'] * param_count)})" if param_count else ''
+                self.cursor.execute(f"EXECUTE {statement_name(name)}{placeholders}", params)
+            else:
+                self.cursor.execute(sql, params)
+        except Exception:
+            self.catalog.record(name, time.perf_counter() - started, 0, failed=True)
+            raise
+        self.catalog.record(name, time.perf_counter() - started, max(self.cursor.rowcount, 0))
+        return self.cursor
+
+    def fetchone(self, name, params=()):
+        return self.execute(name, params).fetchone()
+
+    def fetchall(self, name, params=()):
+        return self.execute(name, params).fetchall()
+
+
+class QueryCatalog:
+    """Connection pool + named statements + per-statement metrics.
+
+    With prepare=True each connection PREPAREs a statement the first time it runs it and
+    EXECUTEs it by name afterwards (no re-parse / re-plan). Turn it off behind transaction
+    poolers such as PgBouncer, where consecutive transactions may land on different
+    server connections.
+    """
+
+    def __init__(self, db_config, queries=QUERIES, prepare=True, minconn=1, maxconn=10):
+        self.db_config = db_config
+        self.prepare = prepare
+        self.minconn = minconn
+        self.maxconn = maxconn
+        self.statements = {name: (sql, *to_positional(sql)) for name, sql in queries.items()}
+        self._pool = None
+        self._pool_lock = threading.Lock()
+        # ThreadedConnectionPool raises PoolError when exhausted; executor threads beyond
+        # maxconn wait here for a free connection instead
+        self._slots = threading.BoundedSemaphore(maxconn)
+        self._stats_lock = threading.Lock()
+        self.stats = {'prepared_statements': prepare, 'prepares': 0, 'statements': {}}
+
+    def _get_pool(self):
+        # Created on first use so importing the server never opens connections
+        if self._pool is None:
+            with self._pool_lock:
+                if self._pool is None:
+                    from psycopg2 import pool
+                    self._pool = pool.ThreadedConnectionPool(
+                        self.minconn, self.maxconn, connection_factory=CatalogConnection, **self.db_config
+                    )
+        return self._pool
+
+    def record_prepare(self):
+        with self._stats_lock:
+            self.stats['prepares'] += 1
+
+    def record(self, name, elapsed, rows, failed=False):
+        elapsed_ms = elapsed * 1000
+        with self._stats_lock:
+            entry = self.stats['statements'].get(name)
+            if entry is None:
+                entry = self.stats['statements'][name] = {
+                    'calls': 0, 'errors': 0, 'rows': 0, 'total_ms': 0.0, 'avg_ms': 0.0, 'max_ms': 0.0
+                }
+            entry['calls'] += 1
+            entry['rows'] += rows
+            entry['errors'] += int(failed)
+            entry['total_ms'] = round(entry['total_ms'] + elapsed_ms, 3)
+            entry['avg_ms'] = round(entry['total_ms'] / entry['calls'], 3)
+            entry['max_ms'] = round(max(entry['max_ms'], elapsed_ms), 3)
+
+    @contextlib.contextmanager
+    def transaction(self):
+        """Yield a CatalogSession; commits on success, rolls back on error"""
+        pool = self._get_pool()
+        with self._slots:
+            conn = pool.getconn()
+            try:
+                with conn.cursor() as cursor:
+                    yield CatalogSession(self, conn, cursor)
+                conn.commit()
+            except Exception:
+                self._recover(conn)
+                raise
+            finally:
+                pool.putconn(conn, close=bool(conn.closed))
+
+    def _recover(self, conn):
+        """Roll back; drop this connection's prepared statements so they are re-created cleanly"""
+        if conn.closed:
+            return
+        try:
+            conn.rollback()
+            if conn.prepared:
+                with conn.cursor() as cursor:
+                    cursor.execute("DEALLOCATE ALL")
+                conn.commit()
+                conn.prepared.clear()
+        except Exception:
+            conn.close()
+
+    def fetchone(self, name, params=()):
+        with self.transaction() as session:
+            return session.fetchone(name, params)
+
+    def fetchall(self, name, params=()):
+        with self.transaction() as session:
+            return session.fetchall(name, params)
+
+    def execute(self, name, params=()):
+        """Run a write statement in its own transaction; returns the row count"""
+        with self.transaction() as session:
+            return session.execute(name, params).rowcount
+
+    def close(self):
+        if self._pool is not None:
+            self._pool.closeall()
@@ -0,0 +1,206 @@
+"""EXPLAIN (ANALYZE) regression check for every statement in query_catalog.QUERIES.
+
+Seeds a scratch schema on a local PostgreSQL with a realistic data volume, runs each
+catalogued statement with EXPLAIN (ANALYZE) and fails when a plan falls back to a
+sequential scan on a large table or exceeds its latency budget.
+
+    python query_perf_check.py            # exit status 1 on any regression
+
+Connection: PERF_PG_HOST/PERF_PG_PORT/PERF_PG_DB/PERF_PG_USER/PERF_PG_PASSWORD.
+Never point it at the production database: the scratch schema is dropped and re-created.
+"""
+
+import json
+import os
+import sys
+import time
+
+import psycopg2
+
+from migrations import run_migrations
+from query_catalog import QUERIES
+
+PERF_SCHEMA = os.environ.get('PERF_SCHEMA', 'perf_check')
+PERF_USERS = int(os.environ.get('PERF_USERS', '100000'))
+PERF_FRIENDS_PER_USER = int(os.environ.get('PERF_FRIENDS_PER_USER', '10'))  # 1M friendships by default
+PERF_GROUP_ROOMS = int(os.environ.get('PERF_GROUP_ROOMS', '1000'))
+PERF_GROUP_SIZE = int(os.environ.get('PERF_GROUP_SIZE', '50'))
+PERF_BUDGET_MS = float(os.environ.get('PERF_BUDGET_MS', '20'))
+PERF_LARGE_TABLE_ROWS = int(os.environ.get('PERF_LARGE_TABLE_ROWS', '10000'))  # seq scans below this are fine
+
+# Friend k of user i is user (i + k * FRIEND_STRIDE) mod N, so every user has the same fan-out
+FRIEND_STRIDE = 7919
+
+# Private room r holds users 2r-1 and 2r; group rooms follow, group g holding a run of
+# PERF_GROUP_SIZE consecutive users (the first one admin)
+PRIVATE_ROOMS = PERF_USERS // 2
+FIRST_GROUP_ROOM = PRIVATE_ROOMS + 1
+
+# Sample parameters per statement. Writes run inside a rolled-back transaction, so they
+# must not collide with seeded rows: users 1 and 2 share private room 1, user 1 is the admin of
+# the first group room, the last dozen users are in no group and user 3 is not a friend of user 1.
+PARAMS = {
+    'users.count': (),
+    'users.list': (),
+    'users.insert': ('perf_new_user', 'x'),
+    'users.login': ('user_500',),
+    'users.by_username': ('user_500',),
+    'users.id_by_username': ('user_500',),
+    'users.username_by_id': (500,),
+    'users.not_friends': (1, 1),
+    'friends.list': (1,),
+    'friends.ids': (1,),
+    'friends.status': (1, 1 + FRIEND_STRIDE),
+    'friends.insert_pair': (1, 3, 3, 1),
+    'rooms.by_private_pair': ('1:2',),
+    'rooms.insert_private': ('1:3',),
+    'rooms.insert_group': ('perf group',),
+    'rooms.private_of_user': (1,),
+    'rooms.inbox_of_user': (1,),
+    'rooms.member_details': (FIRST_GROUP_ROOM,),
+    'room_members.by_room': (1,),
+    'room_members.role': (FIRST_GROUP_ROOM, 1),
+    'room_members.insert_pair': (FIRST_GROUP_ROOM, PERF_USERS - 1, FIRST_GROUP_ROOM, PERF_USERS),
+    'room_members.insert_admin': (FIRST_GROUP_ROOM, PERF_USERS - 2),
+    'room_members.insert_many': (FIRST_GROUP_ROOM, list(range(PERF_USERS - 12, PERF_USERS - 2))),
+    'room_members.delete': (FIRST_GROUP_ROOM, 1),
+}
+
+# Statements that read a whole table by design: (allowed seq-scan tables, budget in ms)
+FULL_TABLE = {
+    'users.count': ({'users'}, 200),
+    'users.list': ({'users'}, 500),
+    'users.not_friends': ({'users'}, 500),
+}
+
+
+def perf_db_config():
+    return {
+        'host': os.environ.get('PERF_PG_HOST', 'localhost'),
+        'port': int(os.environ.get('PERF_PG_PORT', '5432')),
+        'database': os.environ.get('PERF_PG_DB', 'postgres'),
+        'user': os.environ.get('PERF_PG_USER', 'postgres'),
+        'password': os.environ.get('PERF_PG_PASSWORD', ''),
+    }
+
+
+def seed(conn):
+    """Fresh schema at the latest migration, filled with generate_series (server-side, no round trips)"""
+    with conn.cursor() as cursor:
+        cursor.execute(f"DROP SCHEMA IF EXISTS {PERF_SCHEMA} CASCADE")
+        cursor.execute(f"CREATE SCHEMA {PERF_SCHEMA}")
+        cursor.execute(f"SET search_path TO {PERF_SCHEMA}")
+    conn.commit()
+    run_migrations(conn)
+
+    started = time.perf_counter()
+    with conn.cursor() as cursor:
+        cursor.execute("""
+            INSERT INTO users (user_id, username, password_hash)
+            SELECT i, 'user_' || i, 'x' FROM generate_series(1, %s) AS i
+        """, (PERF_USERS,))
+        cursor.execute("""
+            INSERT INTO friendships (user_id, friend_id, status)
+            SELECT i, ((i - 1 + k * %s) %% %s) + 1, 'accepted'
+            FROM generate_series(1, %s) AS i, generate_series(1, %s) AS k
+        """, (FRIEND_STRIDE, PERF_USERS, PERF_USERS, PERF_FRIENDS_PER_USER))
+        cursor.execute("""
+            INSERT INTO rooms (room_id, type, private_pair)
+            SELECT r, 'private', (2 * r - 1) || ':' || (2 * r) FROM generate_series(1, %s) AS r
+        """, (PRIVATE_ROOMS,))
+        cursor.execute("""
+            INSERT INTO room_members (room_id, user_id)
+            SELECT r, 2 * r - side FROM generate_series(1, %s) AS r, generate_series(0, 1) AS side
+        """, (PRIVATE_ROOMS,))
+        cursor.execute("""
+            INSERT INTO rooms (room_id, type, room_name)
+            SELECT %s + g, 'group', 'group_' || g FROM generate_series(0, %s) AS g
+        """, (FIRST_GROUP_ROOM, PERF_GROUP_ROOMS - 1))
+        cursor.execute("""
+            INSERT INTO room_members (room_id, user_id, role)
+            SELECT %s + g, ((g * %s + j) %% %s) + 1, CASE WHEN j = 0 THEN 'admin' ELSE 'member' END
+            FROM generate_series(0, %s) AS g, generate_series(0, %s) AS j
+        """, (FIRST_GROUP_ROOM, PERF_GROUP_SIZE, PERF_USERS - 2 * PERF_GROUP_SIZE,
+              PERF_GROUP_ROOMS - 1, PERF_GROUP_SIZE - 1))
+        cursor.execute("SELECT setval(pg_get_serial_sequence('users', 'user_id'), %s)", (PERF_USERS,))
+        cursor.execute("SELECT setval(pg_get_serial_sequence('rooms', 'room_id'), %s)",
+                       (FIRST_GROUP_ROOM + PERF_GROUP_ROOMS,))
+    conn.commit()
+
+    # Planner statistics, exactly what autovacuum would have after a while
+    conn.autocommit = True
+    with conn.cursor() as cursor:
+        cursor.execute("ANALYZE")
+    conn.autocommit = False
+    print(f"🌱 [PerfCheck] Seeded {PERF_USERS} users, {PERF_USERS * PERF_FRIENDS_PER_USER} friendships, "
+          f"{PRIVATE_ROOMS + PERF_GROUP_ROOMS} rooms in {time.perf_counter() - started:.1f}s")
+
+
+def table_sizes(conn):
+    with conn.cursor() as cursor:
+        cursor.execute("""
+            SELECT c.relname, c.reltuples
+            FROM pg_class c JOIN pg_namespace n ON n.oid = c.relnamespace
+            WHERE n.nspname = %s AND c.relkind = 'r'
+        """, (PERF_SCHEMA,))
+        return dict(cursor.fetchall())
+
+
+def plan_nodes(node):
+    yield node
+    for child in node.get('Plans', ()):
+        yield from plan_nodes(child)
+
+
+def explain(conn, sql, params):
+    """EXPLAIN (ANALYZE) one statement inside a transaction that is always rolled back"""
+    try:
+        with conn.cursor() as cursor:
+            cursor.execute(f"EXPLAIN (ANALYZE, BUFFERS, FORMAT JSON) {sql}", params)
+            return cursor.fetchone()[0][0]
+    finally:
+        conn.rollback()
+
+
+def check_queries(conn, queries=QUERIES):
+    """Returns a list of failure strings (empty when every plan is within limits)"""
+    sizes = table_sizes(conn)
+    large = {table for table, rows in sizes.items() if rows >= PERF_LARGE_TABLE_ROWS}
+    failures = []
+    for name, sql in queries.items():
+        if name not in PARAMS:
+            failures.append(f"{name}: no sample parameters in query_perf_check.PARAMS")
+            continue
+        allowed, budget_ms = FULL_TABLE.get(name, (set(), PERF_BUDGET_MS))
+        plan = explain(conn, sql, PARAMS[name])
+        seq_scans = sorted({
+            node['Relation Name'] for node in plan_nodes(plan['Plan'])
+            if node['Node Type'] == 'Seq Scan' and node['Relation Name'] in large - allowed
+        })
+        elapsed_ms = plan['Planning Time'] + plan['Execution Time']
+
+        problems = []
+        if seq_scans:
+            problems.append(f"seq scan on {', '.join(seq_scans)}")
+        if elapsed_ms > budget_ms:
+            problems.append(f"{elapsed_ms:.1f}ms > {budget_ms:.0f}ms budget")
+        if problems:
+            failures.append(f"{name}: {'; '.join(problems)}")
+            print(f"❌ [PerfCheck] {name:28} {elapsed_ms:8.2f}ms  {'; '.join(problems)}")
+            print(json.dumps(plan['Plan'], indent=2))
+        else:
+            print(f"✅ [PerfCheck] {name:28} {elapsed_ms:8.2f}ms")
+    return failures
+
+
+if __name__ == '__main__':
+    conn = psycopg2.connect(**perf_db_config())
+    try:
+        seed(conn)
+        failures = check_queries(conn)
+    finally:
+        conn.close()
+    if failures:
+        print(f"❌ [PerfCheck] {len(failures)} of {len(QUERIES)} statements regressed")
+        sys.exit(1)
+    print(f"✅ [PerfCheck] All {len(QUERIES)} statements use indexes and fit their budgets")
@@ -0,0 +1,121 @@
+"""Token-bucket ingest limits per user and per IP (message count and bytes, media separately)."""
+
+import threading
+import time
+
+
+class TokenBucket:
+    """Refills `rate` tokens per second up to `capacity`; may go into debt when reserving"""
+
+    __slots__ = ('rate', 'capacity', 'tokens', 'updated')
+
+    def __init__(self, rate, capacity, now):
+        self.rate = rate
+        self.capacity = capacity
+        self.tokens = capacity
+        self.updated = now
+
+    def refill(self, now):
+        self.tokens = min(self.capacity, self.tokens + (now - self.updated) * self.rate)
+        self.updated = now
+
+    def wait_time(self, amount):
+        """Seconds until `amount` tokens are available (0 = now)"""
+        # A single frame bigger than the burst can never fit; treat a full bucket as enough
+        amount = min(amount, self.capacity)
+        if self.tokens >= amount:
+            return 0.0
+        return (amount - self.tokens) / self.rate if self.rate > 0 else float('inf')
+
+
+class IngestLimiter:
+    """Per-user and per-IP buckets for messages/s and bytes/s, with separate media buckets.
+
+    limits: {kind: (rate_per_second, burst)} for kinds 'messages', 'bytes',
+    'media_messages' and 'media_bytes'. IP buckets get `ip_multiplier` times the
+    user limits (several accounts can share one NAT address).
+    """
+
+    def __init__(self, limits, ip_multiplier=4, idle_prune_seconds=300):
+        self.limits = limits
+        self.ip_multiplier = ip_multiplier
+        self.idle_prune_seconds = idle_prune_seconds
+        self._buckets = {}  # (scope, key, kind) -> TokenBucket
+        self._lock = threading.Lock()
+        self._checks = 0
+        self.stats = {
+            'allowed': 0,
+            'throttled_ws': 0,
+            'throttled_http': 0,
+            'throttle_seconds': 0.0,
+            'throttled_by_kind': {kind: 0 for kind in limits}
+        }
+
+    def _bucket(self, scope, key, kind, now):
+        bucket = self._buckets.get((scope, key, kind))
+        if bucket is None:
+            rate, burst = self.limits[kind]
+            if scope == 'ip':
+                rate, burst = rate * self.ip_multiplier, burst * self.ip_multiplier
+            bucket = self._buckets[(scope, key, kind)] = TokenBucket(rate, burst, now)
+        else:
+            bucket.refill(now)
+        return bucket
+
+    def _demands(self, user_id, ip, size, is_media, now):
+        count_kind, bytes_kind = ('media_messages', 'media_bytes') if is_media else ('messages', 'bytes')
+        demands = []
+        for scope, key in (('user', user_id), ('ip', ip)):
+            if key is None:
+                continue
+            demands.append((self._bucket(scope, key, count_kind, now), count_kind, 1))
+            demands.append((self._bucket(scope, key, bytes_kind, now), bytes_kind, size))
+        return demands
+
+    def _maybe_prune(self, now):
+        self._checks += 1
+        if self._checks % 1000:
+            return
+        for key, bucket in list(self._buckets.items()):
+            if now - bucket.updated > self.idle_prune_seconds:
+                del self._buckets[key]
+
+    def reserve(self, user_id, ip, size, is_media=False):
+        """Always consume (buckets may go negative) and return how long the caller should
+        pause before reading more from this client. Used for WebSocket backpressure."""
+        now = time.monotonic()
+        with self._lock:
+            self._maybe_prune(now)
+            delay, limited_kind = 0.0, None
+            for bucket, kind, amount in self._demands(user_id, ip, size, is_media, now):
+                wait = bucket.wait_time(amount)
+                if wait > delay:
+                    delay, limited_kind = wait, kind
+                bucket.tokens -= min(amount, bucket.capacity)
+            if delay > 0:
+                self.stats['throttled_ws'] += 1
+                self.stats['throttle_seconds'] = round(self.stats['throttle_seconds'] + delay, 3)
+                self.stats['throttled_by_kind'][limited_kind] += 1
+            else:
+                self.stats['allowed'] += 1
+        return delay
+
+    def try_acquire(self, user_id, ip, size, is_media=False):
+        """Consume only if every bucket has room; returns 0 on success or the retry-after seconds"""
+        now = time.monotonic()
+        with self._lock:
+            self._maybe_prune(now)
+            demands = self._demands(user_id, ip, size, is_media, now)
+            retry_after, limited_kind = 0.0, None
+            for bucket, kind, amount in demands:
+                wait = bucket.wait_time(amount)
+                if wait > retry_after:
+                    retry_after, limited_kind = wait, kind
+            if retry_after > 0:
+                self.stats['throttled_http'] += 1
+                self.stats['throttled_by_kind'][limited_kind] += 1
+                return retry_after
+            for bucket, kind, amount in demands:
+                bucket.tokens -= min(amount, bucket.capacity)
+            self.stats['allowed'] += 1
+        return 0.0
@@ -0,0 +1,89 @@
+"""Read cursors (last read message id per user/room) and throttled read-receipt fan-out."""
+
+import threading
+from collections import defaultdict
+
+
+class ReadCursorTracker:
+    """Keeps one monotonic cursor per (user, room) and writes changes back in batches"""
+
+    def __init__(self, store):
+        self.store = store
+        self._cursors = {}  # user_id -> {room_id: last_read_id}
+        self._dirty = {}    # (user_id, room_id) -> last_read_id
+        self._lock = threading.Lock()
+        self.stats = {'acks': 0, 'advanced': 0, 'flushed': 0}
+
+    def get_user_cursors(self, user_id):
+        """All cursors of a user ({room_id: last_read_id}), loaded from the store once"""
+        with self._lock:
+            cursors = self._cursors.get(user_id)
+        if cursors is None:
+            loaded = self.store.load_read_cursors(user_id)
+            with self._lock:
+                cursors = self._cursors.setdefault(user_id, loaded)
+        return dict(cursors)
+
+    def advance(self, user_id, room_id, message_id):
+        """Move a cursor forward; returns True if it moved (acks never go backwards)"""
+        room_id = str(room_id)
+        self.get_user_cursors(user_id)
+        with self._lock:
+            self.stats['acks'] += 1
+            cursors = self._cursors[user_id]
+            if message_id <= cursors.get(room_id, 0):
+                return False
+            cursors[room_id] = message_id
+            self._dirty[(user_id, room_id)] = message_id
+            self.stats['advanced'] += 1
+            return True
+
+    def flush(self):
+        """Persist dirty cursors in one store call (runs in an executor)"""
+        with self._lock:
+            dirty, self._dirty = self._dirty, {}
+        if not dirty:
+            return 0
+        try:
+            self.store.save_read_cursors([(user_id, room_id, last_read_id)
+                                          for (user_id, room_id), last_read_id in dirty.items()])
+        except Exception:
+            with self._lock:
+                for key, value in dirty.items():
+                    if value > self._dirty.get(key, 0):
+                        self._dirty[key] = value
+            raise
+        self.stats['flushed'] += len(dirty)
+        return len(dirty)
+
+
+class ReceiptThrottler:
+    """Coalesces read receipts per recipient and pushes them at most once per interval"""
+
+    def __init__(self):
+        # recipient_user_id -> room_id -> reader_user_id -> last_read_id
+        self._pending = defaultdict(lambda: defaultdict(dict))
+        self.stats = {'queued': 0, 'pushed_frames': 0}
+
+    def queue(self, recipient_ids, room_id, reader_id, last_read_id):
+        room_id = str(room_id)
+        for recipient_id in recipient_ids:
+            if recipient_id == reader_id:
+                continue
+            readers = self._pending[recipient_id][room_id]
+            if last_read_id > readers.get(reader_id, 0):
+                readers[reader_id] = last_read_id
+                self.stats['queued'] += 1
+
+    def drain(self):
+        """{recipient_id: [receipt, ...]} accumulated since the last drain"""
+        pending, self._pending = self._pending, defaultdict(lambda: defaultdict(dict))
+        receipts = {}
+        for recipient_id, rooms in pending.items():
+            receipts[recipient_id] = [
+                {'room_id': room_id, 'reader_id': reader_id, 'last_read_id': last_read_id}
+                for room_id, readers in rooms.items()
+                for reader_id, last_read_id in readers.items()
+            ]
+        self.stats['pushed_frames'] += len(receipts)
+        return receipts
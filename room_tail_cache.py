@@ -0,0 +1,236 @@
+"""Write-through cache of the newest messages per room in front of a MessageStore."""
+
+import threading
+from collections import OrderedDict, deque
+
+from message_store import MessageStore, encode_record
+
+
+class RoomTailCache(MessageStore):
+    """Keeps the last `tail_size` messages of recently used rooms in memory.
+
+    Rooms are loaded on the first "latest page" read and then kept current by save_many
+    (write-through), so "open chat, see latest" is served without touching the store.
+    Each cached message is kept with its encoded record (encode_record), computed once
+    when it enters the cache, so fragment reads are plain string joins.
+    Rooms are evicted least-recently-used once `max_rooms` or `max_bytes` is exceeded.
+    Reads the tail cannot answer (full history, pages older than the tail) go to the store.
+    """
+
+    def __init__(self, store, tail_size=100, max_rooms=10000, max_bytes=64 * 1024 * 1024):
+        self.store = store
+        self.name = f"{store.name}+tail_cache"
+        self.tail_size = max(tail_size, 1)
+        self.max_rooms = max_rooms
+        self.max_bytes = max_bytes
+        self._lock = threading.Lock()
+        # room_id -> {'items': deque of (message, fragment), 'bytes': int, 'complete': bool}
+        # complete = the tail holds the room's entire history (short rooms, empty rooms)
+        self._rooms = OrderedDict()
+        self._loading = {}  # room_id -> token of the in-flight load allowed to fill it
+        self._bytes = 0
+        self.stats = {
+            'hits': 0, 'misses': 0, 'bypass': 0, 'hit_rate': 0.0,
+            'fills': 0, 'evictions': 0, 'rooms': 0, 'bytes': 0
+        }
+
+    # --- bookkeeping (caller holds self._lock) ---
+
+    def _count(self, hits=0, misses=0, bypass=0):
+        self.stats['hits'] += hits
+        self.stats['misses'] += misses
+        self.stats['bypass'] += bypass
+        lookups = self.stats['hits'] + self.stats['misses']
+        self.stats['hit_rate'] = round(self.stats['hits'] / lookups, 4) if lookups else 0.0
+
+    def _sync_stats(self):
+        self.stats['rooms'] = len(self._rooms)
+        self.stats['bytes'] = self._bytes
+
+    def _evict(self):
+        while self._rooms and (len(self._rooms) > self.max_rooms or self._bytes > self.max_bytes):
+            _, entry = self._rooms.popitem(last=False)
+            self._bytes -= entry['bytes']
+            self.stats['evictions'] += 1
+
+    def _append(self, entry, message):
+        # Private copy: callers may keep mutating the dict they saved or received
+        message = dict(message)
+        fragment = encode_record(message)
+        entry['items'].append((message, fragment))
+        entry['bytes'] += len(fragment)
+        self._bytes += len(fragment)
+        while len(entry['items']) > self.tail_size:
+            _, dropped = entry['items'].popleft()
+            entry['bytes'] -= len(dropped)
+            self._bytes -= len(dropped)
+            entry['complete'] = False
+
+    def _lookup(self, room_id, limit, before_id):
+        """Cached (message, fragment) items answering a read, or None when the tail cannot"""
+        entry = self._rooms.get(room_id)
+        if entry is None:
+            return None
+        items = entry['items']
+        if before_id is not None:
+            items = [item for item in items if item[0].get('message_id', 0) < before_id]
+        if len(items) < limit and not entry['complete']:
+            # Part of the page is older than the tail
+            return None
+        self._rooms.move_to_end(room_id)
+        return list(items)[-limit:] if limit > 0 else []
+
+    # --- loading ---
+
+    def _begin_load(self, room_ids):
+        token = object()
+        with self._lock:
+            for room_id in room_ids:
+                self._loading[room_id] = token
+        return token
+
+    def _finish_load(self, token, tails):
+        """Install loaded tails unless a write to that room raced with the load"""
+        with self._lock:
+            for room_id, messages in tails.items():
+                if self._loading.get(room_id) is not token:
+                    continue
+                del self._loading[room_id]
+                if room_id in self._rooms:
+                    continue
+                entry = {'items': deque(), 'bytes': 0, 'complete': len(messages) < self.tail_size}
+                self._rooms[room_id] = entry
+                for message in messages:
+                    self._append(entry, message)
+                self.stats['fills'] += 1
+            self._evict()
+            self._sync_stats()
+
+    def _read_room(self, room_id, limit, before_id):
+        """(message, fragment) items for one room, or None when the read should go to the store"""
+        room_id = str(room_id)
+        if limit is None or limit > self.tail_size:
+            with self._lock:
+                self._count(bypass=1)
+            return None
+
+        with self._lock:
+            cached = self._lookup(room_id, limit, before_id)
+            self._count(hits=cached is not None, misses=cached is None)
+        if cached is not None or before_id is not None:
+            # Older history than the tail: read through without disturbing the cached tail
+            return cached
+
+        token = self._begin_load([room_id])
+        tail = self.store.get_room_messages(room_id, limit=self.tail_size)
+        self._finish_load(token, {room_id: tail})
+        with self._lock:
+            # Serve from the freshly installed entry so its fragments are reused
+            cached = self._lookup(room_id, limit, None)
+        if cached is not None:
+            return cached
+        return [(m, None) for m in tail[-limit:]] if limit > 0 else []
+
+    def _read_conversations(self, room_ids, limit_per_room):
+        """{room_id: items} like _read_room, with every miss loaded in one store call"""
+        if limit_per_room is None or limit_per_room > self.tail_size:
+            with self._lock:
+                self._count(bypass=len(room_ids))
+            return None
+
+        conversations, missing = {}, []
+        with self._lock:
+            for room_id in map(str, room_ids):
+                cached = self._lookup(room_id, limit_per_room, None)
+                if cached is None:
+                    missing.append(room_id)
+                elif cached:
+                    conversations[room_id] = cached
+            self._count(hits=len(room_ids) - len(missing), misses=len(missing))
+
+        if missing:
+            # Rooms the store omits are empty and get cached as such
+            token = self._begin_load(missing)
+            loaded = self.store.get_conversations(missing, limit_per_room=self.tail_size)
+            self._finish_load(token, {room_id: loaded.get(room_id, []) for room_id in missing})
+            with self._lock:
+                for room_id in missing:
+                    items = self._lookup(room_id, limit_per_room, None)
+                    if items is None:
+                        items = [(m, None) for m in loaded.get(room_id, [])[-limit_per_room:]]
+                    if items:
+                        conversations[room_id] = items
+        return conversations
+
+    # --- MessageStore interface ---
+
+    def save_many(self, records):
+        saved = self.store.save_many(records)
+        if saved is None:
+            saved = [message for _, message in records]
+        with self._lock:
+            for (room_id, _), message in zip(records, saved):
+                room_id = str(room_id)
+                entry = self._rooms.get(room_id)
+                if entry is None:
+                    # A load that started before this write would install a stale tail
+                    self._loading.pop(room_id, None)
+                    continue
+                self._append(entry, message)
+                self._rooms.move_to_end(room_id)
+            self._evict()
+            self._sync_stats()
+        return saved
+
+    def get_room_messages(self, room_id, limit=None, before_id=None):
+        items = self._read_room(room_id, limit, before_id)
+        if items is None:
+            return self.store.get_room_messages(room_id, limit=limit, before_id=before_id)
+        return [dict(message) for message, _ in items]
+
+    def get_conversations(self, room_ids, limit_per_room=None):
+        conversations = self._read_conversations(room_ids, limit_per_room)
+        if conversations is None:
+            return self.store.get_conversations(room_ids, limit_per_room=limit_per_room)
+        return {room_id: [dict(message) for message, _ in items] for room_id, items in conversations.items()}
+
+    def get_room_fragments(self, room_id, limit=None, before_id=None):
+        items = self._read_room(room_id, limit, before_id)
+        if items is None:
+            # The store's own fragment path (raw segment slices for the segment backend)
+            return self.store.get_room_fragments(room_id, limit=limit, before_id=before_id)
+        return [(message.get('message_id'), fragment or encode_record(message)) for message, fragment in items]
+
+    def get_conversation_fragments(self, room_ids, limit_per_room=None):
+        conversations = self._read_conversations(room_ids, limit_per_room)
+        if conversations is None:
+            return self.store.get_conversation_fragments(room_ids, limit_per_room=limit_per_room)
+        return {room_id: [fragment or encode_record(message) for message, fragment in items]
+                for room_id, items in conversations.items()}
+
+    def list_rooms(self):
+        return self.store.list_rooms()
+
+    def count_room(self, room_id):
+        return self.store.count_room(room_id)
+
+    def delete_through(self, room_id, message_id):
+        return self.store.delete_through(room_id, message_id)
+
+    def iter_room(self, room_id, batch_size=1000):
+        return self.store.iter_room(room_id, batch_size)
+
+    def find_by_client_msg_id(self, sender_id, client_msg_id):
+        return self.store.find_by_client_msg_id(sender_id, client_msg_id)
+
+    def load_read_cursors(self, user_id):
+        return self.store.load_read_cursors(user_id)
+
+    def save_read_cursors(self, cursors):
+        return self.store.save_read_cursors(cursors)
+
+    def count_unread(self, user_id, cursors):
+        return self.store.count_unread(user_id, cursors)
+
+    def close(self):
+        self.store.close()
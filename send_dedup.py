@@ -0,0 +1,81 @@
+"""Per-sender dedup window for client message ids (makes send retries idempotent)."""
+
+import asyncio
+import time
+from collections import OrderedDict
+
+
+class SendDedupWindow:
+    """Remembers the last `max_per_sender` client_msg_ids of each sender for `ttl_seconds`.
+
+    A retry of an id that is still in flight waits for the first attempt; a retry of
+    an id that already completed gets the saved message back without a second write.
+    Ids the window does not know (e.g. replayed after a server restart) are checked with
+    `lookup(sender_id, client_msg_id)`, a blocking store lookup run in the executor.
+    """
+
+    def __init__(self, max_per_sender=256, ttl_seconds=300, max_senders=10000, lookup=None):
+        self.lookup = lookup
+        self.max_per_sender = max_per_sender
+        self.ttl_seconds = ttl_seconds
+        self.max_senders = max_senders
+        self._windows = OrderedDict()  # sender_id -> OrderedDict(client_msg_id -> (future, created_at))
+        self.stats = {'accepted': 0, 'duplicates': 0, 'stored_duplicates': 0, 'evicted': 0}
+
+    def _window(self, sender_id):
+        window = self._windows.get(sender_id)
+        if window is None:
+            window = self._windows[sender_id] = OrderedDict()
+            while len(self._windows) > self.max_senders:
+                self._windows.popitem(last=False)
+        else:
+            self._windows.move_to_end(sender_id)
+        return window
+
+    def _expire(self, window, now):
+        while window:
+            client_msg_id, (future, created_at) = next(iter(window.items()))
+            if len(window) <= self.max_per_sender and now - created_at < self.ttl_seconds:
+                break
+            if not future.done():
+                break  # never drop an in-flight send, its retry must still find it
+            window.popitem(last=False)
+            self.stats['evicted'] += 1
+
+    async def submit(self, sender_id, client_msg_id, save):
+        """Run `save()` once per (sender, client_msg_id); returns (message, is_duplicate)"""
+        if not client_msg_id:
+            return await save(), False
+
+        now = time.time()
+        window = self._window(sender_id)
+        self._expire(window, now)
+        entry = window.get(client_msg_id)
+        if entry is not None:
+            self.stats['duplicates'] += 1
+            return await asyncio.shield(entry[0]), True
+
+        loop = asyncio.get_running_loop()
+        future = loop.create_future()
+        window[client_msg_id] = (future, now)
+        try:
+            stored = None
+            if self.lookup is not None:
+                stored = await loop.run_in_executor(None, self.lookup, sender_id, client_msg_id)
+            if stored is None:
+                message = await save()
+        except BaseException as e:
+            # Failed or cancelled sends are forgotten so the client's retry gets a real second attempt
+            window.pop(client_msg_id, None)
+            if isinstance(e, asyncio.CancelledError):
+                e = RuntimeError("Send was interrupted, please retry")
+            future.set_exception(e)
+            future.exception()  # mark retrieved; waiting retries re-raise it themselves
+            raise
+        if stored is not None:
+            self.stats['stored_duplicates'] += 1
+            future.set_result(stored)
+            return stored, True
+        self.stats['accepted'] += 1
+        future.set_result(message)
+        return message, False
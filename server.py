@@ -16,40 +16,183 @@ import psycopg2
 import pytz
 import contextlib
 import base64
+import zlib
+import functools
+from wire_codec import PROTOCOL_JSON, negotiate_protocol, encode_frame, decode_frame, encode_batch, json_array, splice_json
+from message_batcher import MessageWriteBatcher
+from message_store import create_message_store
+from room_tail_cache import RoomTailCache
+from cold_archive import ColdArchive, TieredMessageStore
+from inbox import InboxIndex
+from read_receipts import ReadCursorTracker, ReceiptThrottler
+from send_dedup import SendDedupWindow
+from offline_mailbox import UserMailbox
+from presence import PresenceTracker
+from rate_limit import IngestLimiter
+from upload_store import UploadStore, UploadQuotaExceeded
+from outbound import LANE_CONTROL, LANE_CHAT, LANE_BULK, OutboundScheduler, ChunkAssembler
+from query_catalog import QueryCatalog
+from migrations import run_migrations, private_pair_key, LATEST_VERSION
+from subscriptions import SubscriptionRegistry, TOPIC_SYSTEM, room_topic, presence_topic, parse_topic, normalize_topic
 
 CHAT_LOG_FILE = 'chat_log.json'
-chat_log_lock = asyncio.Lock()
 
-def load_chat_log():
-    """Memuat data chat dari file JSON."""
-    try:
-        with open(CHAT_LOG_FILE, 'r') as f:
-            return json.load(f)
-    except (FileNotFoundError, json.JSONDecodeError):
-        # Jika file tidak ada atau rusak, kembalikan struktur default
-        return {"conversations": {}}
-
-def save_chat_log(data):
-    """Menyimpan data chat ke file JSON."""
-    with open(CHAT_LOG_FILE, 'w') as f:
-        json.dump(data, f, indent=4)
+# Message storage backend: 'json' (chat_log.json), 'sqlite' (WAL), 'postgres' (pooled) or 'segment' (mmap)
+MESSAGE_STORE_BACKEND = os.environ.get('MESSAGE_STORE_BACKEND', 'json')
+SQLITE_MESSAGE_DB = os.environ.get('SQLITE_MESSAGE_DB', 'chat_messages.db')
+SEGMENT_MESSAGE_DIR = os.environ.get('SEGMENT_MESSAGE_DIR', 'chat_segments')
+# Messages per room sent on connect / returned per history page
+HISTORY_PAGE_SIZE = int(os.environ.get('HISTORY_PAGE_SIZE', '50'))
+# In-memory tail of the newest messages per hot room (0 = off); must cover HISTORY_PAGE_SIZE + 1
+ROOM_TAIL_SIZE = int(os.environ.get('ROOM_TAIL_SIZE', str(2 * HISTORY_PAGE_SIZE)))
+ROOM_TAIL_MAX_ROOMS = int(os.environ.get('ROOM_TAIL_MAX_ROOMS', '10000'))
+ROOM_TAIL_MAX_BYTES = int(os.environ.get('ROOM_TAIL_MAX_BYTES', str(64 * 1024 * 1024)))
+
+# Cold archive: old history moves into compressed, immutable segments (reads fall through).
+# Off by default for postgres: its `messages` table is shared with Code_Client_WSS/server.py,
+# which reads it directly and would lose every archived row.
+ARCHIVE_ENABLED = os.environ.get('ARCHIVE_ENABLED', '0' if MESSAGE_STORE_BACKEND == 'postgres' else '1') == '1'
+ARCHIVE_DIR = os.environ.get('ARCHIVE_DIR', 'chat_archive')
+ARCHIVE_KEEP_RECENT = int(os.environ.get('ARCHIVE_KEEP_RECENT', '200'))  # newest messages per room always hot
+ARCHIVE_AFTER_DAYS = float(os.environ.get('ARCHIVE_AFTER_DAYS', '30'))
+ARCHIVE_MAX_HOT = int(os.environ.get('ARCHIVE_MAX_HOT', '5000'))  # per room, archived beyond this regardless of age
+ARCHIVE_INTERVAL = float(os.environ.get('ARCHIVE_INTERVAL', '3600'))  # seconds
+
+# Group commit: messages are persisted together every few ms (or every N messages)
+MESSAGE_BATCH_WINDOW_MS = int(os.environ.get('MESSAGE_BATCH_WINDOW_MS', '5'))
+MESSAGE_BATCH_MAX = int(os.environ.get('MESSAGE_BATCH_MAX', '100'))
+
+# Idempotent sends: client_msg_ids remembered per sender (last N ids, for TTL seconds)
+SEND_DEDUP_WINDOW = int(os.environ.get('SEND_DEDUP_WINDOW', '256'))
+SEND_DEDUP_TTL = int(os.environ.get('SEND_DEDUP_TTL', '300'))
+
+# Read receipts: pushes to senders are coalesced per interval, cursors are written back in batches
+RECEIPT_PUSH_INTERVAL = float(os.environ.get('RECEIPT_PUSH_INTERVAL', '1.0'))  # seconds
+READ_CURSOR_FLUSH_INTERVAL = float(os.environ.get('READ_CURSOR_FLUSH_INTERVAL', '2.0'))  # seconds
 
 # Database setup
 DATABASE_FILE = 'auth_bridge.db'
 JWT_SECRET = 'your-secret-key-change-in-production'  # Change this in production!
 
+# Durable offline mailbox (per-user queue for HTTP polling / reconnecting clients)
+MAILBOX_DB = os.environ.get('MAILBOX_DB', DATABASE_FILE)
+MAILBOX_RETENTION_HOURS = float(os.environ.get('MAILBOX_RETENTION_HOURS', '168'))  # 7 days
+MAILBOX_MAX_MESSAGES = int(os.environ.get('MAILBOX_MAX_MESSAGES', '5000'))  # per user
+MAILBOX_MAX_BYTES = int(os.environ.get('MAILBOX_MAX_BYTES', str(5 * 1024 * 1024)))  # per user, on disk
+MAILBOX_TAIL_SIZE = int(os.environ.get('MAILBOX_TAIL_SIZE', '100'))  # newest messages per user kept in memory
+MAILBOX_PURGE_INTERVAL = float(os.environ.get('MAILBOX_PURGE_INTERVAL', '300'))  # seconds
+
+# Uploads (uploads/images, uploads/files): reference index, per-user quotas and orphan sweeping
+UPLOAD_INDEX_DB = os.environ.get('UPLOAD_INDEX_DB', DATABASE_FILE)
+UPLOAD_QUOTA_BYTES = int(os.environ.get('UPLOAD_QUOTA_BYTES', str(1024 * 1024 * 1024)))  # per user, 0 = unlimited
+UPLOAD_RATE_BYTES_PER_HOUR = int(os.environ.get('UPLOAD_RATE_BYTES_PER_HOUR', str(512 * 1024 * 1024)))  # per user, 0 = off
+UPLOAD_RATE_FILES_PER_HOUR = int(os.environ.get('UPLOAD_RATE_FILES_PER_HOUR', '200'))  # per user, 0 = off
+UPLOAD_ORPHAN_GRACE = float(os.environ.get('UPLOAD_ORPHAN_GRACE', '3600'))  # seconds before an unreferenced file goes
+UPLOAD_SWEEP_INTERVAL = float(os.environ.get('UPLOAD_SWEEP_INTERVAL', '3600'))  # seconds
+
+# Presence: protocol-level pings drop dead sockets, app heartbeats/activity drive online -> idle
+WS_HEARTBEAT_INTERVAL = float(os.environ.get('WS_HEARTBEAT_INTERVAL', '30'))  # seconds, 0 = off
+PRESENCE_IDLE_AFTER = float(os.environ.get('PRESENCE_IDLE_AFTER', '120'))  # seconds without activity
+PRESENCE_POLL_GRACE = float(os.environ.get('PRESENCE_POLL_GRACE', '45'))  # long-poll gap before offline
+PRESENCE_BROADCAST_INTERVAL = float(os.environ.get('PRESENCE_BROADCAST_INTERVAL', '2.0'))  # seconds
+PRESENCE_FRIENDS_TTL = float(os.environ.get('PRESENCE_FRIENDS_TTL', '60'))  # friend list cache, seconds
+
+# Ingest rate limits (token buckets per user and per IP); media has its own buckets
+RATE_LIMIT_ENABLED = os.environ.get('RATE_LIMIT_ENABLED', '1') == '1'
+RATE_LIMITS = {
+    # kind: (tokens per second, burst)
+    'messages': (float(os.environ.get('RATE_MESSAGES_PER_SEC', '5')), float(os.environ.get('RATE_MESSAGES_BURST', '20'))),
+    'bytes': (float(os.environ.get('RATE_BYTES_PER_SEC', str(64 * 1024))), float(os.environ.get('RATE_BYTES_BURST', str(512 * 1024)))),
+    'media_messages': (float(os.environ.get('RATE_MEDIA_PER_SEC', '0.5')), float(os.environ.get('RATE_MEDIA_BURST', '5'))),
+    'media_bytes': (float(os.environ.get('RATE_MEDIA_BYTES_PER_SEC', str(1024 * 1024))), float(os.environ.get('RATE_MEDIA_BYTES_BURST', str(16 * 1024 * 1024)))),
+}
+RATE_LIMIT_IP_MULTIPLIER = float(os.environ.get('RATE_LIMIT_IP_MULTIPLIER', '4'))
+RATE_LIMIT_MAX_PAUSE = float(os.environ.get('RATE_LIMIT_MAX_PAUSE', '30'))  # seconds a socket may be paused per frame
+
+# Outbound priority lanes: control > chat > bulk, large bulk frames are chunked for clients that support it
+OUTBOUND_BULK_MIN_SIZE = int(os.environ.get('OUTBOUND_BULK_MIN_SIZE', str(64 * 1024)))  # bytes; bigger frames go to bulk
+OUTBOUND_CHUNK_SIZE = int(os.environ.get('OUTBOUND_CHUNK_SIZE', str(64 * 1024)))
+OUTBOUND_MAX_QUEUED_BYTES = int(os.environ.get('OUTBOUND_MAX_QUEUED_BYTES', str(32 * 1024 * 1024)))  # per connection
+CONTROL_MESSAGE_TYPES = ('auth_success', 'error', 'heartbeat', 'presence', 'read_receipts', 'message_sent',
+                         'subscribed', 'unsubscribed')
+BULK_MESSAGE_TYPES = ('previous_conversations', 'mailbox', 'older_messages', 'inbox')
+# Outbound coalescing: clients advertising "batch" get small frames packed into one batch frame
+OUTBOUND_BATCH_WINDOW_MS = float(os.environ.get('OUTBOUND_BATCH_WINDOW_MS', '5'))  # 0 = no wait, only batch what piled up
+OUTBOUND_BATCH_MAX_FRAMES = int(os.environ.get('OUTBOUND_BATCH_MAX_FRAMES', '64'))
+OUTBOUND_BATCH_MAX_BYTES = int(os.environ.get('OUTBOUND_BATCH_MAX_BYTES', str(64 * 1024)))
+OUTBOUND_BATCHING_ENABLED = os.environ.get('OUTBOUND_BATCHING_ENABLED', '1') == '1'
+# Group rooms: member lists are cached per room (invalidated by the membership APIs)
+ROOM_MEMBERS_TTL = float(os.environ.get('ROOM_MEMBERS_TTL', '300'))  # seconds
+GROUP_MAX_MEMBERS = int(os.environ.get('GROUP_MAX_MEMBERS', '1000'))
+
+# Topic subscriptions (room:<id>, presence:<user_id>, system) replace broadcast-to-everyone
+MAX_TOPICS_PER_CONNECTION = int(os.environ.get('MAX_TOPICS_PER_CONNECTION', '500'))
+INBOUND_BULK_QUEUE_SIZE = int(os.environ.get('INBOUND_BULK_QUEUE_SIZE', '4'))  # uploads waiting per connection
+INBOUND_CHUNK_MAX_BYTES = int(os.environ.get('INBOUND_CHUNK_MAX_BYTES', str(32 * 1024 * 1024)))  # reassembled upload cap
+
+# WebSocket permessage-deflate (negotiated per connection, clients opt in)
+WS_COMPRESSION_ENABLED = os.environ.get('WS_COMPRESSION_ENABLED', '1') == '1'
+# Metrics only: aiohttp deflates every frame once deflate is negotiated, there is no public
+# per-frame opt-out. Frames below this size (and media) are left out of the savings estimate.
+WS_COMPRESSION_METRICS_MIN_SIZE = int(os.environ.get('WS_COMPRESSION_METRICS_MIN_SIZE', '1024'))  # bytes
+# Fresh deflate context per frame (per-message compress=<wbits>): less memory per socket, worse ratio
+WS_COMPRESSION_NO_CONTEXT_TAKEOVER = os.environ.get('WS_COMPRESSION_NO_CONTEXT_TAKEOVER', '0') == '1'
+WS_COMPRESSION_SAMPLE_EVERY = int(os.environ.get('WS_COMPRESSION_SAMPLE_EVERY', '20'))  # estimate ratio on every Nth frame
+# Payloads that are already compressed gain nothing from deflate (excluded from the estimate)
+WS_PRECOMPRESSED_MIME_PREFIXES = (
+    'image/', 'video/', 'audio/',
+    'application/zip', 'application/gzip', 'application/x-7z', 'application/x-rar', 'application/pdf'
+)
+
+def classify_lane(message, frame_size):
+    """Pick the outbound lane for a message: acks/presence first, bulk for history and media"""
+    message_type = message.get('type') if isinstance(message, dict) else None
+    if message_type in CONTROL_MESSAGE_TYPES and frame_size < OUTBOUND_BULK_MIN_SIZE:
+        return LANE_CONTROL
+    if message_type in BULK_MESSAGE_TYPES or frame_size >= OUTBOUND_BULK_MIN_SIZE or is_precompressed_payload(message):
+        return LANE_BULK
+    return LANE_CHAT
+
+def is_precompressed_payload(message):
+    """True if the message carries already-compressed media bytes"""
+    if not isinstance(message, dict):
+        return False
+    inner = message.get('message') if isinstance(message.get('message'), dict) else message
+    if not inner.get('file_data'):
+        return False
+    mime_type = inner.get('mime_type') or ''
+    return mime_type.startswith(WS_PRECOMPRESSED_MIME_PREFIXES) or inner.get('message_type') == 'image'
+
+# PostgreSQL connection settings from env vars; host and password have no defaults
+DB_CONFIG = {
+    'host': os.environ.get('DB_HOST'),
+    'port': int(os.environ.get('DB_PORT', '5432')),
+    'database': os.environ.get('DB_NAME', "postgres"),
+    'user': os.environ.get('DB_USER', "postgres"),
+    'password': os.environ.get('DB_PASSWORD'),
+    'sslmode': os.environ.get('DB_SSLMODE', 'require')
+}
+_missing_db_settings = [name for name, key in (('DB_HOST', 'host'), ('DB_PASSWORD', 'password')) if not DB_CONFIG[key]]
+if _missing_db_settings:
+    raise SystemExit(f"❌ [DB] {' and '.join(_missing_db_settings)} must be set (e.g. DB_HOST=localhost DB_PASSWORD=...)")
+
+# Hot-path SQL goes through the named query catalog (pooled, optionally prepared, timed).
+# PREPARE is session state, which a transaction pooler (Supabase/PgBouncer on 6543) does not keep.
+DB_PREPARED_STATEMENTS = os.environ.get('DB_PREPARED_STATEMENTS', 'auto')  # auto / 1 / 0
+DB_POOL_MIN = int(os.environ.get('DB_POOL_MIN', '1'))
+DB_POOL_MAX = int(os.environ.get('DB_POOL_MAX', '10'))
+db_queries = QueryCatalog(
+    DB_CONFIG,
+    prepare=(DB_CONFIG['port'] != 6543) if DB_PREPARED_STATEMENTS == 'auto' else DB_PREPARED_STATEMENTS == '1',
+    minconn=DB_POOL_MIN,
+    maxconn=DB_POOL_MAX
+)
+
 def get_db_connection():
     """Get database connection"""
     try:
     #     # Coba PostgreSQL dulu
-        conn = psycopg2.connect(
-            host="aws-0-ap-southeast-1.pooler.supabase.com",
-            port=6543,                                 
-            database="postgres",                         
-            user="postgres.ziymoatadswbppsrsanr",         
-            password="Oriorion21!",      
-            sslmode='require'
-        )
+        conn = psycopg2.connect(**DB_CONFIG)
         return conn # , 'postgresql'
     except Exception as e:
         print(f"❌ Database connection error: {e}")
@@ -83,70 +226,16 @@ def get_db_cursor():
             conn.close()
 
 def init_database():
-    """Initialize SQLite database with users table"""
+    """Bring the PostgreSQL schema up to date (no DDL at all when it already is)"""
     conn = get_db_connection()
-    cursor = conn.cursor()
-    
-    # Create users table matching your schema
-    cursor.execute('''
-        CREATE TABLE IF NOT EXISTS users (
-            user_id SERIAL PRIMARY KEY,
-            username TEXT UNIQUE NOT NULL,
-            password_hash TEXT NOT NULL
-        )
-    ''')
-
-    # Create friendships table
-    cursor.execute('''
-        CREATE TABLE IF NOT EXISTS friendships (
-            user_id INTEGER NOT NULL,
-            friend_id INTEGER NOT NULL,
-            status TEXT NOT NULL,
-            created_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP,
-            PRIMARY KEY (user_id, friend_id),
-            FOREIGN KEY (user_id) REFERENCES users (user_id),
-            FOREIGN KEY (friend_id) REFERENCES users (user_id)
-        )
-    ''')
-
-    # Tabel untuk menyimpan informasi room
-    cursor.execute('''
-        CREATE TABLE IF NOT EXISTS rooms (
-            room_id SERIAL PRIMARY KEY,
-            type VARCHAR(50) NOT NULL, -- 'private' untuk 1-on-1, 'group' untuk grup
-            room_name VARCHAR(255),
-            created_at TIMESTAMPTZ DEFAULT CURRENT_TIMESTAMP
-        )
-    ''')
-
-    # Tabel untuk menyimpan anggota dari setiap room
-    cursor.execute('''
-        CREATE TABLE IF NOT EXISTS room_members (
-            room_id INTEGER NOT NULL,
-            user_id INTEGER NOT NULL,
-            role VARCHAR(50) DEFAULT 'member', -- bisa 'admin' atau 'member'
-            PRIMARY KEY (room_id, user_id),
-            FOREIGN KEY (room_id) REFERENCES rooms (room_id) ON DELETE CASCADE,
-            FOREIGN KEY (user_id) REFERENCES users (user_id) ON DELETE CASCADE
-        )
-    ''')
-    
-    # # Create sessions table for active sessions
-    # cursor.execute('''
-    #     CREATE TABLE IF NOT EXISTS user_sessions (
-    #         session_id TEXT PRIMARY KEY,
-    #         user_id INTEGER,
-    #         username TEXT,
-    #         created_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP,
-    #         expires_at TIMESTAMP,
-    #         is_active BOOLEAN DEFAULT TRUE,
-    #         FOREIGN KEY (user_id) REFERENCES users (user_id)
-    #     )
-    # ''')
-    
-    conn.commit()
-    conn.close()
-    # print(f"✅ Database initialized: {DATABASE_FILE}")
+    try:
+        applied = run_migrations(conn)
+    finally:
+        conn.close()
+    if applied:
+        print(f"✅ Database migrated to version {applied[-1]}")
+    else:
+        print(f"✅ Database schema current (version {LATEST_VERSION})")
 
 def verify_password(password, password_hash):
     """Verify password against hash"""
@@ -176,9 +265,22 @@ class AuthenticatedMessageBridge:
     def __init__(self):
         # Store active WebSocket connections with user info
         self.websocket_clients = {}  # {ws: {'user_id': int, 'username': str, 'session_id': str}}
+        self.user_sockets = defaultdict(set)  # user_id -> {ws}, so per-user sends skip the full scan
+        
+        # Topic subscriptions (publish cost scales with subscribers, not connections)
+        self.subscriptions = SubscriptionRegistry(max_topics_per_connection=MAX_TOPICS_PER_CONNECTION)
+        
+        # Mailbox persisten untuk setiap user (drained by mailbox_seq cursor)
+        self.mailbox = UserMailbox(
+            MAILBOX_DB,
+            retention_seconds=MAILBOX_RETENTION_HOURS * 3600,
+            max_messages_per_user=MAILBOX_MAX_MESSAGES,
+            max_bytes_per_user=MAILBOX_MAX_BYTES,
+            tail_size=MAILBOX_TAIL_SIZE
+        )
         
-        # Message queues untuk setiap user
-        self.user_message_queues = defaultdict(lambda: deque(maxlen=100))
+        # Presence (online / idle / offline) per user
+        self.presence = PresenceTracker(idle_after=PRESENCE_IDLE_AFTER, poll_grace=PRESENCE_POLL_GRACE)
         
         # HTTP clients yang sedang long-polling per user
         self.http_long_poll_clients = {}  # {client_id: {'future': future, 'user_id': int}}
@@ -189,8 +291,22 @@ class AuthenticatedMessageBridge:
             'active_websocket_clients': 0,
             'active_http_polls': 0,
             'registered_users': 0,
-            'active_sessions': 0
+            'active_sessions': 0,
+            'mailbox': self.mailbox.stats,
+            'presence': self.presence.stats,
+            'subscriptions': self.subscriptions.stats,
+            'queries': db_queries.stats,
+            'outbound': {},
+            'ws_compression': {
+                'frames_compressed': 0,
+                'frames_small': 0,
+                'frames_media': 0,
+                'bytes_before_compression': 0,
+                'estimated_ratio': 1.0,
+                'estimated_bytes_saved': 0
+            }
         }
+        self._compression_frames_seen = 0
         
         # Update stats on init
         self.update_user_stats()
@@ -198,62 +314,163 @@ class AuthenticatedMessageBridge:
     def update_user_stats(self):
         """Update user statistics from database"""
         try:
-            conn = get_db_connection()
-            cursor = conn.cursor()
-            
             # Count registered users
-            cursor.execute("SELECT COUNT(*) FROM users")
-            self.stats['registered_users'] = cursor.fetchone()[0]
+            self.stats['registered_users'] = db_queries.fetchone('users.count')[0]
             
             # Count active sessions
             # cursor.execute("SELECT COUNT(*) FROM user_sessions WHERE is_active = TRUE AND expires_at > ?", 
             #              (datetime.now(pytz.UTC),))
             # self.stats['active_sessions'] = cursor.fetchone()[0]
-            
-            conn.close()
         except Exception as e:
             print(f"❌ Error updating user stats: {e}")
     
-    def add_websocket_client(self, ws, user_id, username, session_id):
-        """Add authenticated WebSocket client"""
+    def add_websocket_client(self, ws, user_id, username, session_id, protocol=PROTOCOL_JSON, features=()):
+        """Add authenticated WebSocket client (with its own outbound priority scheduler)"""
+        features = set(features or ())
+        batching = OUTBOUND_BATCHING_ENABLED and 'batch' in features
         self.websocket_clients[ws] = {
             'user_id': user_id,
             'username': username,
             'session_id': session_id,
+            'protocol': protocol,
+            'features': features,
+            'outbound': OutboundScheduler(
+                write_fn=lambda frame, compressible: self._write_now(ws, frame, compressible),
+                encode_fn=lambda message: encode_frame(protocol, message),
+                chunk_size=OUTBOUND_CHUNK_SIZE,
+                chunking='chunks' in features,
+                max_queued_bytes=OUTBOUND_MAX_QUEUED_BYTES,
+                on_failure=lambda: self._drop_connection(ws),
+                stats=self.stats['outbound'],
+                batch_fn=(lambda frames: encode_batch(protocol, frames)) if batching else None,
+                batch_window=OUTBOUND_BATCH_WINDOW_MS / 1000.0,
+                batch_max_frames=OUTBOUND_BATCH_MAX_FRAMES,
+                batch_max_bytes=OUTBOUND_BATCH_MAX_BYTES
+            ),
             'connected_at': time.time()
         }
+        self.user_sockets[user_id].add(ws)
         self.stats['active_websocket_clients'] = len(self.websocket_clients)
-        print(f"🔌 WebSocket client connected: {username} (ID: {user_id})")
+        self.presence.connect(user_id)
+        print(f"🔌 WebSocket client connected: {username} (ID: {user_id}, protocol: {protocol})")
     
     def remove_websocket_client(self, ws):
         """Remove WebSocket client"""
         if ws in self.websocket_clients:
             user_info = self.websocket_clients[ws]
             del self.websocket_clients[ws]
+            sockets = self.user_sockets.get(user_info['user_id'])
+            if sockets is not None:
+                sockets.discard(ws)
+                if not sockets:
+                    del self.user_sockets[user_info['user_id']]
+            self.subscriptions.drop(ws)
+            user_info['outbound'].close()
             self.stats['active_websocket_clients'] = len(self.websocket_clients)
+            self.presence.disconnect(user_info['user_id'])
             print(f"🔌 WebSocket client disconnected: {user_info['username']}")
     
+    def _drop_connection(self, ws):
+        """Writer failed or client can't keep up: forget it and close the socket"""
+        self.remove_websocket_client(ws)
+        if not ws.closed:
+            asyncio.ensure_future(ws.close())
+    
     def get_user_from_ws(self, ws):
         """Get user info from WebSocket connection"""
         return self.websocket_clients.get(ws)
     
-    async def send_to_user_websockets(self, target_user_id, message, exclude_ws=None):
-        """Send message to specific user's WebSocket connections"""
+    def get_ws_protocol(self, ws):
+        """Get negotiated wire protocol for a WebSocket (JSON before auth)"""
+        user_info = self.websocket_clients.get(ws)
+        return user_info.get('protocol', PROTOCOL_JSON) if user_info else PROTOCOL_JSON
+    
+    def decode_ws_message(self, ws, msg):
+        """Decode a TEXT or BINARY frame using the connection's protocol"""
+        return decode_frame(self.get_ws_protocol(ws), msg.data)
+    
+    def worth_compressing(self, message, frame):
+        """Metrics only: False for tiny frames and already-compressed media, which deflate saves
+        nothing on; they are still deflated on the wire but kept out of the savings estimate"""
+        if len(frame) < WS_COMPRESSION_METRICS_MIN_SIZE:
+            self.stats['ws_compression']['frames_small'] += 1
+            return False
+        if is_precompressed_payload(message):
+            self.stats['ws_compression']['frames_media'] += 1
+            return False
+        return True
+    
+    def _record_compressed_frame(self, frame):
+        """Track bandwidth saved, sampling the real deflate ratio every N frames"""
+        metrics = self.stats['ws_compression']
+        raw = frame if isinstance(frame, bytes) else frame.encode('utf-8')
+        self._compression_frames_seen += 1
+        if self._compression_frames_seen % WS_COMPRESSION_SAMPLE_EVERY == 1:
+            ratio = len(zlib.compress(raw, 6)) / max(len(raw), 1)
+            metrics['estimated_ratio'] = round(0.8 * metrics['estimated_ratio'] + 0.2 * ratio, 4)
+        metrics['frames_compressed'] += 1
+        metrics['bytes_before_compression'] += len(raw)
+        metrics['estimated_bytes_saved'] += int(len(raw) * (1 - metrics['estimated_ratio']))
+    
+    async def _write_frame(self, ws, frame, compress=None):
+        if isinstance(frame, bytes):
+            await ws.send_bytes(frame, compress=compress)
+        else:
+            await ws.send_str(frame, compress=compress)
+    
+    async def send_ws_frame(self, ws, frame, compressible=True, lane=LANE_CHAT):
+        """Queue an already-encoded frame on the connection's lane (direct write before auth)"""
+        client = self.websocket_clients.get(ws)
+        if client is None:
+            await self._write_now(ws, frame, compressible)
+            return
+        client['outbound'].enqueue(lane, frame, compressible)
+    
+    async def _write_now(self, ws, frame, compressible=True):
+        """Write an encoded frame (str -> text frame, bytes -> binary frame).
+        
+        aiohttp has no public per-frame opt-out once deflate is negotiated (compress=0 falls
+        back to the socket setting), so frames worth_compressing rejects are still deflated; they are
+        only kept out of the savings estimate.
+        """
+        if not ws.compress:
+            await self._write_frame(ws, frame)
+            return
+        if compressible:
+            self._record_compressed_frame(frame)
+        # ws.compress holds the negotiated window bits; passing them per message uses a fresh context
+        await self._write_frame(ws, frame, compress=ws.compress if WS_COMPRESSION_NO_CONTEXT_TAKEOVER else None)
+    
+    async def send_ws(self, ws, message):
+        """Encode and send a message to a single WebSocket"""
+        frame = encode_frame(self.get_ws_protocol(ws), message)
+        await self.send_ws_frame(ws, frame, self.worth_compressing(message, frame), classify_lane(message, len(frame)))
+    
+    async def _fan_out(self, targets, message, exclude_ws=None, log_each=False):
+        """Send one message to many sockets, encoding it once per protocol"""
         sent_count = 0
         closed_clients = set()
+        frames = {}  # protocol -> (encoded frame, compressible, lane), so each encoding happens once
         
-        for ws, user_info in self.websocket_clients.items():
-            if user_info['user_id'] == target_user_id and ws != exclude_ws:
-                try:
-                    if ws.closed:
-                        closed_clients.add(ws)
-                    else:
-                        await ws.send_str(json.dumps(message))
-                        sent_count += 1
-                        print(f"📤 [WS] Sent to {user_info['username']}: {message}")
-                except Exception as e:
-                    print(f"❌ Error sending to WebSocket {user_info['username']}: {e}")
+        for ws in targets:
+            user_info = self.websocket_clients.get(ws)
+            if user_info is None or ws == exclude_ws:
+                continue
+            try:
+                if ws.closed:
                     closed_clients.add(ws)
+                else:
+                    protocol = user_info.get('protocol', PROTOCOL_JSON)
+                    if protocol not in frames:
+                        frame = encode_frame(protocol, message)
+                        frames[protocol] = (frame, self.worth_compressing(message, frame), classify_lane(message, len(frame)))
+                    await self.send_ws_frame(ws, *frames[protocol])
+                    sent_count += 1
+                    if log_each:
+                        print(f"📤 [WS] Sent to {user_info['username']}: {message}")
+            except Exception as e:
+                print(f"❌ Error sending to WebSocket {user_info['username']}: {e}")
+                closed_clients.add(ws)
         
         # Clean up closed connections
         for ws in closed_clients:
@@ -261,31 +478,28 @@ class AuthenticatedMessageBridge:
         
         return sent_count
     
-    async def broadcast_to_all_websockets(self, message, exclude_ws=None):
-        """Broadcast message to all WebSocket connections"""
-        sent_count = 0
-        closed_clients = set()
-        
-        for ws, user_info in self.websocket_clients.items():
-            if ws != exclude_ws:
-                try:
-                    if ws.closed:
-                        closed_clients.add(ws)
-                    else:
-                        await ws.send_str(json.dumps(message))
-                        sent_count += 1
-                except Exception as e:
-                    print(f"❌ Error broadcasting to {user_info['username']}: {e}")
-                    closed_clients.add(ws)
-        
-        # Clean up closed connections
-        for ws in closed_clients:
-            self.remove_websocket_client(ws)
-        
+    async def send_to_user_websockets(self, target_user_id, message, exclude_ws=None):
+        """Send message to specific user's WebSocket connections"""
+        return await self._fan_out(list(self.user_sockets.get(target_user_id, ())), message, exclude_ws, log_each=True)
+    
+    async def send_to_users_websockets(self, user_ids, message, exclude_ws=None):
+        """Send one message to the connections of many users (encoded once per protocol)"""
+        targets = [ws for user_id in user_ids for ws in self.user_sockets.get(user_id, ())]
+        return await self._fan_out(targets, message, exclude_ws)
+    
+    async def publish(self, topic, message, exclude_ws=None):
+        """Send message to every connection subscribed to a topic"""
+        sent_count = await self._fan_out(self.subscriptions.subscribers(topic), message, exclude_ws)
+        self.subscriptions.stats['publishes'] += 1
+        self.subscriptions.stats['delivered'] += sent_count
         return sent_count
     
-    def add_message_for_user(self, target_user_id, message):
-        """Add message to queue for specific user's HTTP clients"""
+    async def broadcast_to_all_websockets(self, message, exclude_ws=None):
+        """Broadcast message to all WebSocket connections (admin use; normal traffic goes through publish)"""
+        return await self._fan_out(list(self.websocket_clients), message, exclude_ws)
+    
+    async def add_message_for_user(self, target_user_id, message):
+        """Add message to queue for specific user's HTTP clients (mailbox write in the executor)"""
         enhanced_message = {
             **message,
             'bridge_id': str(uuid.uuid4()),
@@ -293,16 +507,62 @@ class AuthenticatedMessageBridge:
             'target_user_id': target_user_id
         }
         
-        self.user_message_queues[target_user_id].append(enhanced_message)
+        loop = asyncio.get_running_loop()
+        enhanced_message['mailbox_seq'] = await loop.run_in_executor(
+            None, self.mailbox.append, target_user_id, enhanced_message
+        )
         self.stats['total_messages'] += 1
         print(f"📦 [Bridge] Queued message for user {target_user_id}: {enhanced_message}")
         
         # Notify waiting HTTP clients for this user
         self._notify_user_http_clients(target_user_id, enhanced_message)
     
-    def get_messages_for_user(self, user_id, since_timestamp=None):
-        """Get messages for specific user"""
-        messages = list(self.user_message_queues[user_id])
+    def needs_mailbox(self, user_id, delivered_live):
+        """Queue unless a live socket took the message and the user has no HTTP poller.
+        
+        WebSocket clients never ack the mailbox, so queueing what they already received
+        would only fill it up to the budget; HTTP pollers (client_https8) read nothing else.
+        """
+        return not delivered_live or self.presence.is_polling(user_id)
+    
+    async def deliver_to_user(self, target_user_id, message, exclude_ws=None):
+        """Send to the user's live sockets; queue in the mailbox for HTTP pollers or when no socket took it"""
+        sent_count = await self.send_to_user_websockets(target_user_id, message, exclude_ws)
+        if self.needs_mailbox(target_user_id, sent_count > 0):
+            await self.add_message_for_user(target_user_id, message)
+        return sent_count
+    
+    async def add_message_for_users(self, user_ids, message):
+        """Queue one message for many users: one mailbox transaction (in the executor), one pass over polls"""
+        enhanced_message = {
+            **message,
+            'bridge_id': str(uuid.uuid4()),
+            'bridge_timestamp': time.time()
+        }
+        loop = asyncio.get_running_loop()
+        seqs = await loop.run_in_executor(None, self.mailbox.append_many, list(user_ids), enhanced_message)
+        self.stats['total_messages'] += len(seqs)
+        print(f"📦 [Bridge] Queued message for {len(seqs)} users")
+        
+        for client_id, client_info in list(self.http_long_poll_clients.items()):
+            seq = seqs.get(client_info['user_id'])
+            if seq is not None and not client_info['future'].done():
+                client_info['future'].set_result([{
+                    **enhanced_message, 'mailbox_seq': seq, 'target_user_id': client_info['user_id']
+                }])
+                del self.http_long_poll_clients[client_id]
+        return seqs
+    
+    def get_messages_for_user(self, user_id, since_timestamp=None, after_seq=None):
+        """Get messages for specific user.
+        
+        With after_seq (cursor drain) everything up to the cursor is acknowledged and
+        deleted, and only newer messages are returned.
+        """
+        if after_seq is not None:
+            self.mailbox.ack(user_id, after_seq)
+            return self.mailbox.read(user_id, after_seq)
+        messages = self.mailbox.read(user_id)
         if since_timestamp:
             messages = [msg for msg in messages if msg['bridge_timestamp'] > since_timestamp]
         return messages
@@ -343,6 +603,97 @@ class AuthenticatedMessageBridge:
 # Global authenticated bridge instance
 auth_bridge = AuthenticatedMessageBridge()
 
+# Global message store (backend chosen by MESSAGE_STORE_BACKEND)
+message_store = create_message_store(
+    MESSAGE_STORE_BACKEND,
+    json_path=CHAT_LOG_FILE,
+    sqlite_path=SQLITE_MESSAGE_DB,
+    db_config=DB_CONFIG,
+    segment_dir=SEGMENT_MESSAGE_DIR
+)
+tiered_store = None
+if ARCHIVE_ENABLED:
+    message_store = tiered_store = TieredMessageStore(message_store, ColdArchive(ARCHIVE_DIR))
+    auth_bridge.stats['archive'] = tiered_store.stats
+if ROOM_TAIL_SIZE > 0:
+    # Write-through: the batcher's save_many below keeps cached tails current
+    message_store = RoomTailCache(
+        message_store,
+        tail_size=ROOM_TAIL_SIZE,
+        max_rooms=ROOM_TAIL_MAX_ROOMS,
+        max_bytes=ROOM_TAIL_MAX_BYTES
+    )
+    auth_bridge.stats['room_tail_cache'] = message_store.stats
+print(f"💾 Message store backend: {message_store.name}")
+
+# Global write-behind batcher for chat messages
+message_batcher = MessageWriteBatcher(
+    message_store.save_many,
+    window_ms=MESSAGE_BATCH_WINDOW_MS,
+    max_batch=MESSAGE_BATCH_MAX
+)
+auth_bridge.stats['message_batches'] = message_batcher.stats
+
+# Global dedup window so client retries (same client_msg_id) are saved and fanned out once
+send_dedup = SendDedupWindow(
+    max_per_sender=SEND_DEDUP_WINDOW,
+    ttl_seconds=SEND_DEDUP_TTL,
+    lookup=message_store.find_by_client_msg_id  # ids the window forgot (restart, TTL) are checked in the store
+)
+auth_bridge.stats['send_dedup'] = send_dedup.stats
+
+# Global ingest limiter (WebSocket: pause reading = backpressure, HTTP: 429)
+ingest_limiter = IngestLimiter(RATE_LIMITS, ip_multiplier=RATE_LIMIT_IP_MULTIPLIER)
+auth_bridge.stats['rate_limit'] = ingest_limiter.stats
+
+def is_media_payload(data):
+    """True for uploads (image/file messages and their chunks), which use the media buckets"""
+    return bool(data.get('file_data')) or data.get('message_type', data.get('type')) in ('image', 'file', 'chunk')
+
+async def check_http_rate_limit(request, user_info, is_media):
+    """None if the request may proceed, otherwise a 429 response with Retry-After"""
+    if not RATE_LIMIT_ENABLED:
+        return None
+    size = request.content_length or len(await request.read())
+    retry_after = ingest_limiter.try_acquire(user_info['user_id'], request.remote, size, is_media)
+    if not retry_after:
+        return None
+    print(f"🚦 [RateLimit] HTTP 429 for {user_info['username']} ({request.remote}), retry in {retry_after:.1f}s")
+    return web.json_response({
+        'status': 'error',
+        'message': 'Rate limit exceeded',
+        'retry_after': round(retry_after, 2)
+    }, status=429, headers={'Retry-After': str(max(1, int(retry_after + 0.999)))})
+
+# Global upload index: which message references each stored file, per-user quotas
+upload_store = UploadStore(
+    'uploads',
+    UPLOAD_INDEX_DB,
+    quota_bytes=UPLOAD_QUOTA_BYTES,
+    rate_bytes_per_hour=UPLOAD_RATE_BYTES_PER_HOUR,
+    rate_files_per_hour=UPLOAD_RATE_FILES_PER_HOUR,
+    orphan_grace_seconds=UPLOAD_ORPHAN_GRACE
+)
+auth_bridge.stats['uploads'] = upload_store.stats
+
+def upload_quota_response(error):
+    """413 for a full storage quota, 429 + Retry-After for the upload rate"""
+    if error.kind == 'rate':
+        return web.json_response({
+            'status': 'error',
+            'message': str(error),
+            'retry_after': round(error.retry_after, 2)
+        }, status=429, headers={'Retry-After': str(max(1, int(error.retry_after + 0.999)))})
+    return web.json_response({'status': 'error', 'message': str(error)}, status=413)
+
+# Global per-user inbox index (room, peer, last message, unread count)
+inbox_index = InboxIndex()
+
+# Global read state: last read message id per (user, room) + throttled receipt pushes
+read_cursors = ReadCursorTracker(message_store)
+receipt_throttler = ReceiptThrottler()
+auth_bridge.stats['read_receipts'] = {'cursors': read_cursors.stats, 'receipts': receipt_throttler.stats}
+
 def get_user_from_token(request):
     """Extract user info from JWT token in request"""
     auth_header = request.headers.get('Authorization', '')
@@ -372,64 +723,54 @@ async def auth_login_register(request):
                 'message': 'Type must be "login" or "register"'
             }, status=400)
         
-        with get_db_cursor() as (cursor, conn):
-            if action_type == 'register':
-                try:
-                    cursor.execute(
-                        "INSERT INTO users (username, password_hash) VALUES (%s, %s) RETURNING user_id",
-                        (username, password)
-                    )
-                    user_id = cursor.fetchone()[0]
-                    conn.commit()
-
-                    print(f"✅ [Auth] New user registered: {username} (ID: {user_id})")
-                    
-                    token = create_jwt_token(user_id, username)
-                    session_id = str(uuid.uuid4())
-                    
-                    response_data = {
-                        'status': 'success',
-                        'message': 'Registration successful',
-                        'user': {'user_id': user_id, 'username': username},
-                        'token': token,
-                        'session_id': session_id
-                    }
-                    
-                except psycopg2.IntegrityError:
-                    response_data = {
-                        'status': 'error',
-                        'message': 'Username already exists'
-                    }
-                    
-            else:  # login
-                cursor.execute(
-                    "SELECT user_id, username, password_hash FROM users WHERE username = %s",
-                    (username,)
-                )
-                user = cursor.fetchone()
+        if action_type == 'register':
+            try:
+                user_id = db_queries.fetchone('users.insert', (username, password))[0]
+
+                print(f"✅ [Auth] New user registered: {username} (ID: {user_id})")
                 
-                if user and verify_password(password, user[2]):
-                    user_id, db_username, _ = user
-                    
-                    token = create_jwt_token(user_id, username)
-                    session_id = str(uuid.uuid4())
-                    
-                    print(f"✅ [Auth] User logged in: {username} (ID: {user_id})")
-                    
-                    response_data = {
-                        'status': 'success',
-                        'message': 'Login successful',
-                        'user': {'user_id': user_id, 'username': db_username},
-                        'token': token,
-                        'session_id': session_id
-                    }
-                    
-                else:
-                    response_data = {
-                        'status': 'error',
-                        'message': 'Invalid username or password'
-                    }
-        
+                token = create_jwt_token(user_id, username)
+                session_id = str(uuid.uuid4())
+                
+                response_data = {
+                    'status': 'success',
+                    'message': 'Registration successful',
+                    'user': {'user_id': user_id, 'username': username},
+                    'token': token,
+                    'session_id': session_id
+                }
+                
+            except psycopg2.IntegrityError:
+                response_data = {
+                    'status': 'error',
+                    'message': 'Username already exists'
+                }
+                
+        else:  # login
+            user = db_queries.fetchone('users.login', (username,))
+            
+            if user and verify_password(password, user[2]):
+                user_id, db_username, _ = user
+                
+                token = create_jwt_token(user_id, username)
+                session_id = str(uuid.uuid4())
+                
+                print(f"✅ [Auth] User logged in: {username} (ID: {user_id})")
+                
+                response_data = {
+                    'status': 'success',
+                    'message': 'Login successful',
+                    'user': {'user_id': user_id, 'username': db_username},
+                    'token': token,
+                    'session_id': session_id
+                }
+                
+            else:
+                response_data = {
+                    'status': 'error',
+                    'message': 'Invalid username or password'
+                }
+
         auth_bridge.update_user_stats()
         print(f"📨 [Auth] {action_type.title()} request from {request.remote}: {response_data['status']}")
         return web.json_response(response_data)
@@ -475,13 +816,138 @@ async def auth_logout(request):
             'message': 'Logout failed'
         }, status=500)
     
+def save_upload_file(user_id, room_id, message_type, original_filename, file_content):
+    """Store an uploaded image/file under uploads/ and return its URL path (blocking).
+
+    Raises UploadQuotaExceeded before writing anything when the user is over quota.
+    """
+    # Binary protocols carry raw bytes, JSON carries base64
+    if isinstance(file_content, (bytes, bytearray)):
+        file_data = bytes(file_content)
+    else:
+        try:
+            file_data = base64.b64decode(file_content)
+        except (ValueError, TypeError):
+            raise ValueError('Invalid base64 content')
+    return upload_store.save(user_id, room_id, message_type, original_filename, file_data)
+
+async def handle_ws_chat_message(ws, user_info, data):
+    """Handle a chat message (text, image, or file) sent over the WebSocket"""
+    recipient_id = data.get("recipient_id")
+    message_type = data.get("message_type", "text")
+    
+    # --- Logic to handle different message types ---
+    async def persist_chat_message():
+        """Steps 1-4 run once per client_msg_id; retries reuse the stored message"""
+        recipient_id = data.get("recipient_id")
+        # 1. Determine recipient ID (handle username or user_id); group sends name the room instead
+        if not recipient_id:
+            room_id = str(data.get("room_id"))
+            if user_info['user_id'] not in get_room_members(room_id):
+                raise ValueError("Not a member of this room")
+        elif isinstance(recipient_id, str) and not recipient_id.isdigit():
+            user_result = db_queries.fetchone('users.id_by_username', (recipient_id,))
+            if user_result:
+                recipient_id = user_result[0]
+            else:
+                raise ValueError(f"Username '{data.get('recipient_id')}' not found")
+
+        recipient_id = int(recipient_id) if recipient_id else None
+        final_content = ""
+        original_filename = None
+
+        # 2. Resolve the room first, so an upload is indexed under the room it is sent to
+        if recipient_id:
+            room_id = get_or_create_room_id(user_info['user_id'], recipient_id)
+
+        # 3. Process content based on type (text, image, or file)
+        if message_type in ['image', 'file']:
+            print(f"🖼️  [WS] Received {message_type} message from {user_info['username']}")
+            file_content_base64 = data.get('file_data')
+            original_filename = data.get('file_name')
+            if not file_content_base64 or not original_filename:
+                raise ValueError("File message requires 'file_data' and 'file_name'")
+
+            # Quota check + decode + disk write run in the executor, off the event loop
+            final_content = await asyncio.get_running_loop().run_in_executor(
+                None, save_upload_file, user_info['user_id'], room_id, message_type,
+                original_filename, file_content_base64
+            )
+            print(f"✅ [WS] {message_type.capitalize()} saved to {final_content}")
+        else: # Default to text
+            final_content = data.get("message")
+            if not final_content:
+                raise ValueError("Text message content cannot be empty")
+
+        new_message = {
+            "sender_id": user_info['user_id'],
+            "sender_username": user_info['username'],
+            "timestamp": datetime.now(pytz.UTC).isoformat(),
+            "type": message_type,
+            "content": final_content,
+            "filename": original_filename,
+            "room_id": room_id,
+            "recipient_id": recipient_id,
+            "client_msg_id": client_msg_id
+        }
+
+        # 4. Save to chat log (group commit; returns once the batch is durable)
+        new_message = await message_batcher.submit((room_id, new_message))
+        print(f"✅ [Message Saved via WS to Room {room_id}]")
+        if message_type in ['image', 'file']:
+            await asyncio.get_running_loop().run_in_executor(
+                None, upload_store.attach, final_content, room_id, new_message.get('message_id')
+            )
+        return new_message
+
+    try:
+        client_msg_id = data.get("client_msg_id")
+        new_message, is_duplicate = await send_dedup.submit(
+            user_info['user_id'], client_msg_id, persist_chat_message
+        )
+
+        # 5. Push to the other room members (only the first attempt fans out)
+        if is_duplicate:
+            print(f"♻️ [WS] Duplicate send {client_msg_id} from {user_info['username']} - re-acking")
+        else:
+            await fan_out_room_message(new_message['room_id'], new_message, user_info['user_id'], exclude_ws=ws)
+        
+        # 6. Confirm back to the sender with the canonical id and room order
+        echo_response = {
+            "type": "message_sent",
+            "message": new_message,
+            "client_msg_id": client_msg_id,
+            "message_id": new_message.get('message_id'),
+            "seq": new_message.get('seq'),
+            "duplicate": is_duplicate,
+            "status": "stored",
+            "server_timestamp": time.time()
+        }
+        await auth_bridge.send_ws(ws, echo_response)
+
+    except Exception as e:
+        print(f"❌ [WS] Error handling chat message: {e}")
+        await auth_bridge.send_ws(ws, {"type": "error", "message": str(e)})
+
+async def run_bulk_worker(ws, user_info, bulk_queue):
+    """Per-connection background worker for uploads, so big payloads never stall the read loop"""
+    while True:
+        data = await bulk_queue.get()
+        try:
+            await handle_ws_chat_message(ws, user_info, data)
+        finally:
+            bulk_queue.task_done()
+    
 async def websocket_handler(request):
     """Enhanced WebSocket handler with login, registration, and authentication support"""
-    ws = web.WebSocketResponse()
+    ws = web.WebSocketResponse(compress=WS_COMPRESSION_ENABLED, heartbeat=WS_HEARTBEAT_INTERVAL or None)
     await ws.prepare(request)
     
     client_ip = request.remote
     user_info = None
+    bulk_queue = None
+    bulk_worker = None  # started on the first upload
+    chunk_assembler = ChunkAssembler(max_bytes=INBOUND_CHUNK_MAX_BYTES)
     
     print(f"🔌 WebSocket connection attempt from {client_ip}")
     
@@ -522,9 +988,10 @@ async def websocket_handler(request):
             
             # Add authenticated client
             session_id = first_data.get('session_id', 'unknown')
-            auth_bridge.add_websocket_client(ws, user_info['user_id'], user_info['username'], session_id)
+            # Negotiate wire protocol: clients offer e.g. ["msgpack", "json"]; browser sends nothing -> JSON
+            protocol = negotiate_protocol(first_data.get('protocols'))
             
-            # Send authentication success
+            # Send authentication success (always JSON text so the client learns the protocol)
             welcome_msg = {
                 "type": "auth_success",
                 "message": f"Welcome {user_info['username']}!",
@@ -532,9 +999,18 @@ async def websocket_handler(request):
                     "user_id": user_info['user_id'],
                     "username": user_info['username']
                 },
+                "protocol": protocol,
                 "timestamp": time.time()
             }
             await ws.send_str(json.dumps(welcome_msg))
+            # Optional client features: "chunks" = can reassemble chunked bulk frames,
+            # "batch" = accepts {"type": "batch", "messages": [...]} coalesced frames
+            auth_bridge.add_websocket_client(ws, user_info['user_id'], user_info['username'], session_id, protocol,
+                                             features=first_data.get('features'))
+            
+            # Untargeted publishes reach system + room:<id> subscribers, friends' presence presence:<id>
+            await subscribe_default_topics(ws, user_info['user_id'])
+            await sync_presence_subscriptions(user_info['user_id'])
             
             # Determine connection type and handle accordingly
             is_search_connection = 'search' in session_id.lower()
@@ -557,31 +1033,71 @@ async def websocket_handler(request):
                         "message": "Failed to load friends",
                         "timestamp": time.time()
                     }
-                    await ws.send_str(json.dumps(friends_error_response))
+                    await auth_bridge.send_ws(ws, friends_error_response)
             else:
                 print(f"❓ [WS] Unknown connection type for {user_info['username']} - session: {session_id}")
             
-            # Send previous conversations
-            previous_conversations = await get_user_previous_conversations(user_info['user_id'])
+            # Reconnecting clients drain their offline mailbox from the last cursor they processed
+            if first_data.get('mailbox_cursor') is not None:
+                await send_mailbox_drain(ws, user_info['user_id'], first_data.get('mailbox_cursor'))
+            
+            # Send compact inbox first so the sidebar renders without any history
+            inbox_entries = await get_user_inbox(user_info['user_id'])
+            await auth_bridge.send_ws(ws, {
+                "type": "inbox",
+                "rooms": inbox_entries,
+                "timestamp": time.time()
+            })
+            
+            # Send previous conversations (JSON clients get the cached records spliced in as-is)
+            as_fragments = auth_bridge.get_ws_protocol(ws) == PROTOCOL_JSON
+            previous_conversations = await get_user_previous_conversations(user_info['user_id'], as_fragments)
             if previous_conversations:
                 conversations_msg = {
                     "type": "previous_conversations",
-                    "conversations": previous_conversations,
                     "timestamp": time.time()
                 }
-                await ws.send_str(json.dumps(conversations_msg))
+                if as_fragments:
+                    frame = splice_json(conversations_msg, {"conversations": splice_json({}, {
+                        room_id: json_array(fragments) for room_id, fragments in previous_conversations.items()
+                    })})
+                    await auth_bridge.send_ws_frame(ws, frame, auth_bridge.worth_compressing(conversations_msg, frame), LANE_BULK)
+                else:
+                    conversations_msg["conversations"] = previous_conversations
+                    await auth_bridge.send_ws(ws, conversations_msg)
                 print(f"📤 [WS] Sent {len(previous_conversations)} previous conversations to {user_info['username']}")
             
         except json.JSONDecodeError:
-            await ws.send_str(json.dumps({'error': 'Invalid message format'}))
+            await auth_bridge.send_ws(ws, {'error': 'Invalid message format'})
             return ws
         
         # MAIN MESSAGE HANDLING LOOP - AUTHENTICATION ALREADY VERIFIED
         print(f"🔄 [WS] Starting message loop for authenticated user: {user_info['username']}")
         async for msg in ws:
-            if msg.type == WSMsgType.TEXT:
+            if msg.type in (WSMsgType.TEXT, WSMsgType.BINARY):
                 try:
-                    data = json.loads(msg.data)
+                    data = auth_bridge.decode_ws_message(ws, msg)
+                    
+                    # Backpressure: over-limit clients are paused before their frame is handled.
+                    # While we sleep nothing is read from the socket, so TCP pushes back on the sender.
+                    if RATE_LIMIT_ENABLED:
+                        pause = ingest_limiter.reserve(user_info['user_id'], client_ip, len(msg.data), is_media_payload(data))
+                        if pause > 0:
+                            print(f"🚦 [RateLimit] Pausing {user_info['username']} for {min(pause, RATE_LIMIT_MAX_PAUSE):.2f}s")
+                            await asyncio.sleep(min(pause, RATE_LIMIT_MAX_PAUSE))
+                    
+                    # Large uploads may arrive as chunk envelopes; handle them once reassembled
+                    if data.get('type') == 'chunk':
+                        frame = chunk_assembler.feed(data)
+                        if frame is None:
+                            continue
+                        data = decode_frame(auth_bridge.get_ws_protocol(ws), frame)
+                    
+                    # Presence heartbeat: {"type": "heartbeat", "active": bool} (no reply, no logging)
+                    if data.get('type') == 'heartbeat':
+                        auth_bridge.presence.touch(user_info['user_id'], active=data.get('active', True))
+                        continue
+                    auth_bridge.presence.touch(user_info['user_id'])
                     print(f"📨 [WS] Received from {user_info['username']}: {data}")
                     
                     # Handle friend-related messages (search, add friend, get friends)
@@ -593,106 +1109,35 @@ async def websocket_handler(request):
                             await broadcast_friends_update_to_user(user_info['user_id'])
                         continue
 
-                    # Handle chat messages (FIXED LOGIC - Accept username or user_id)
-                    # In websocket_handler function, replace the chat message handling block
+                    # Topic subscriptions: {"type": "subscribe" | "unsubscribe", "topics": ["room:12", "system"]}
+                    if await handle_subscription_message(ws, user_info, data):
+                        continue
 
-                    # --- START OF MODIFIED BLOCK ---
-                    # Handle chat messages (text, image, or file)
-                    if data.get('recipient_id') and (data.get('message') or data.get('file_data')):
-                        recipient_id = data.get("recipient_id")
-                        message_type = data.get("message_type", "text")
-                        
-                        # --- Logic to handle different message types ---
-                        try:
-                            # 1. Determine recipient ID (handle username or user_id)
-                            if isinstance(recipient_id, str) and not recipient_id.isdigit():
-                                with get_db_cursor() as (cursor, conn):
-                                    cursor.execute("SELECT user_id FROM users WHERE username = %s", (recipient_id,))
-                                    user_result = cursor.fetchone()
-                                    if user_result:
-                                        recipient_id = user_result[0]
-                                    else:
-                                        raise ValueError(f"Username '{data.get('recipient_id')}' not found")
-
-                            recipient_id = int(recipient_id)
-                            final_content = ""
-                            original_filename = None
-
-                            # 2. Process content based on type (text, image, or file)
-                            if message_type in ['image', 'file']:
-                                print(f"🖼️  [WS] Received {message_type} message from {user_info['username']}")
-                                file_content_base64 = data.get('file_data')
-                                original_filename = data.get('file_name')
-                                if not file_content_base64 or not original_filename:
-                                    raise ValueError("File message requires 'file_data' and 'file_name'")
-
-                                upload_dir = f"uploads/{message_type}s"
-                                os.makedirs(upload_dir, exist_ok=True)
-                                
-                                file_data = base64.b64decode(file_content_base64)
-                                file_extension = os.path.splitext(original_filename)[1]
-                                unique_filename = f"{uuid.uuid4().hex}{file_extension}"
-                                file_path = os.path.join(upload_dir, unique_filename)
-
-                                with open(file_path, 'wb') as f:
-                                    f.write(file_data)
-                                
-                                final_content = f"/{file_path.replace(os.sep, '/')}"
-                                print(f"✅ [WS] {message_type.capitalize()} saved to {file_path}")
-                            else: # Default to text
-                                final_content = data.get("message")
-                                if not final_content:
-                                    raise ValueError("Text message content cannot be empty")
-
-                            # 3. Create room and the message object to be saved
-                            room_id = get_or_create_room_id(user_info['user_id'], recipient_id)
-                            new_message = {
-                                "sender_id": user_info['user_id'],
-                                "sender_username": user_info['username'],
-                                "timestamp": datetime.now(pytz.UTC).isoformat(),
-                                "type": message_type,
-                                "content": final_content,
-                                "filename": original_filename,
-                                "room_id": room_id,
-                                "recipient_id": recipient_id
-                            }
+                    # Mailbox cursor ack: {"type": "mailbox_ack", "cursor": mailbox_seq}
+                    if data.get('type') == 'mailbox_ack':
+                        await send_mailbox_drain(ws, user_info['user_id'], data.get('cursor'))
+                        continue
 
-                            # 4. Save to chat log
-                            async with chat_log_lock:
-                                chat_data = load_chat_log()
-                                chat_data.setdefault("conversations", {})
-                                if room_id not in chat_data["conversations"]:
-                                    chat_data["conversations"][room_id] = []
-                                chat_data["conversations"][room_id].append(new_message)
-                                save_chat_log(chat_data)
-                            print(f"✅ [Message Saved via WS to Room {room_id}]")
-
-                            # 5. Push real-time update to the recipient
-                            websocket_payload = {
-                                "type": "new_message",
-                                "message": new_message
-                            }
-                            await auth_bridge.send_to_user_websockets(
-                                target_user_id=recipient_id,
-                                message=websocket_payload,
-                                exclude_ws=ws
-                            )
-                            
-                            # 6. Confirm back to the sender
-                            echo_response = {
-                                "type": "message_sent",
-                                "message": new_message,
-                                "status": "delivered",
-                                "server_timestamp": time.time()
-                            }
-                            await ws.send_str(json.dumps(echo_response))
+                    # Batched read acks: {"type": "read_up_to", "rooms": {room_id: message_id}}
+                    if data.get('type') == 'read_up_to':
+                        acks = data.get('rooms') or {data.get('room_id'): data.get('message_id')}
+                        await apply_read_acks(user_info['user_id'], acks)
+                        continue
 
-                        except Exception as e:
-                            print(f"❌ [WS] Error handling chat message: {e}")
-                            await ws.send_str(json.dumps({"type": "error", "message": str(e)}))
-                        
+                    # Handle chat messages (text, image, or file)
+                    # Group rooms send {"room_id", "message_type", ...} instead of a recipient_id
+                    if (data.get('recipient_id') or (data.get('room_id') and data.get('message_type'))) \
+                            and (data.get('message') or data.get('file_data')):
+                        if is_media_payload(data):
+                            # Bulk lane: uploads are processed by a background worker in arrival order.
+                            # A full queue blocks this loop, which is backpressure for upload floods.
+                            if bulk_worker is None:
+                                bulk_queue = asyncio.Queue(maxsize=INBOUND_BULK_QUEUE_SIZE)
+                                bulk_worker = asyncio.ensure_future(run_bulk_worker(ws, user_info, bulk_queue))
+                            await bulk_queue.put(data)
+                        else:
+                            await handle_ws_chat_message(ws, user_info, data)
                         continue # Skip to the next message
-                    # --- END OF MODIFIED BLOCK ---
                     
                     # Handle room_id and message (LEGACY SUPPORT)
                     room_id = data.get('room_id')
@@ -700,6 +1145,9 @@ async def websocket_handler(request):
                     
                     if room_id and message_content:
                         sender_id = user_info['user_id']
+                        if sender_id not in get_room_members(room_id):
+                            await auth_bridge.send_ws(ws, {"type": "error", "message": "Not a member of this room"})
+                            continue
                         
                         # Create message object
                         new_message = {
@@ -710,35 +1158,13 @@ async def websocket_handler(request):
                             "content": message_content
                         }
 
-                        # Save to chat_log.json
-                        async with chat_log_lock:
-                            chat_data = load_chat_log()
-                            if room_id not in chat_data.get("conversations", {}):
-                                chat_data.setdefault("conversations", {})[room_id] = []
-                            
-                            chat_data["conversations"][room_id].append(new_message)
-                            save_chat_log(chat_data)
+                        # Save to chat_log.json (group commit)
+                        new_message = await message_batcher.submit((room_id, new_message))
 
                         print(f"✅ [Legacy Message Saved via WS to Room {room_id}] from {user_info['username']}")
 
-                        # Find recipient from room members
-                        recipient_id = None
-                        with get_db_cursor() as (cursor, conn):
-                            cursor.execute(
-                                "SELECT user_id FROM room_members WHERE room_id = %s", (int(room_id),)
-                            )
-                            members = cursor.fetchall()
-                        
-                        if members:
-                            for member_tuple in members:
-                                if member_tuple[0] != sender_id:
-                                    recipient_id = member_tuple[0]
-                                    break
-                        
-                        # Send to recipient if found
-                        if recipient_id:
-                            print(f"📡 Queuing message for HTTP poll for user {recipient_id}...")
-                            auth_bridge.add_message_for_user(recipient_id, new_message)
+                        # Deliver to every other member (live sockets now, mailbox for the rest)
+                        await fan_out_room_message(room_id, new_message, sender_id, exclude_ws=ws)
                         continue
                     
                     # Handle as regular bridge message (fallback)
@@ -756,13 +1182,15 @@ async def websocket_handler(request):
                     target_user_id = data.get('target_user_id')
                     
                     if target_user_id:
-                        # Send to specific user
-                        auth_bridge.add_message_for_user(target_user_id, enhanced_data)
-                        await auth_bridge.send_to_user_websockets(target_user_id, enhanced_data, exclude_ws=ws)
+                        # Send to specific user (mailbox only if not delivered live)
+                        await auth_bridge.deliver_to_user(target_user_id, enhanced_data, exclude_ws=ws)
                     else:
-                        # Broadcast to all users
-                        await auth_bridge.broadcast_to_all_websockets(enhanced_data, exclude_ws=ws)
-                        auth_bridge.add_message_for_user(user_info['user_id'], enhanced_data)
+                        # No target: publish to the message's room topic, subscribers only
+                        topic = await authorize_publish(user_info['user_id'], data)
+                        if topic is None:
+                            await auth_bridge.send_ws(ws, {"error": "Not allowed to publish here: name a room you are a member of"})
+                            continue
+                        await auth_bridge.publish(topic, enhanced_data, exclude_ws=ws)
                     
                     # Echo back to sender
                     echo_response = {
@@ -771,14 +1199,14 @@ async def websocket_handler(request):
                         "server_timestamp": time.time(),
                         "status": "delivered"
                     }
-                    await ws.send_str(json.dumps(echo_response))
+                    await auth_bridge.send_ws(ws, echo_response)
                     
-                except json.JSONDecodeError as e:
-                    error_msg = {"error": "Invalid JSON", "details": str(e)}
-                    await ws.send_str(json.dumps(error_msg))
+                except (json.JSONDecodeError, ValueError) as e:
+                    error_msg = {"error": "Invalid message format", "details": str(e)}
+                    await auth_bridge.send_ws(ws, error_msg)
                 except Exception as e:
                     print(f"❌ [WS] Error processing message: {e}")
-                    await ws.send_str(json.dumps({'error': f'Server error: {e}'}))
+                    await auth_bridge.send_ws(ws, {'error': f'Server error: {e}'})
                     
             elif msg.type == WSMsgType.ERROR:
                 print(f'❌ [WS] Error from {user_info["username"]}: {ws.exception()}')
@@ -786,12 +1214,19 @@ async def websocket_handler(request):
     
     except asyncio.TimeoutError:
         print(f"⏰ WebSocket timeout from {client_ip}")
-        await ws.send_str(json.dumps({'error': 'Message timeout'}))
+        await auth_bridge.send_ws(ws, {'error': 'Message timeout'})
     except Exception as e:
         print(f"❌ [WS] Exception: {e}")
         import traceback
         traceback.print_exc()
     finally:
+        if bulk_worker is not None:
+            # Uploads already received are still saved, the client just misses the ack
+            try:
+                await asyncio.wait_for(bulk_queue.join(), timeout=30)
+            except asyncio.TimeoutError:
+                print(f"⚠️ [WS] Dropping {bulk_queue.qsize()} unsaved uploads after disconnect")
+            bulk_worker.cancel()
         if user_info and ws in auth_bridge.websocket_clients:
             auth_bridge.remove_websocket_client(ws)
             print(f"🔌 [WS] Disconnected: {user_info['username']}")
@@ -809,6 +1244,9 @@ async def api_send_authenticated_message(request):
     
     try:
         data = await request.json()
+        limited = await check_http_rate_limit(request, user_info, is_media_payload(data))
+        if limited:
+            return limited
         print(f"📨 [HTTP] Authenticated message from {user_info['username']}: {data}")
         
         # Enhanced message with sender info
@@ -826,12 +1264,17 @@ async def api_send_authenticated_message(request):
         target_user_id = data.get('target_user_id')
         
         if target_user_id:
-            # Send to specific user
-            auth_bridge.add_message_for_user(target_user_id, enhanced_data)
-            sent_count = await auth_bridge.send_to_user_websockets(target_user_id, enhanced_data)
+            # Send to specific user (mailbox only if not delivered live)
+            sent_count = await auth_bridge.deliver_to_user(target_user_id, enhanced_data)
         else:
-            # Broadcast to all
-            sent_count = await auth_bridge.broadcast_to_all_websockets(enhanced_data)
+            # Publish to the message's room topic, subscribers only
+            topic = await authorize_publish(user_info['user_id'], data)
+            if topic is None:
+                return web.json_response({
+                    'status': 'error',
+                    'message': 'Not allowed to publish here: name a room you are a member of'
+                }, status=403)
+            sent_count = await auth_bridge.publish(topic, enhanced_data)
         
         response_data = {
             "status": "success",
@@ -868,21 +1311,40 @@ async def api_receive_authenticated_messages(request):
     except (ValueError, TypeError):
         since_timestamp = None
     
+    # ?after=<mailbox_seq>: cursor drain (acks everything up to the cursor)
+    try:
+        after_seq = int(request.query['after']) if request.query.get('after') else None
+    except ValueError:
+        after_seq = None
+    
     poll = request.query.get('poll', 'false').lower() == 'true'
+    auth_bridge.presence.touch_poll(user_id)
     
-    print(f"📡 [HTTP] User {user_info['username']} requesting messages (poll={poll})")
+    print(f"📡 [HTTP] User {user_info['username']} requesting messages (poll={poll}, after={after_seq})")
     
     try:
-        if poll:
+        messages = []
+        # Mailbox acks and reads are SQLite statements: run them in the executor
+        loop = asyncio.get_running_loop()
+        if after_seq is not None:
+            # Anything that arrived while the client was away is returned without waiting
+            messages = await loop.run_in_executor(
+                None, functools.partial(auth_bridge.get_messages_for_user, user_id, after_seq=after_seq)
+            )
+        if poll and not messages:
             messages = await auth_bridge.wait_for_user_messages(client_id, user_id, timeout=30)
-        else:
-            messages = auth_bridge.get_messages_for_user(user_id, since_timestamp)
+        elif not poll and after_seq is None:
+            messages = await loop.run_in_executor(None, auth_bridge.get_messages_for_user, user_id, since_timestamp)
         
+        next_cursor = max((msg.get('mailbox_seq', 0) for msg in messages), default=after_seq)
+        if next_cursor is None:
+            next_cursor = await loop.run_in_executor(None, auth_bridge.mailbox.last_seq, user_id)
         response_data = {
             "status": "success",
             "messages": messages,
             "count": len(messages),
             "user_id": user_id,
+            "next_cursor": next_cursor,
             "timestamp": time.time()
         }
         
@@ -908,11 +1370,7 @@ async def api_get_users(request):
         }, status=401)
     
     try:
-        conn = get_db_connection()
-        cursor = conn.cursor()
-        cursor.execute("SELECT user_id, username FROM users ORDER BY username")
-        users = [{'user_id': row[0], 'username': row[1]} for row in cursor.fetchall()]
-        conn.close()
+        users = [{'user_id': row[0], 'username': row[1]} for row in db_queries.fetchall('users.list')]
         
         return web.json_response({
             'status': 'success',
@@ -945,13 +1403,9 @@ async def api_add_friend(request):
                 'message': 'Friend username is required'
             }, status=400)
         
-        with get_db_cursor() as (cursor, conn):
+        with db_queries.transaction() as session:
             # Find friend by username
-            cursor.execute(
-                "SELECT user_id FROM users WHERE username = %s",
-                (friend_username,)
-            )
-            friend = cursor.fetchone()
+            friend = session.fetchone('users.id_by_username', (friend_username,))
             
             if not friend:
                 return web.json_response({
@@ -968,11 +1422,7 @@ async def api_add_friend(request):
                 })
             
             # Check if friendship already exists
-            cursor.execute(
-                "SELECT status FROM friendships WHERE user_id = %s AND friend_id = %s",
-                (user_info['user_id'], friend_id)
-            )
-            existing = cursor.fetchone()
+            existing = session.fetchone('friends.status', (user_info['user_id'], friend_id))
             
             if existing:
                 return web.json_response({
@@ -981,10 +1431,7 @@ async def api_add_friend(request):
                 })
             
             # Add bidirectional friendship
-            cursor.execute(
-                "INSERT INTO friendships (user_id, friend_id, status) VALUES (%s, %s, %s), (%s, %s, %s)",
-                (user_info['user_id'], friend_id, 'accepted', friend_id, user_info['user_id'], 'accepted')
-            )
+            session.execute('friends.insert_pair', (user_info['user_id'], friend_id, friend_id, user_info['user_id']))
         
         print(f"✅ [Friend] {user_info['username']} added {friend_username} as friend")
         
@@ -1010,32 +1457,14 @@ async def api_get_available_friends(request):
         }, status=401)
     
     try:
-        conn = get_db_connection()
-        cursor = conn.cursor()
-        
-        # Get accepted friend
-        cursor.execute("""
-            SELECT u.user_id, u.username
-            FROM users u
-            WHERE u.user_id != %s
-            AND u.user_id NOT IN (
-                SELECT f.friend_id
-                FROM friendships f
-                WHERE f.user_id = %s AND f.status = 'accepted'       
-            )
-            ORDER BY u.username
-        """, (user_info['user_id'], user_info['user_id']))
-        
+        # Users that are not yet accepted friends
         friends = []
-        for row in cursor.fetchall():
+        for row in db_queries.fetchall('users.not_friends', (user_info['user_id'], user_info['user_id'])):
             friends.append({
                 'user_id': row[0],
-                'username': row[1],
-                'created_at': str(row[2])
+                'username': row[1]
             })
         
-        conn.close()
-        
         return web.json_response({
             'status': 'success',
             'friends': friends,
@@ -1058,23 +1487,14 @@ async def api_get_friends(request):
         }, status=401)
     
     try:
-        with get_db_cursor() as (cursor, conn):
-            # Get accepted friends
-            cursor.execute("""
-                SELECT u.user_id, u.username, f.created_at 
-                FROM friendships f 
-                JOIN users u ON f.friend_id = u.user_id 
-                WHERE f.user_id = %s AND f.status = 'accepted'
-                ORDER BY u.username
-            """, (user_info['user_id'],))
-            
-            friends = []
-            for row in cursor.fetchall():
-                friends.append({
-                    'user_id': row[0],
-                    'username': row[1],
-                    'created_at': str(row[2]) if row[2] else None
-                })
+        # Get accepted friends
+        friends = []
+        for row in db_queries.fetchall('friends.list', (user_info['user_id'],)):
+            friends.append({
+                'user_id': row[0],
+                'username': row[1],
+                'created_at': str(row[2]) if row[2] else None
+            })
         
         return web.json_response({
             'status': 'success',
@@ -1103,42 +1523,12 @@ async def api_find_or_create_private_room(request):
         if current_user_id == peer_id:
             return web.json_response({'status': 'error', 'message': 'Cannot create a room with yourself'}, status=400)
 
-        with get_db_cursor() as (cursor, conn):
-            # Search for existing private room
-            cursor.execute("""
-                SELECT r.room_id
-                FROM rooms r
-                JOIN room_members rm ON r.room_id = rm.room_id
-                WHERE r.type = 'private'
-                  AND r.room_id IN (
-                    SELECT room_id FROM room_members WHERE user_id = %s
-                    INTERSECT
-                    SELECT room_id FROM room_members WHERE user_id = %s
-                  )
-                GROUP BY r.room_id
-                HAVING COUNT(rm.user_id) = 2
-            """, (current_user_id, peer_id))
-            
-            existing_room = cursor.fetchone()
-
-            if existing_room:
-                room_id = existing_room[0]
-                return web.json_response({'status': 'success', 'room_id': room_id, 'created': False})
-            else:
-                # Create new room
-                cursor.execute(
-                    "INSERT INTO rooms (type) VALUES ('private') RETURNING room_id"
-                )
-                new_room_id = cursor.fetchone()[0]
-
-                # Add members
-                cursor.execute(
-                    "INSERT INTO room_members (room_id, user_id) VALUES (%s, %s), (%s, %s)",
-                    (new_room_id, current_user_id, new_room_id, peer_id)
-                )
-                
-                print(f"✅ [Room] Created private room {new_room_id} for users {current_user_id} and {peer_id}")
-                return web.json_response({'status': 'success', 'room_id': new_room_id, 'created': True})
+        room_id, created = await asyncio.get_running_loop().run_in_executor(
+            None, find_or_create_private_room, current_user_id, peer_id
+        )
+        if created:
+            print(f"✅ [Room] Created private room {room_id} for users {current_user_id} and {peer_id}")
+        return web.json_response({'status': 'success', 'room_id': room_id, 'created': created})
 
     except Exception as e:
         print(f"❌ [Find/Create Room] Error: {e}")
@@ -1304,76 +1694,70 @@ async def api_send_message(request):
         
         if not room_id or not message_content:
             return web.json_response({'status': 'error', 'message': 'room_id and content are required'}, status=400)
-        
+
+        limited = await check_http_rate_limit(request, user_info, message_type in ['image', 'file'])
+        if limited:
+            return limited
+
         sender_id = user_info['user_id']
-        final_content = message_content
+        members = await asyncio.get_running_loop().run_in_executor(None, get_room_members, room_id)
+        if sender_id not in members:
+            return web.json_response({'status': 'error', 'message': 'Not a member of this room'}, status=403)
         original_filename = data.get('filename')
+        client_msg_id = data.get('client_msg_id')
 
-        # --- NEW: Handle file and image uploads ---
-        if message_type in ['image', 'file']:
-            # Create uploads directories if they don't exist
-            upload_dir = f"uploads/{message_type}s"
-            os.makedirs(upload_dir, exist_ok=True)
-            
-            # Decode the base64 content
-            try:
-                file_data = base64.b64decode(message_content)
-            except (ValueError, TypeError):
-                return web.json_response({'status': 'error', 'message': 'Invalid base64 content'}, status=400)
+        async def persist_message():
+            """Runs once per client_msg_id; a retried request gets the stored message back"""
+            final_content = message_content
 
-            # Create a unique filename to avoid collisions
-            file_extension = os.path.splitext(original_filename)[1]
-            unique_filename = f"{uuid.uuid4().hex}{file_extension}"
-            file_path = os.path.join(upload_dir, unique_filename)
+            # --- NEW: Handle file and image uploads ---
+            if message_type in ['image', 'file']:
+                # The content stored in the log is the URL path of the stored file
+                final_content = await asyncio.get_running_loop().run_in_executor(
+                    None, save_upload_file, sender_id, room_id, message_type, original_filename, message_content
+                )
+                print(f"✅ [{message_type.capitalize()} Saved] to {final_content}")
+
+            new_message = {
+                "sender_id": sender_id,
+                "sender_username": user_info['username'],
+                "timestamp": datetime.now(pytz.UTC).isoformat(),
+                "type": message_type,
+                "content": final_content,
+                "filename": original_filename, # Store original filename for display
+                "room_id": room_id,
+                "client_msg_id": client_msg_id
+            }
 
-            # Save the file to the server's disk
-            with open(file_path, 'wb') as f:
-                f.write(file_data)
-            
-            # The content stored in the log is now the URL path
-            final_content = f"/{file_path.replace(os.sep, '/')}"
-            print(f"✅ [{message_type.capitalize()} Saved] to {file_path}")
+            # Simpan pesan ke log file JSON (group commit)
+            new_message = await message_batcher.submit((room_id, new_message))
+            print(f"✅ [Message Saved to Room {room_id}] from {user_info['username']}")
+            if message_type in ['image', 'file']:
+                await asyncio.get_running_loop().run_in_executor(
+                    None, upload_store.attach, final_content, room_id, new_message.get('message_id')
+                )
+            return new_message
 
-        new_message = {
-            "sender_id": sender_id,
-            "sender_username": user_info['username'],
-            "timestamp": datetime.now(pytz.UTC).isoformat(),
-            "type": message_type,
-            "content": final_content,
-            "filename": original_filename, # Store original filename for display
-            "room_id": room_id
-        }
+        try:
+            new_message, is_duplicate = await send_dedup.submit(sender_id, client_msg_id, persist_message)
+        except UploadQuotaExceeded as e:
+            print(f"🚫 [Uploads] {user_info['username']}: {e}")
+            return upload_quota_response(e)
+        except ValueError as e:
+            return web.json_response({'status': 'error', 'message': str(e)}, status=400)
 
-        # ... (The rest of the function for saving to JSON and notifying clients is the same) ...
-        # ... (It saves the new_message object, which now contains the file path) ...
-        
-        # Simpan pesan ke log file JSON
-        async with chat_log_lock:
-            chat_data = load_chat_log()
-            if room_id not in chat_data.get("conversations", {}):
-                chat_data.setdefault("conversations", {})[room_id] = []
+        # Deliver to every other member (retries were already delivered by the first attempt)
+        if not is_duplicate:
+            await fan_out_room_message(room_id, new_message, sender_id)
             
-            chat_data["conversations"][room_id].append(new_message)
-            save_chat_log(chat_data)
-
-        print(f"✅ [Message Saved to Room {room_id}] from {user_info['username']}")
-        
-        # Find recipient and notify them
-        recipient_id = None
-        with get_db_cursor() as (cursor, conn):
-            cursor.execute("SELECT user_id FROM room_members WHERE room_id = %s", (int(room_id),))
-            members = cursor.fetchall()
-        
-        if members:
-            for member_tuple in members:
-                if member_tuple[0] != sender_id:
-                    recipient_id = member_tuple[0]
-                    break
-        
-        if recipient_id:
-            auth_bridge.add_message_for_user(recipient_id, new_message)
-            
-        return web.json_response({'status': 'success', 'message': 'Message processed successfully'})
+        return web.json_response({
+            'status': 'success',
+            'message': 'Message processed successfully',
+            'client_msg_id': client_msg_id,
+            'message_id': new_message.get('message_id'),
+            'seq': new_message.get('seq'),
+            'duplicate': is_duplicate
+        })
             
     except Exception as e:
         print(f"❌ [API Send Message] Error: {e}")
@@ -1395,21 +1779,26 @@ async def api_get_messages(request):
         # (Opsional tapi dianjurkan) Verifikasi bahwa user adalah anggota room
         # ... (logika ini bisa ditambahkan untuk keamanan) ...
 
-        messages_to_return = []
-        async with chat_log_lock:
-            chat_data = load_chat_log()
-            messages_to_return = chat_data.get("conversations", {}).get(room_id, [])
-
-        # Ubah format timestamp agar lebih ramah dibaca klien
-        for msg in messages_to_return:
-             iso_timestamp = datetime.fromisoformat(msg["timestamp"])
-             msg["timestamp"] = iso_timestamp.strftime("%I:%M %p").lower()
-
-        return web.json_response({
+        # Keyset pagination: ?before=<message_id>&limit=<n> pages back through older history
+        try:
+            before_id = int(request.query['before']) if request.query.get('before') else None
+            limit = max(1, min(int(request.query.get('limit', HISTORY_PAGE_SIZE)), 500))
+        except ValueError:
+            return web.json_response({'status': 'error', 'message': 'before and limit must be integers'}, status=400)
+
+        # Fetch one extra row to know whether an older page exists
+        page = message_store.get_room_fragments(room_id, limit=limit + 1, before_id=before_id)
+        has_more = len(page) > limit
+        page = page[-limit:]
+
+        # Records are spliced in as stored (ISO timestamps, formatted by the client), no re-encode
+        body = splice_json({
             'status': 'success',
             'room_id': room_id,
-            'messages': messages_to_return
-        })
+            'has_more': has_more,
+            'next_before': page[0][0] if has_more and page else None
+        }, {'messages': json_array(fragment for _, fragment in page)})
+        return web.Response(text=body, content_type='application/json')
 
     except Exception as e:
         print(f"❌ [API Get Messages] Error: {e}")
@@ -1494,49 +1883,44 @@ async def handle_websocket_login(ws, data):
             error_response = {
                 'type': 'login_response',
                 'status': 'error',
-                'message': 'Username and password are required'
+                'message': 'Username and password are required'
+            }
+            await ws.send_str(json.dumps(error_response))
+            return
+        
+        user = db_queries.fetchone('users.login', (username,))
+        
+        if user and verify_password(password, user[2]):
+            user_id, db_username, _ = user
+            
+            print(f"✅ [WS-Auth] User logged in: {username} (ID: {user_id})")
+            
+            token = create_jwt_token(user_id, username)
+            session_id = str(uuid.uuid4())
+            
+            success_response = {
+                'type': 'login_response',
+                'status': 'success',
+                'message': 'Login successful',
+                'user': {
+                    'user_id': user_id,
+                    'username': db_username
+                },
+                'token': token,
+                'session_id': session_id
+            }
+            
+            await ws.send_str(json.dumps(success_response))
+            print(f"📤 [WS-Auth] Login success sent to {username}")
+            
+        else:
+            error_response = {
+                'type': 'login_response',
+                'status': 'error',
+                'message': 'Invalid username or password'
             }
             await ws.send_str(json.dumps(error_response))
-            return
-        
-        with get_db_cursor() as (cursor, conn):
-            cursor.execute(
-                "SELECT user_id, username, password_hash FROM users WHERE username = %s",
-                (username,)
-            )
-            user = cursor.fetchone()
             
-            if user and verify_password(password, user[2]):
-                user_id, db_username, _ = user
-                
-                print(f"✅ [WS-Auth] User logged in: {username} (ID: {user_id})")
-                
-                token = create_jwt_token(user_id, username)
-                session_id = str(uuid.uuid4())
-                
-                success_response = {
-                    'type': 'login_response',
-                    'status': 'success',
-                    'message': 'Login successful',
-                    'user': {
-                        'user_id': user_id,
-                        'username': db_username
-                    },
-                    'token': token,
-                    'session_id': session_id
-                }
-                
-                await ws.send_str(json.dumps(success_response))
-                print(f"📤 [WS-Auth] Login success sent to {username}")
-                
-            else:
-                error_response = {
-                    'type': 'login_response',
-                    'status': 'error',
-                    'message': 'Invalid username or password'
-                }
-                await ws.send_str(json.dumps(error_response))
-                
     except Exception as e:
         print(f"❌ [WS-Auth] Login error: {e}")
         error_response = {
@@ -1563,33 +1947,28 @@ async def handle_websocket_registration(ws, data):
             return
         
         try:
-            with get_db_cursor() as (cursor, conn):
-                cursor.execute(
-                    "INSERT INTO users (username, password_hash) VALUES (%s, %s) RETURNING user_id",
-                    (username, password)
-                )
-                user_id = cursor.fetchone()[0]
-                
-                print(f"✅ [WS-Auth] New user registered: {username} (ID: {user_id})")
-                
-                token = create_jwt_token(user_id, username)
-                session_id = str(uuid.uuid4())
-                
-                success_response = {
-                    'type': 'register_response',
-                    'status': 'success',
-                    'message': 'Registration successful',
-                    'user': {
-                        'user_id': user_id,
-                        'username': username
-                    },
-                    'token': token,
-                    'session_id': session_id
-                }
-                
-                await ws.send_str(json.dumps(success_response))
-                print(f"📤 [WS-Auth] Registration success sent to {username}")
-                
+            user_id = db_queries.fetchone('users.insert', (username, password))[0]
+            
+            print(f"✅ [WS-Auth] New user registered: {username} (ID: {user_id})")
+            
+            token = create_jwt_token(user_id, username)
+            session_id = str(uuid.uuid4())
+            
+            success_response = {
+                'type': 'register_response',
+                'status': 'success',
+                'message': 'Registration successful',
+                'user': {
+                    'user_id': user_id,
+                    'username': username
+                },
+                'token': token,
+                'session_id': session_id
+            }
+            
+            await ws.send_str(json.dumps(success_response))
+            print(f"📤 [WS-Auth] Registration success sent to {username}")
+            
         except psycopg2.IntegrityError:
             error_response = {
                 'type': 'register_response',
@@ -1611,22 +1990,14 @@ async def handle_websocket_registration(ws, data):
 async def handle_get_friends_websocket(ws, user_info):
     """Handle get friends list via WebSocket"""
     try:
-        with get_db_cursor() as (cursor, conn):
-            cursor.execute("""
-                SELECT f.friend_id, u.username, f.created_at 
-                FROM friendships f 
-                JOIN users u ON f.friend_id = u.user_id 
-                WHERE f.user_id = %s AND f.status = 'accepted'
-                ORDER BY u.username
-            """, (user_info['user_id'],))
-            
-            friends = []
-            for row in cursor.fetchall():
-                friends.append({
-                    'user_id': row[0],
-                    'username': row[1],
-                    'created_at': str(row[2]) if row[2] else None
-                })
+        friends = []
+        for row in db_queries.fetchall('friends.list', (user_info['user_id'],)):
+            friends.append({
+                'user_id': row[0],
+                'username': row[1],
+                'created_at': str(row[2]) if row[2] else None,
+                'presence': auth_bridge.presence.get_state(row[0])
+            })
         
         response = {
             'type': 'friends_list_response',
@@ -1636,7 +2007,7 @@ async def handle_get_friends_websocket(ws, user_info):
             'timestamp': time.time()
         }
         
-        await ws.send_str(json.dumps(response))
+        await auth_bridge.send_ws(ws, response)
         print(f"📋 [WS] Sent friends list to {user_info['username']}: {len(friends)} friends")
         
     except Exception as e:
@@ -1646,7 +2017,7 @@ async def handle_get_friends_websocket(ws, user_info):
             'message': f'Failed to load friends: {str(e)}',
             'timestamp': time.time()
         }
-        await ws.send_str(json.dumps(error_response))
+        await auth_bridge.send_ws(ws, error_response)
 
 # 4. HANDLE ADD FRIEND VIA WEBSOCKET
 async def handle_add_friend_websocket(ws, user_info, data):
@@ -1661,16 +2032,12 @@ async def handle_add_friend_websocket(ws, user_info, data):
                 'message': 'Friend username is required',
                 'timestamp': time.time()
             }
-            await ws.send_str(json.dumps(error_response))
+            await auth_bridge.send_ws(ws, error_response)
             return
         
-        with get_db_cursor() as (cursor, conn):
+        with db_queries.transaction() as session:
             # Find friend by username
-            cursor.execute(
-                "SELECT user_id FROM users WHERE username = %s",
-                (friend_username,)
-            )
-            friend = cursor.fetchone()
+            friend = session.fetchone('users.id_by_username', (friend_username,))
             
             if not friend:
                 error_response = {
@@ -1679,7 +2046,7 @@ async def handle_add_friend_websocket(ws, user_info, data):
                     'message': 'User not found',
                     'timestamp': time.time()
                 }
-                await ws.send_str(json.dumps(error_response))
+                await auth_bridge.send_ws(ws, error_response)
                 return
             
             friend_id = friend[0]
@@ -1691,15 +2058,11 @@ async def handle_add_friend_websocket(ws, user_info, data):
                     'message': 'Cannot add yourself as friend',
                     'timestamp': time.time()
                 }
-                await ws.send_str(json.dumps(error_response))
+                await auth_bridge.send_ws(ws, error_response)
                 return
             
             # Check if friendship already exists
-            cursor.execute(
-                "SELECT status FROM friendships WHERE user_id = %s AND friend_id = %s",
-                (user_info['user_id'], friend_id)
-            )
-            existing = cursor.fetchone()
+            existing = session.fetchone('friends.status', (user_info['user_id'], friend_id))
             
             if existing:
                 error_response = {
@@ -1708,14 +2071,11 @@ async def handle_add_friend_websocket(ws, user_info, data):
                     'message': f'Friend request already exists with status: {existing[0]}',
                     'timestamp': time.time()
                 }
-                await ws.send_str(json.dumps(error_response))
+                await auth_bridge.send_ws(ws, error_response)
                 return
             
             # Add bidirectional friendship
-            cursor.execute(
-                "INSERT INTO friendships (user_id, friend_id, status) VALUES (%s, %s, %s), (%s, %s, %s)",
-                (user_info['user_id'], friend_id, 'accepted', friend_id, user_info['user_id'], 'accepted')
-            )
+            session.execute('friends.insert_pair', (user_info['user_id'], friend_id, friend_id, user_info['user_id']))
         
         success_response = {
             'type': 'add_friend_response',
@@ -1725,7 +2085,7 @@ async def handle_add_friend_websocket(ws, user_info, data):
             'timestamp': time.time()
         }
         
-        await ws.send_str(json.dumps(success_response))
+        await auth_bridge.send_ws(ws, success_response)
         print(f"✅ [WS] {user_info['username']} added {friend_username} as friend (bidirectional)")
         
     except Exception as e:
@@ -1735,7 +2095,7 @@ async def handle_add_friend_websocket(ws, user_info, data):
             'message': f'Internal server error: {str(e)}',
             'timestamp': time.time()
         }
-        await ws.send_str(json.dumps(error_response))
+        await auth_bridge.send_ws(ws, error_response)
 
 # 5. HANDLE SEARCH USER VIA WEBSOCKET
 async def handle_search_user_websocket(ws, user_info, data):
@@ -1750,15 +2110,10 @@ async def handle_search_user_websocket(ws, user_info, data):
                 'message': 'Username is required for search',
                 'timestamp': time.time()
             }
-            await ws.send_str(json.dumps(error_response))
+            await auth_bridge.send_ws(ws, error_response)
             return
         
-        with get_db_cursor() as (cursor, conn):
-            cursor.execute(
-                "SELECT user_id, username FROM users WHERE username = %s",
-                (search_username,)
-            )
-            user = cursor.fetchone()
+        user = db_queries.fetchone('users.by_username', (search_username,))
         
         if user:
             user_id, username = user
@@ -1771,7 +2126,7 @@ async def handle_search_user_websocket(ws, user_info, data):
                 },
                 'timestamp': time.time()
             }
-            await ws.send_str(json.dumps(success_response))
+            await auth_bridge.send_ws(ws, success_response)
             print(f"✅ [WS] User search: Found {username} for {user_info['username']}")
         else:
             error_response = {
@@ -1780,7 +2135,7 @@ async def handle_search_user_websocket(ws, user_info, data):
                 'message': f'User "{search_username}" not found',
                 'timestamp': time.time()
             }
-            await ws.send_str(json.dumps(error_response))
+            await auth_bridge.send_ws(ws, error_response)
             print(f"❌ [WS] User search: {search_username} not found")
         
     except Exception as e:
@@ -1791,7 +2146,7 @@ async def handle_search_user_websocket(ws, user_info, data):
             'message': f'Search failed: {str(e)}',
             'timestamp': time.time()
         }
-        await ws.send_str(json.dumps(error_response))
+        await auth_bridge.send_ws(ws, error_response)
 
 # 6. HANDLE FRIEND WEBSOCKET MESSAGES
 async def handle_friend_websocket_message(ws, user_info, data):
@@ -1814,41 +2169,27 @@ async def handle_friend_websocket_message(ws, user_info, data):
             'message': f'Error handling {message_type}: {str(e)}',
             'timestamp': time.time()
         }
-        await ws.send_str(json.dumps(error_response))
+        await auth_bridge.send_ws(ws, error_response)
         return True
 
 # 7. GET PREVIOUS CONVERSATIONS
-async def get_user_previous_conversations(user_id):
-    """Get previous conversations with actual messages for user"""
+async def get_user_previous_conversations(user_id, as_fragments=False):
+    """Get previous conversations with actual messages for user (encoded records with as_fragments)"""
     try:
         print(f"📚 [Server] Getting conversations with messages for user {user_id}")
         
-        # Load chat data from JSON
-        async with chat_log_lock:
-            chat_data = load_chat_log()
-            all_conversations = chat_data.get("conversations", {})
-        
-        user_conversations = {}
-        
-        with get_db_cursor() as (cursor, conn):
-            # Get all rooms where user is a member
-            cursor.execute("""
-                SELECT r.room_id
-                FROM rooms r
-                JOIN room_members rm ON r.room_id = rm.room_id
-                WHERE rm.user_id = %s AND r.type = 'private'
-            """, (user_id,))
-            
-            user_room_ids = [str(row[0]) for row in cursor.fetchall()]
-            print(f"📚 [Server] User {user_id} is member of rooms: {user_room_ids}")
-        
-        # Filter conversations to only include user's rooms and include actual messages
-        for room_id in user_room_ids:
-            if room_id in all_conversations:
-                messages = all_conversations[room_id]
-                if messages:  # Only include rooms with actual messages
-                    user_conversations[room_id] = messages
-                    print(f"📚 [Server] Added {len(messages)} messages for room {room_id}")
+        # Get all rooms where user is a member
+        user_room_ids = [str(row[0]) for row in db_queries.fetchall('rooms.private_of_user', (user_id,))]
+        print(f"📚 [Server] User {user_id} is member of rooms: {user_room_ids}")
+
+        # Last HISTORY_PAGE_SIZE messages of each room in one store call (empty rooms are omitted);
+        # older pages come from GET /api/messages/{room_id}?before=<message_id>
+        if as_fragments:
+            user_conversations = message_store.get_conversation_fragments(user_room_ids, limit_per_room=HISTORY_PAGE_SIZE)
+        else:
+            user_conversations = message_store.get_conversations(user_room_ids, limit_per_room=HISTORY_PAGE_SIZE)
+        for room_id, messages in user_conversations.items():
+            print(f"📚 [Server] Added {len(messages)} messages for room {room_id}")
         
         print(f"📚 [Server] Returning {len(user_conversations)} conversations with messages for user {user_id}")
         return user_conversations
@@ -1860,53 +2201,31 @@ async def get_user_previous_conversations(user_id):
         return {}
 
 # 8. GET OR CREATE ROOM ID
+def find_or_create_private_room(user_a, user_b):
+    """Private room of two users via the unique private_pair key; returns (room_id, created)"""
+    pair = private_pair_key(user_a, user_b)
+    with db_queries.transaction() as session:
+        existing_room = session.fetchone('rooms.by_private_pair', (pair,))
+        if existing_room:
+            return existing_room[0], False
+        
+        # Concurrent first messages race here; the unique key lets exactly one insert win
+        row = session.fetchone('rooms.insert_private', (pair,))
+        if row is None:
+            return session.fetchone('rooms.by_private_pair', (pair,))[0], False
+        
+        new_room_id = row[0]
+        session.execute('room_members.insert_pair', (new_room_id, int(user_a), new_room_id, int(user_b)))
+    invalidate_room_members(new_room_id)
+    return new_room_id, True
+
 def get_or_create_room_id(sender_id, recipient_id):
     """Cari room private antara dua user di database, atau buat baru jika belum ada."""
     try:
-        # Ensure both IDs are integers
-        sender_id = int(sender_id)
-        recipient_id = int(recipient_id)
-        
-        with get_db_cursor() as (cursor, conn):
-            # Cari room private yang berisi kedua user dengan query yang diperbaiki
-            cursor.execute("""
-                SELECT DISTINCT r.room_id
-                FROM rooms r
-                WHERE r.type = 'private'
-                  AND r.room_id IN (
-                    SELECT rm1.room_id 
-                    FROM room_members rm1 
-                    WHERE rm1.user_id = %s
-                  )
-                  AND r.room_id IN (
-                    SELECT rm2.room_id 
-                    FROM room_members rm2 
-                    WHERE rm2.user_id = %s
-                  )
-                  AND (
-                    SELECT COUNT(*) 
-                    FROM room_members rm3 
-                    WHERE rm3.room_id = r.room_id
-                  ) = 2
-                LIMIT 1
-            """, (sender_id, recipient_id))
-            
-            existing_room = cursor.fetchone()
-            if existing_room:
-                print(f"✅ Found existing room {existing_room[0]} for users {sender_id} and {recipient_id}")
-                return str(existing_room[0])
-            
-            # Jika belum ada, buat baru
-            cursor.execute(
-                "INSERT INTO rooms (type) VALUES ('private') RETURNING room_id"
-            )
-            new_room_id = cursor.fetchone()[0]
-            cursor.execute(
-                "INSERT INTO room_members (room_id, user_id) VALUES (%s, %s), (%s, %s)",
-                (new_room_id, sender_id, new_room_id, recipient_id)
-            )
-            print(f"✅ Created new room {new_room_id} for users {sender_id} and {recipient_id}")
-            return str(new_room_id)
+        room_id, created = find_or_create_private_room(sender_id, recipient_id)
+        if created:
+            print(f"✅ Created new room {room_id} for users {sender_id} and {recipient_id}")
+        return str(room_id)
             
     except Exception as e:
         print(f"❌ Error in get_or_create_room_id: {e}")
@@ -1933,18 +2252,13 @@ async def handle_new_message_save(user_info, data):
                 recipient_id = int(recipient_id)
             else:
                 # It's a username, convert to user_id
-                with get_db_cursor() as (cursor, conn):
-                    cursor.execute(
-                        "SELECT user_id FROM users WHERE username = %s",
-                        (recipient_id,)
-                    )
-                    user_result = cursor.fetchone()
-                    if user_result:
-                        recipient_id = user_result[0]
-                        print(f"💬 [Server] Converted username '{original_recipient}' to user_id {recipient_id}")
-                    else:
-                        print(f"❌ [Server] Username '{original_recipient}' not found")
-                        return None
+                user_result = db_queries.fetchone('users.id_by_username', (recipient_id,))
+                if user_result:
+                    recipient_id = user_result[0]
+                    print(f"💬 [Server] Converted username '{original_recipient}' to user_id {recipient_id}")
+                else:
+                    print(f"❌ [Server] Username '{original_recipient}' not found")
+                    return None
         
         # Get existing room or create new one
         room_id = get_or_create_room_id(user_info['user_id'], recipient_id)
@@ -1960,16 +2274,12 @@ async def handle_new_message_save(user_info, data):
             "recipient_id": recipient_id
         }
         
-        # Save to JSON file
-        async with chat_log_lock:
-            chat_data = load_chat_log()
-            conversations = chat_data.setdefault("conversations", {})
-
-            if room_id not in conversations:
-                conversations[room_id] = []
-
-            conversations[room_id].append(new_message)
-            save_chat_log(chat_data)
+        # Save to JSON file (group commit)
+        new_message = await message_batcher.submit((room_id, new_message))
+        record_message_in_inbox(room_id, new_message, {
+            user_info['user_id']: user_info['username'],
+            recipient_id: get_username(recipient_id)
+        })
         
         print(f"✅ [Message to Room {room_id}] from {user_info['username']} to recipient {recipient_id}")
         
@@ -1979,17 +2289,10 @@ async def handle_new_message_save(user_info, data):
             'room_id': room_id,
             'message': new_message
         }
-        # Send to recipient's WebSocket connections
-        sent_count = await auth_bridge.send_to_user_websockets(
-            target_user_id=recipient_id,
-            message=websocket_message
-        )
+        # Send to recipient's WebSocket connections, HTTP message queue if none is connected
+        sent_count = await auth_bridge.deliver_to_user(recipient_id, websocket_message)
         print(f"📤 [Server] Sent to {sent_count} WebSocket connections for user {recipient_id}")
         
-        # ENHANCED: Add to HTTP message queue for recipient
-        auth_bridge.add_message_for_user(recipient_id, websocket_message)
-        print(f"📦 [Server] Added message to HTTP queue for user {recipient_id}")
-        
         return new_message
         
     except Exception as e:
@@ -2001,37 +2304,31 @@ async def handle_new_message_save(user_info, data):
 # 10. BROADCAST FRIENDS UPDATE
 async def broadcast_friends_update_to_user(user_id):
     """Send updated friends list to all of user's friend list connections"""
+    friend_ids_cache.pop(user_id, None)  # presence fan-out must see the new friend
     try:
+        await sync_presence_subscriptions(user_id)
+        
         # Find all friend list connections for this user
         user_connections = []
-        for ws_client in auth_bridge.websocket_clients:
+        for ws_client in list(auth_bridge.user_sockets.get(user_id, ())):
             client_info = auth_bridge.websocket_clients[ws_client]
-            if (client_info['user_id'] == user_id and 
-                ('auto_friends' in client_info.get('session_id', '') or 
-                 'friends' in client_info.get('session_id', '') or
-                 client_info.get('session_id', '') == 'unknown')):
+            if ('auto_friends' in client_info.get('session_id', '') or 
+                'friends' in client_info.get('session_id', '') or
+                client_info.get('session_id', '') == 'unknown'):
                 user_connections.append((ws_client, client_info))
         
         if user_connections:
             print(f"📤 [WS] Broadcasting friends update to {len(user_connections)} connections for user {user_id}")
             
             # Get updated friends list
-            with get_db_cursor() as (cursor, conn):
-                cursor.execute("""
-                    SELECT f.friend_id, u.username, f.created_at
-                    FROM friendships f
-                    JOIN users u ON f.friend_id = u.user_id
-                    WHERE f.user_id = %s AND f.status = 'accepted'
-                    ORDER BY u.username
-                """, (user_id,))
-                
-                friends = []
-                for row in cursor.fetchall():
-                    friends.append({
-                        'user_id': row[0],
-                        'username': row[1],
-                        'created_at': str(row[2]) if row[2] else None
-                    })
+            friends = []
+            for row in db_queries.fetchall('friends.list', (user_id,)):
+                friends.append({
+                    'user_id': row[0],
+                    'username': row[1],
+                    'created_at': str(row[2]) if row[2] else None,
+                    'presence': auth_bridge.presence.get_state(row[0])
+                })
             
             # Send updated friends list to all friend list connections
             friends_update = {
@@ -2045,7 +2342,7 @@ async def broadcast_friends_update_to_user(user_id):
             
             for ws_client, client_info in user_connections:
                 try:
-                    await ws_client.send_str(json.dumps(friends_update))
+                    await auth_bridge.send_ws(ws_client, friends_update)
                     print(f"✅ [WS] Sent friends update to session {client_info.get('session_id', 'unknown')}")
                 except Exception as e:
                     print(f"❌ [WS] Failed to send friends update: {e}")
@@ -2053,6 +2350,584 @@ async def broadcast_friends_update_to_user(user_id):
     except Exception as e:
         print(f"❌ [WS] Error broadcasting friends update: {e}")
 
+# 11. ROOM MEMBERS & USERNAMES
+username_cache = {}  # user_id -> username (usernames never change)
+room_members_cache = {}  # room_id -> (expires_at, {user_id: username}); dropped on membership changes
+
+def get_username(user_id):
+    """Resolve a username with a process-wide cache"""
+    if user_id in username_cache:
+        return username_cache[user_id]
+    try:
+        row = db_queries.fetchone('users.username_by_id', (int(user_id),))
+    except Exception as e:
+        print(f"❌ [Users] Username lookup failed for {user_id}: {e}")
+        return None
+    if row:
+        username_cache[user_id] = row[0]
+        return row[0]
+    return None
+
+def get_room_members(room_id):
+    """Members of a room as {user_id: username}, cached for ROOM_MEMBERS_TTL seconds.
+
+    The returned dict is shared with the cache: read it, never modify it.
+    """
+    try:
+        room_id = int(room_id)
+    except (TypeError, ValueError):
+        return {}
+    cached = room_members_cache.get(room_id)
+    if cached and cached[0] > time.time():
+        return cached[1]
+    members = {row[0]: row[1] for row in db_queries.fetchall('room_members.by_room', (room_id,))}
+    username_cache.update(members)
+    # An empty result may be a room id that is about to be created; never cache it
+    if members:
+        room_members_cache[room_id] = (time.time() + ROOM_MEMBERS_TTL, members)
+    return members
+
+def invalidate_room_members(room_id):
+    room_members_cache.pop(int(room_id), None)
+
+# 12. INBOX
+def build_user_inbox(user_id):
+    """Build a user's inbox from storage: rooms + peer from DB, last message from the store"""
+    rows = db_queries.fetchall('rooms.inbox_of_user', (user_id,))
+
+    rooms = {}
+    for room_id, room_type, room_name, peer_id, peer_username in rows:
+        if str(room_id) in rooms:
+            continue
+        if room_type == 'private':
+            rooms[str(room_id)] = (peer_id, peer_username)
+        else:
+            rooms[str(room_id)] = (None, room_name)
+
+    last_messages = message_store.get_conversations(list(rooms), limit_per_room=1)
+    cursors = read_cursors.get_user_cursors(user_id)
+    unread = message_store.count_unread(user_id, {
+        room_id: cursors.get(room_id, 0) for room_id in last_messages
+    })
+    entries = []
+    for room_id, messages in last_messages.items():
+        peer_id, peer_username = rooms[room_id]
+        entries.append(inbox_index.make_entry(room_id, peer_id, peer_username, last_message=messages[-1],
+                                              unread_count=unread.get(room_id, 0)))
+    inbox_index.load_user(user_id, entries)
+
+async def get_user_inbox(user_id):
+    """Inbox entries for a user (built from storage on first access)"""
+    try:
+        if not inbox_index.is_loaded(user_id):
+            build_user_inbox(user_id)
+        return inbox_index.get_inbox(user_id) or []
+    except Exception as e:
+        print(f"❌ [Inbox] Error building inbox for user {user_id}: {e}")
+        return []
+
+def record_message_in_inbox(room_id, message, members):
+    """O(1)-per-member inbox update after a message is saved"""
+    try:
+        inbox_index.record_message(room_id, message, members)
+    except Exception as e:
+        print(f"❌ [Inbox] Error updating inbox for room {room_id}: {e}")
+
+async def api_get_inbox(request):
+    """Compact inbox: one entry per room, no message history"""
+    user_info = get_user_from_token(request)
+    if not user_info:
+        return web.json_response({'status': 'error', 'message': 'Authentication required'}, status=401)
+    
+    rooms = await get_user_inbox(user_info['user_id'])
+    return web.json_response({
+        'status': 'success',
+        'rooms': rooms,
+        'count': len(rooms),
+        'timestamp': time.time()
+    })
+
+# 13. OFFLINE MAILBOX
+async def send_mailbox_drain(ws, user_id, cursor):
+    """Ack the mailbox up to `cursor` and send whatever is newer (one frame, empty means drained)"""
+    try:
+        cursor = int(cursor or 0)
+    except (TypeError, ValueError):
+        cursor = 0
+    loop = asyncio.get_running_loop()
+    messages = await loop.run_in_executor(None, functools.partial(
+        auth_bridge.get_messages_for_user, user_id, after_seq=cursor
+    ))
+    await auth_bridge.send_ws(ws, {
+        "type": "mailbox",
+        "messages": messages,
+        "next_cursor": max((msg.get('mailbox_seq', 0) for msg in messages), default=cursor),
+        "timestamp": time.time()
+    })
+
+async def mailbox_purge_loop():
+    """Drop mailbox entries past the retention period"""
+    loop = asyncio.get_running_loop()
+    while True:
+        await asyncio.sleep(MAILBOX_PURGE_INTERVAL)
+        try:
+            deleted = await loop.run_in_executor(None, auth_bridge.mailbox.purge_expired)
+            if deleted:
+                print(f"🧹 [Mailbox] Purged {deleted} expired messages")
+        except Exception as e:
+            print(f"❌ [Mailbox] Purge failed: {e}")
+
+async def upload_sweep_loop():
+    """Index pre-existing uploads once, then periodically delete files no message references"""
+    loop = asyncio.get_running_loop()
+    try:
+        await loop.run_in_executor(None, upload_store.backfill, message_store)
+    except Exception as e:
+        print(f"❌ [Uploads] Backfill failed: {e}")
+    while True:
+        await asyncio.sleep(UPLOAD_SWEEP_INTERVAL)
+        try:
+            removed, reclaimed = await loop.run_in_executor(None, upload_store.sweep, message_store)
+            if removed:
+                print(f"🧹 [Uploads] Deleted {removed} orphaned files ({reclaimed / (1024 * 1024):.1f} MB)")
+        except Exception as e:
+            print(f"❌ [Uploads] Sweep failed: {e}")
+
+async def api_get_upload_usage(request):
+    """Storage used by the caller's uploads and their quota"""
+    user_info = get_user_from_token(request)
+    if not user_info:
+        return web.json_response({'status': 'error', 'message': 'Authentication required'}, status=401)
+    usage = await asyncio.get_running_loop().run_in_executor(None, upload_store.usage, user_info['user_id'])
+    return web.json_response({'status': 'success', **usage})
+
+async def archive_loop():
+    """Move old room history into the cold archive (the hot store keeps the recent tail)"""
+    loop = asyncio.get_running_loop()
+    while True:
+        try:
+            moved = await loop.run_in_executor(None, functools.partial(
+                tiered_store.archive_old,
+                keep_recent=max(ARCHIVE_KEEP_RECENT, ROOM_TAIL_SIZE, HISTORY_PAGE_SIZE + 1),
+                max_age_seconds=ARCHIVE_AFTER_DAYS * 86400,
+                max_hot=ARCHIVE_MAX_HOT
+            ))
+            if moved:
+                print(f"🧊 [Archive] Moved {moved} messages to cold storage")
+        except Exception as e:
+            print(f"❌ [Archive] Archiving failed: {e}")
+        await asyncio.sleep(ARCHIVE_INTERVAL)
+
+# 14. PRESENCE
+friend_ids_cache = {}  # user_id -> (expires_at, set of accepted friend ids)
+
+def get_friend_ids(user_id):
+    """Accepted friends of a user, cached for PRESENCE_FRIENDS_TTL seconds"""
+    cached = friend_ids_cache.get(user_id)
+    if cached and cached[0] > time.time():
+        return cached[1]
+    friend_ids = {row[0] for row in db_queries.fetchall('friends.ids', (user_id,))}
+    friend_ids_cache[user_id] = (time.time() + PRESENCE_FRIENDS_TTL, friend_ids)
+    return friend_ids
+
+async def presence_broadcast_loop():
+    """Every interval: apply timeouts, then send each presence subscriber one batched frame"""
+    while True:
+        await asyncio.sleep(PRESENCE_BROADCAST_INTERVAL)
+        try:
+            auth_bridge.presence.sweep()
+            changes = auth_bridge.presence.drain_changes()
+            if not changes:
+                continue
+            
+            batches = defaultdict(list)  # subscribed connection -> [update, ...]
+            for user_id, state in changes.items():
+                for ws in auth_bridge.subscriptions.subscribers(presence_topic(user_id)):
+                    batches[ws].append({'user_id': user_id, 'state': state})
+            
+            now = time.time()
+            for ws, updates in batches.items():
+                await auth_bridge.send_ws(ws, {
+                    "type": "presence",
+                    "updates": updates,
+                    "timestamp": now
+                })
+            if batches:
+                print(f"🟢 [Presence] {len(changes)} changes -> {len(batches)} recipients")
+        except Exception as e:
+            print(f"❌ [Presence] Broadcast failed: {e}")
+
+# 15. READ RECEIPTS
+async def apply_read_acks(user_id, acks):
+    """Apply {room_id: last_read_message_id} acks: move cursors, fix unread counts, queue receipts"""
+    loop = asyncio.get_running_loop()
+    advanced, room_members = {}, {}
+    for room_id, message_id in (acks or {}).items():
+        try:
+            room_id, message_id = str(room_id), int(message_id)
+        except (TypeError, ValueError):
+            continue
+        # Only members may move a room's cursor (and send receipts to its members)
+        try:
+            members = await loop.run_in_executor(None, get_room_members, room_id)
+        except Exception as e:
+            print(f"❌ [Receipts] Could not load members of room {room_id}: {e}")
+            continue
+        if user_id not in members:
+            continue
+        if await loop.run_in_executor(None, read_cursors.advance, user_id, room_id, message_id):
+            advanced[room_id] = message_id
+            room_members[room_id] = members
+    if not advanced:
+        return advanced
+
+    # Unread count: 0 if the ack reaches the newest message, otherwise count what is left
+    inbox = {entry['room_id']: entry for entry in (inbox_index.get_inbox(user_id) or [])}
+    partial = {room_id: message_id for room_id, message_id in advanced.items()
+               if inbox.get(room_id) and (inbox[room_id]['last_message_id'] or 0) > message_id}
+    remaining = await loop.run_in_executor(None, message_store.count_unread, user_id, partial) if partial else {}
+    for room_id, message_id in advanced.items():
+        inbox_index.mark_read(user_id, room_id, remaining.get(room_id, 0))
+        receipt_throttler.queue(room_members[room_id], room_id, user_id, message_id)
+    return advanced
+
+async def receipt_push_loop():
+    """Push coalesced read receipts once per interval (one frame per recipient)"""
+    while True:
+        await asyncio.sleep(RECEIPT_PUSH_INTERVAL)
+        for recipient_id, receipts in receipt_throttler.drain().items():
+            try:
+                await auth_bridge.send_to_user_websockets(recipient_id, {
+                    "type": "read_receipts",
+                    "receipts": receipts,
+                    "timestamp": time.time()
+                })
+            except Exception as e:
+                print(f"❌ [Receipts] Push to user {recipient_id} failed: {e}")
+
+async def read_cursor_flush_loop():
+    """Write dirty read cursors back to the store in one batch per interval"""
+    loop = asyncio.get_running_loop()
+    while True:
+        await asyncio.sleep(READ_CURSOR_FLUSH_INTERVAL)
+        try:
+            await loop.run_in_executor(None, read_cursors.flush)
+        except Exception as e:
+            print(f"❌ [Receipts] Cursor flush failed (will retry): {e}")
+
+async def api_mark_read(request):
+    """HTTP variant of read_up_to: {"rooms": {room_id: message_id}}"""
+    user_info = get_user_from_token(request)
+    if not user_info:
+        return web.json_response({'status': 'error', 'message': 'Authentication required'}, status=401)
+    try:
+        data = await request.json()
+    except json.JSONDecodeError:
+        return web.json_response({'status': 'error', 'message': 'Invalid JSON'}, status=400)
+    
+    acks = data.get('rooms') or {data.get('room_id'): data.get('message_id')}
+    advanced = await apply_read_acks(user_info['user_id'], acks)
+    return web.json_response({
+        'status': 'success',
+        'rooms': advanced,
+        'timestamp': time.time()
+    })
+
+# 16. SUBSCRIPTIONS
+def authorize_topics(user_id, topics):
+    """Split requested topics into (allowed, denied); rooms need membership, presence needs friendship.
+
+    Blocking (DB lookups), run in an executor.
+    """
+    allowed, denied = [], []
+    friend_ids = None
+    for topic in topics:
+        try:
+            kind, key = parse_topic(topic)
+        except ValueError:
+            denied.append(topic)
+            continue
+        if kind == 'room':
+            permitted = user_id in get_room_members(key)
+        elif kind == 'presence':
+            if friend_ids is None:
+                friend_ids = get_friend_ids(user_id)
+            permitted = key == user_id or key in friend_ids
+        else:
+            permitted = True
+        if permitted:
+            allowed.append(normalize_topic(topic))
+        else:
+            denied.append(topic)
+    return allowed, denied
+
+async def authorize_publish(user_id, data):
+    """Topic for an untargeted message ("topic", else room_id); None if missing or not allowed.
+
+    Users only publish to rooms they are members of. `system` and presence topics are
+    written by the server alone, so a message naming no room is rejected, never broadcast.
+    """
+    if data.get('topic'):
+        topic = data['topic']
+    elif data.get('room_id'):
+        topic = f"room:{data['room_id']}"
+    else:
+        return None
+    try:
+        kind, _ = parse_topic(topic)
+    except ValueError:
+        return None
+    if kind != 'room':
+        return None
+    loop = asyncio.get_running_loop()
+    allowed, denied = await loop.run_in_executor(None, authorize_topics, user_id, [topic])
+    return allowed[0] if allowed else None
+
+async def handle_subscription_message(ws, user_info, data):
+    """Handle subscribe / unsubscribe frames; returns True if the frame was one of them"""
+    message_type = data.get('type')
+    if message_type not in ('subscribe', 'unsubscribe'):
+        return False
+    topics = data.get('topics') or []
+    if isinstance(topics, str):
+        topics = [topics]
+    if not isinstance(topics, list) or len(topics) > MAX_TOPICS_PER_CONNECTION:
+        # Checked before authorize_topics, which costs a member lookup per room topic
+        await auth_bridge.send_ws(ws, {
+            "type": "error",
+            "message": f"topics must be a list of at most {MAX_TOPICS_PER_CONNECTION} topics"
+        })
+        return True
+    
+    if message_type == 'unsubscribe':
+        normalized = []
+        for topic in topics:
+            try:
+                normalized.append(normalize_topic(topic))
+            except ValueError:
+                pass
+        removed = auth_bridge.subscriptions.unsubscribe(ws, normalized)
+        await auth_bridge.send_ws(ws, {"type": "unsubscribed", "topics": removed, "timestamp": time.time()})
+        return True
+    
+    loop = asyncio.get_running_loop()
+    allowed, denied = await loop.run_in_executor(None, authorize_topics, user_info['user_id'], topics)
+    added = auth_bridge.subscriptions.subscribe(ws, allowed)
+    await auth_bridge.send_ws(ws, {
+        "type": "subscribed",
+        "topics": added,
+        "denied": denied,
+        "timestamp": time.time()
+    })
+    print(f"📌 [Subscriptions] {user_info['username']} +{len(added)} topics, {len(denied)} denied")
+    return True
+
+def get_user_room_ids(user_id):
+    """Ids of every room a user is a member of (blocking)"""
+    return {row[0] for row in db_queries.fetchall('rooms.inbox_of_user', (user_id,))}
+
+async def subscribe_default_topics(ws, user_id):
+    """Subscribe a new connection to system and to the rooms its user belongs to"""
+    auth_bridge.subscriptions.subscribe(ws, [TOPIC_SYSTEM])
+    try:
+        room_ids = await asyncio.get_running_loop().run_in_executor(None, get_user_room_ids, user_id)
+    except Exception as e:
+        print(f"❌ [Subscriptions] Could not load rooms of user {user_id}: {e}")
+        return
+    auth_bridge.subscriptions.subscribe(ws, [room_topic(room_id) for room_id in sorted(room_ids)])
+
+async def sync_presence_subscriptions(user_id):
+    """Subscribe a user's connections to presence:<friend> for every friend (and friends to theirs)"""
+    sockets = list(auth_bridge.user_sockets.get(user_id, ()))
+    if not sockets:
+        return
+    loop = asyncio.get_running_loop()
+    friend_ids = await loop.run_in_executor(None, get_friend_ids, user_id)
+    wanted = {presence_topic(friend_id) for friend_id in friend_ids}
+    for ws in sockets:
+        current = {topic for topic in auth_bridge.subscriptions.topics_of(ws) if topic.startswith('presence:')}
+        auth_bridge.subscriptions.unsubscribe(ws, current - wanted)
+        auth_bridge.subscriptions.subscribe(ws, wanted - current)
+    # Friendship is mutual: connected friends start following this user too (idempotent)
+    own_topic = [presence_topic(user_id)]
+    for friend_id in friend_ids:
+        for ws in list(auth_bridge.user_sockets.get(friend_id, ())):
+            auth_bridge.subscriptions.subscribe(ws, own_topic)
+
+# 17. GROUP ROOMS
+async def fan_out_room_message(room_id, message, sender_id, exclude_ws=None):
+    """Deliver a saved message to every other member of a room.
+
+    Online members get one frame (encoded once per protocol); members without a live
+    connection (or with an HTTP poller) are queued in a single mailbox batch.
+    """
+    loop = asyncio.get_running_loop()
+    members = await loop.run_in_executor(None, get_room_members, room_id)
+    record_message_in_inbox(room_id, message, members)
+    
+    online, offline = [], []
+    for user_id in members:
+        if user_id != sender_id:
+            (online if user_id in auth_bridge.user_sockets else offline).append(user_id)
+    sent = await auth_bridge.send_to_users_websockets(online, {"type": "new_message", "message": message}, exclude_ws)
+    # HTTP pollers read only the mailbox, even when they also have a socket open
+    offline += [user_id for user_id in online if auth_bridge.needs_mailbox(user_id, True)]
+    if offline:
+        await auth_bridge.add_message_for_users(offline, message)
+    if len(members) > 2:
+        print(f"👥 [Group] Room {room_id}: {sent} live frames, {len(offline)} members queued offline")
+    return members
+
+def get_member_role(room_id, user_id):
+    """Role of a user in a room ('admin' / 'member'), None if not a member"""
+    row = db_queries.fetchone('room_members.role', (room_id, user_id))
+    return row[0] if row else None
+
+def create_group_room(creator_id, name, member_ids):
+    """Insert a group room with the creator as admin; returns (room_id, [added member ids])"""
+    with db_queries.transaction() as session:
+        room_id = session.fetchone('rooms.insert_group', (name,))[0]
+        session.execute('room_members.insert_admin', (room_id, creator_id))
+        added = insert_room_members(session, room_id, member_ids)
+    print(f"✅ [Group] Created room {room_id} '{name}' with {len(added) + 1} members")
+    return room_id, added
+
+def insert_room_members(session, room_id, user_ids):
+    """One statement for any number of members; unknown users and existing members are skipped"""
+    if not user_ids:
+        return []
+    return [row[0] for row in session.fetchall('room_members.insert_many', (room_id, list(user_ids)))]
+
+def add_group_members(room_id, user_ids):
+    with db_queries.transaction() as session:
+        return insert_room_members(session, room_id, user_ids)
+
+def remove_group_member(room_id, user_id):
+    return db_queries.execute('room_members.delete', (room_id, user_id)) > 0
+
+def get_room_member_details(room_id):
+    return db_queries.fetchall('rooms.member_details', (room_id,))
+
+async def on_room_membership_changed(room_id, user_ids, action):
+    """Drop cached member lists, rebuild affected inboxes and tell the affected users"""
+    invalidate_room_members(room_id)
+    for user_id in user_ids:
+        inbox_index.forget_user(user_id)  # rebuilt from storage (with / without the room) on next access
+        for ws in list(auth_bridge.user_sockets.get(user_id, ())):
+            if action == 'removed':
+                auth_bridge.subscriptions.unsubscribe(ws, [room_topic(room_id)])
+            else:
+                auth_bridge.subscriptions.subscribe(ws, [room_topic(room_id)])
+    await auth_bridge.send_to_users_websockets(user_ids, {
+        "type": "room_membership",
+        "room_id": str(room_id),
+        "action": action,
+        "timestamp": time.time()
+    })
+
+async def api_create_group_room(request):
+    """Create a group room: {"name": str, "member_ids": [user_id, ...]}; the creator becomes admin"""
+    user_info = get_user_from_token(request)
+    if not user_info:
+        return web.json_response({'status': 'error', 'message': 'Authentication required'}, status=401)
+    try:
+        data = await request.json()
+        name = (data.get('name') or '').strip()
+        member_ids = {int(user_id) for user_id in data.get('member_ids') or []}
+    except (json.JSONDecodeError, TypeError, ValueError):
+        return web.json_response({'status': 'error', 'message': 'name and integer member_ids are required'}, status=400)
+    member_ids.discard(user_info['user_id'])
+    if not name:
+        return web.json_response({'status': 'error', 'message': 'name is required'}, status=400)
+    if len(member_ids) + 1 > GROUP_MAX_MEMBERS:
+        return web.json_response({'status': 'error', 'message': f'Groups are limited to {GROUP_MAX_MEMBERS} members'}, status=400)
+    
+    loop = asyncio.get_running_loop()
+    try:
+        room_id, added = await loop.run_in_executor(None, create_group_room, user_info['user_id'], name, member_ids)
+    except Exception as e:
+        print(f"❌ [Group] Create failed: {e}")
+        return web.json_response({'status': 'error', 'message': 'Internal server error'}, status=500)
+    await on_room_membership_changed(room_id, [user_info['user_id'], *added], 'added')
+    return web.json_response({
+        'status': 'success',
+        'room_id': room_id,
+        'name': name,
+        'member_count': len(added) + 1,
+        'skipped': sorted(member_ids - set(added))
+    })
+
+async def api_get_room_members(request):
+    """Members of a room with roles and presence (members only)"""
+    user_info = get_user_from_token(request)
+    if not user_info:
+        return web.json_response({'status': 'error', 'message': 'Authentication required'}, status=401)
+    try:
+        room_id = int(request.match_info['room_id'])
+    except ValueError:
+        return web.json_response({'status': 'error', 'message': 'Invalid room_id'}, status=400)
+    
+    rows = await asyncio.get_running_loop().run_in_executor(None, get_room_member_details, room_id)
+    if not any(row[2] == user_info['user_id'] for row in rows):
+        return web.json_response({'status': 'error', 'message': 'Not a member of this room'}, status=403)
+    return web.json_response({
+        'status': 'success',
+        'room_id': room_id,
+        'type': rows[0][0],
+        'name': rows[0][1],
+        'members': [{
+            'user_id': user_id,
+            'username': username,
+            'role': role,
+            'presence': auth_bridge.presence.get_state(user_id)
+        } for _, _, user_id, username, role in rows],
+        'count': len(rows)
+    })
+
+async def api_add_room_members(request):
+    """Add members to a group room: {"user_ids": [...]} (admins only)"""
+    user_info = get_user_from_token(request)
+    if not user_info:
+        return web.json_response({'status': 'error', 'message': 'Authentication required'}, status=401)
+    try:
+        room_id = int(request.match_info['room_id'])
+        data = await request.json()
+        user_ids = {int(user_id) for user_id in data.get('user_ids') or []}
+    except (json.JSONDecodeError, TypeError, ValueError):
+        return web.json_response({'status': 'error', 'message': 'Integer user_ids are required'}, status=400)
+    
+    loop = asyncio.get_running_loop()
+    if await loop.run_in_executor(None, get_member_role, room_id, user_info['user_id']) != 'admin':
+        return web.json_response({'status': 'error', 'message': 'Only group admins can add members'}, status=403)
+    members = await loop.run_in_executor(None, get_room_members, room_id)
+    if len(members) + len(user_ids - set(members)) > GROUP_MAX_MEMBERS:
+        return web.json_response({'status': 'error', 'message': f'Groups are limited to {GROUP_MAX_MEMBERS} members'}, status=400)
+    
+    added = await loop.run_in_executor(None, add_group_members, room_id, user_ids)
+    if added:
+        await on_room_membership_changed(room_id, added, 'added')
+    return web.json_response({'status': 'success', 'room_id': room_id, 'added': added})
+
+async def api_remove_room_member(request):
+    """Remove a member (admins) or leave a group (the member themself)"""
+    user_info = get_user_from_token(request)
+    if not user_info:
+        return web.json_response({'status': 'error', 'message': 'Authentication required'}, status=401)
+    try:
+        room_id = int(request.match_info['room_id'])
+        target_id = int(request.match_info['user_id'])
+    except ValueError:
+        return web.json_response({'status': 'error', 'message': 'Invalid room_id or user_id'}, status=400)
+    
+    loop = asyncio.get_running_loop()
+    if target_id != user_info['user_id'] and \
+            await loop.run_in_executor(None, get_member_role, room_id, user_info['user_id']) != 'admin':
+        return web.json_response({'status': 'error', 'message': 'Only group admins can remove members'}, status=403)
+    if not await loop.run_in_executor(None, remove_group_member, room_id, target_id):
+        return web.json_response({'status': 'error', 'message': 'Not a member of this room'}, status=404)
+    await on_room_membership_changed(room_id, [target_id], 'removed')
+    return web.json_response({'status': 'success', 'room_id': room_id, 'removed': target_id})
+
 async def serve_auth_interface(request):
     """Serve enhanced HTML interface dengan authentication"""
     client_ip = request.remote
@@ -2839,6 +3714,31 @@ async def serve_auth_interface(request):
     """
     return web.Response(text=html_content, content_type='text/html')
 
+async def start_background_tasks(app):
+    """Start the read receipt push, cursor flush, mailbox purge, presence, upload sweep and archive loops"""
+    app['background_tasks'] = [
+        asyncio.ensure_future(receipt_push_loop()),
+        asyncio.ensure_future(read_cursor_flush_loop()),
+        asyncio.ensure_future(mailbox_purge_loop()),
+        asyncio.ensure_future(presence_broadcast_loop()),
+        asyncio.ensure_future(upload_sweep_loop())
+    ]
+    if tiered_store is not None:
+        app['background_tasks'].append(asyncio.ensure_future(archive_loop()))
+
+async def flush_pending_writes(app):
+    """Flush write-behind batches and read cursors on shutdown"""
+    for task in app.get('background_tasks', []):
+        task.cancel()
+    await message_batcher.flush()
+    print(f"💾 [Batcher] Flushed pending writes: {message_batcher.stats}")
+    try:
+        flushed = await asyncio.get_running_loop().run_in_executor(None, read_cursors.flush)
+        print(f"💾 [Receipts] Flushed {flushed} read cursors")
+    except Exception as e:
+        print(f"❌ [Receipts] Final cursor flush failed: {e}")
+    db_queries.close()
+
 async def create_app():
     """Create and configure the web application"""
     app = web.Application()
@@ -2878,11 +3778,22 @@ async def create_app():
     app.router.add_post('/api/rooms/find-or-create', api_find_or_create_private_room) # BARU
     app.router.add_post('/api/send_message', api_send_message) # Sudah diubah
     app.router.add_get('/api/messages/{room_id}', api_get_messages) # URL diubah dari {contact}
+    app.router.add_get('/api/inbox', api_get_inbox)
+    app.router.add_post('/api/rooms/group', api_create_group_room)
+    app.router.add_get('/api/rooms/{room_id}/members', api_get_room_members)
+    app.router.add_post('/api/rooms/{room_id}/members', api_add_room_members)
+    app.router.add_delete('/api/rooms/{room_id}/members/{user_id}', api_remove_room_member)
+    app.router.add_post('/api/read', api_mark_read)
+    app.router.add_get('/api/uploads/usage', api_get_upload_usage)
     # app.router.add_post('/api/accept_friend', api_accept_friend)
     
     # Web interface
     app.router.add_get('/', serve_auth_interface)
     
+    # Background loops (read receipts) + persist any batched writes before shutting down
+    app.on_startup.append(start_background_tasks)
+    app.on_shutdown.append(flush_pending_writes)
+    
     # Add CORS to all routes
     for route in list(app.router.routes()):
         cors.add(route)
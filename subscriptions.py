@@ -0,0 +1,95 @@
+"""Topic subscriptions for WebSocket connections (room:<id>, presence:<user_id>, system)."""
+
+from collections import defaultdict
+
+TOPIC_SYSTEM = 'system'
+
+
+def room_topic(room_id):
+    return f"room:{room_id}"
+
+
+def presence_topic(user_id):
+    return f"presence:{user_id}"
+
+
+def parse_topic(topic):
+    """Split a topic into (kind, key): 'room:7' -> ('room', 7), 'system' -> ('system', None).
+
+    Raises ValueError for unknown kinds or non-numeric ids.
+    """
+    if topic == TOPIC_SYSTEM:
+        return TOPIC_SYSTEM, None
+    kind, sep, key = str(topic).partition(':')
+    if not sep or kind not in ('room', 'presence'):
+        raise ValueError(f"Unknown topic: {topic}")
+    return kind, int(key)
+
+
+def normalize_topic(topic):
+    """Canonical spelling of a topic ('room:007' -> 'room:7'); raises ValueError if invalid"""
+    kind, key = parse_topic(topic)
+    return kind if key is None else f"{kind}:{key}"
+
+
+class SubscriptionRegistry:
+    """Two-way index: topic -> connections and connection -> topics.
+
+    publish cost is O(subscribers of the topic); dropping a connection is O(its topics).
+    """
+
+    def __init__(self, max_topics_per_connection=500):
+        self.max_topics_per_connection = max_topics_per_connection
+        self._subscribers = defaultdict(set)  # topic -> {ws}
+        self._topics = defaultdict(set)       # ws -> {topic}
+        self.stats = {'topics': 0, 'subscriptions': 0, 'publishes': 0, 'delivered': 0}
+
+    def _update_stats(self, delta):
+        self.stats['topics'] = len(self._subscribers)
+        self.stats['subscriptions'] += delta
+
+    def subscribe(self, ws, topics):
+        """Add subscriptions; returns the topics that were newly added"""
+        current = self._topics[ws]
+        added = []
+        for topic in topics:
+            if topic in current:
+                continue
+            if len(current) >= self.max_topics_per_connection:
+                break
+            current.add(topic)
+            self._subscribers[topic].add(ws)
+            added.append(topic)
+        self._update_stats(len(added))
+        return added
+
+    def unsubscribe(self, ws, topics):
+        current = self._topics.get(ws)
+        if not current:
+            return []
+        removed = []
+        for topic in topics:
+            if topic not in current:
+                continue
+            current.discard(topic)
+            subscribers = self._subscribers.get(topic)
+            if subscribers is not None:
+                subscribers.discard(ws)
+                if not subscribers:
+                    del self._subscribers[topic]
+            removed.append(topic)
+        if not current:
+            self._topics.pop(ws, None)
+        self._update_stats(-len(removed))
+        return removed
+
+    def drop(self, ws):
+        """Forget a closed connection and all of its subscriptions"""
+        self.unsubscribe(ws, list(self._topics.get(ws, ())))
+
+    def subscribers(self, topic):
+        """Connections subscribed to a topic (a copy, safe to iterate while sending)"""
+        return list(self._subscribers.get(topic, ()))
+
+    def topics_of(self, ws):
+        return set(self._topics.get(ws, ()))
@@ -0,0 +1,166 @@
+"""Behaviour shared by the JSON, SQLite and segment message stores (PostgreSQL needs a server)."""
+
+import io
+import os
+
+import pytest
+
+import chat_transfer
+from message_store import JsonMessageStore, SegmentMessageStore, SqliteMessageStore
+
+BACKENDS = ['json', 'sqlite', 'segment']
+
+
+def open_store(backend, directory):
+    if backend == 'json':
+        return JsonMessageStore(os.path.join(directory, 'chat_log.json'))
+    if backend == 'sqlite':
+        return SqliteMessageStore(os.path.join(directory, 'chat_messages.db'))
+    return SegmentMessageStore(os.path.join(directory, 'segments'))
+
+
+def message(i, sender_id=1, **extra):
+    return {'sender_id': sender_id, 'sender_username': f"user{sender_id}", 'content': f"message {i}",
+            'timestamp': f"2024-01-01T00:00:{i % 60:02d}+00:00", **extra}
+
+
+def summary(messages):
+    return [(m['message_id'], m['seq'], m['sender_id'], m['content']) for m in messages]
+
+
+@pytest.fixture(params=BACKENDS)
+def backend(request):
+    return request.param
+
+
+@pytest.fixture
+def reopen(backend, tmp_path):
+    """Open (or re-open, after closing the previous one) the backend's store in tmp_path"""
+    opened = []
+
+    def _reopen():
+        if opened:
+            opened[-1].close()
+        opened.append(open_store(backend, str(tmp_path)))
+        return opened[-1]
+
+    yield _reopen
+    opened[-1].close()
+
+
+def test_save_many_assigns_ids_and_per_room_seqs(reopen):
+    store = reopen()
+    records = [('r1', message(0)), ('r2', message(1)), ('r1', message(2)), ('r1', message(3)), ('r2', message(4))]
+    saved = store.save_many(records)
+
+    assert [m['content'] for m in saved] == [m['content'] for _, m in records]
+    ids = [m['message_id'] for m in saved]
+    assert ids == sorted(ids) and len(set(ids)) == len(ids)
+    assert [m['seq'] for m in store.get_room_messages('r1')] == [1, 2, 3]
+    assert [m['seq'] for m in store.get_room_messages('r2')] == [1, 2]
+    assert sorted(store.list_rooms()) == ['r1', 'r2']
+    assert store.count_room('r1') == 3 and store.count_room('missing') == 0
+
+
+def test_ids_and_seqs_continue_after_reopen(reopen):
+    store = reopen()
+    first = store.save_many([('r1', message(i)) for i in range(3)])
+    store = reopen()
+    assert summary(store.get_room_messages('r1')) == summary(first)
+
+    second = store.save_many([('r1', message(i)) for i in range(3, 5)])
+    assert second[0]['message_id'] > first[-1]['message_id']
+    assert [m['seq'] for m in second] == [4, 5]
+
+
+def test_paging_with_before_id(reopen):
+    store = reopen()
+    saved = store.save_many([('r1', message(i)) for i in range(10)])
+
+    pages, before_id = [], None
+    while True:
+        page = store.get_room_messages('r1', limit=3, before_id=before_id)
+        if not page:
+            break
+        assert len(page) <= 3
+        pages.insert(0, page)
+        before_id = page[0]['message_id']
+    assert summary([m for page in pages for m in page]) == summary(saved)
+    assert summary(store.get_room_messages('r1', limit=3)) == summary(saved[-3:])
+    assert summary(store.get_room_messages('r1', limit=100)) == summary(saved)
+
+
+def test_delete_through_keeps_newer_messages_and_seq(reopen):
+    store = reopen()
+    saved = store.save_many([('r1', message(i)) for i in range(6)] + [('r2', message(i)) for i in range(2)])
+
+    store.delete_through('r1', saved[3]['message_id'])
+    assert summary(store.get_room_messages('r1')) == summary(saved[4:6])
+    assert store.count_room('r2') == 2
+
+    store = reopen()
+    assert summary(store.get_room_messages('r1')) == summary(saved[4:6])
+    # Seqs keep counting past the removed rows
+    assert store.save_many([('r1', message(6))])[0]['seq'] == 7
+
+
+def test_iter_room_matches_get_room_messages(reopen):
+    store = reopen()
+    store.save_many([('r1', message(i)) for i in range(7)])
+    assert summary(store.iter_room('r1', batch_size=2)) == summary(store.get_room_messages('r1'))
+
+
+def test_find_by_client_msg_id_survives_reopen(reopen):
+    store = reopen()
+    saved = store.save_many([('r1', message(0, sender_id=5, client_msg_id='abc'))])[0]
+    store = reopen()
+    found = store.find_by_client_msg_id(5, 'abc')
+    assert found is not None and found['message_id'] == saved['message_id']
+    assert store.find_by_client_msg_id(6, 'abc') is None
+
+
+def test_segment_index_is_rebuilt_when_missing(tmp_path):
+    store = open_store('segment', str(tmp_path))
+    saved = store.save_many([('r1', message(i)) for i in range(4)] + [('r2', message(4))])
+    store.close()
+    os.remove(os.path.join(str(tmp_path), 'segments', 'messages.idx'))
+
+    store = open_store('segment', str(tmp_path))
+    try:
+        assert summary(store.get_room_messages('r1')) == summary(saved[:4])
+        later = store.save_many([('r1', message(5))])[0]
+        assert later['message_id'] > saved[-1]['message_id'] and later['seq'] == 5
+    finally:
+        store.close()
+
+
+@pytest.mark.parametrize('target', ['sqlite', 'segment'])
+def test_ndjson_export_import_round_trip(backend, target, tmp_path):
+    (tmp_path / 'source').mkdir()
+    source = open_store(backend, str(tmp_path / 'source'))
+    try:
+        source.save_many([('r1', message(i)) for i in range(5)] + [('r2', message(i, sender_id=2)) for i in range(3)])
+        expected = {room_id: summary(source.get_room_messages(room_id)) for room_id in ('r1', 'r2')}
+        out = io.StringIO()
+        chat_transfer.export_records(chat_transfer.iter_store(source), out, chat_transfer.Progress('export'))
+    finally:
+        source.close()
+
+    export_path = tmp_path / 'export.ndjson'
+    export_path.write_text(out.getvalue(), encoding='utf-8')
+    target_dir = tmp_path / 'target'
+    target_dir.mkdir()
+    records = chat_transfer.read_ndjson(str(export_path))
+    progress = chat_transfer.Progress('import')
+    if target == 'sqlite':
+        chat_transfer.import_sqlite(records, progress, str(target_dir / 'chat_messages.db'))
+    else:
+        chat_transfer.import_segment(records, progress, str(target_dir / 'segments'))
+
+    imported = open_store(target, str(target_dir))
+    try:
+        assert {room_id: summary(imported.get_room_messages(room_id)) for room_id in ('r1', 'r2')} == expected
+        # The target keeps numbering after the imported history
+        assert imported.save_many([('r1', message(9))])[0]['seq'] == 6
+    finally:
+        imported.close()
@@ -0,0 +1,298 @@
+"""Upload files under uploads/ with a SQLite reference index, per-user quotas and an orphan sweeper."""
+
+import contextlib
+import os
+import sqlite3
+import threading
+import time
+import uuid
+from datetime import datetime
+
+from rate_limit import TokenBucket
+
+UPLOAD_URL_PREFIX = '/uploads/'
+
+
+class UploadQuotaExceeded(ValueError):
+    """Raised before anything is written; `kind` is 'storage' or 'rate'"""
+
+    def __init__(self, kind, message, retry_after=None):
+        super().__init__(message)
+        self.kind = kind
+        self.retry_after = retry_after
+
+
+class UploadStore:
+    """Stores uploads as uploads/<type>s/<random>.<ext> and indexes every file.
+
+    Each index row holds the owner, size, creation time and the message that references
+    the file (NULL until the message is saved). Messages are never deleted (old history
+    moves to the cold archive), so a referenced file is kept for good. The sweeper removes
+    files whose message never got saved and files on disk the index does not know,
+    both only after `orphan_grace_seconds`.
+
+    Quotas are checked before a file is written: total bytes stored per user and
+    bytes/files uploaded per hour (token buckets, so bursts up to the hourly amount are fine).
+    """
+
+    def __init__(self, root='uploads', path='auth_bridge.db', quota_bytes=1024 * 1024 * 1024,
+                 rate_bytes_per_hour=512 * 1024 * 1024, rate_files_per_hour=200, orphan_grace_seconds=3600):
+        self.root = root
+        self.quota_bytes = quota_bytes
+        self.rate_bytes_per_hour = rate_bytes_per_hour
+        self.rate_files_per_hour = rate_files_per_hour
+        self.orphan_grace_seconds = orphan_grace_seconds
+        self._lock = threading.Lock()
+        self._usage = {}    # owner_id -> bytes stored (loaded lazily)
+        self._buckets = {}  # (owner_id, 'bytes' | 'files') -> TokenBucket
+        self.conn = sqlite3.connect(path, check_same_thread=False)
+        self.conn.execute("PRAGMA journal_mode=WAL")
+        self.conn.execute("PRAGMA synchronous=NORMAL")
+        self.conn.execute('''
+            CREATE TABLE IF NOT EXISTS uploads (
+                path TEXT PRIMARY KEY,
+                owner_id INTEGER NOT NULL,
+                size INTEGER NOT NULL,
+                created_at REAL NOT NULL,
+                room_id TEXT,
+                message_id INTEGER
+            )
+        ''')
+        self.conn.execute("CREATE INDEX IF NOT EXISTS idx_uploads_owner ON uploads (owner_id)")
+        self.conn.execute("CREATE INDEX IF NOT EXISTS idx_uploads_unreferenced ON uploads (created_at) WHERE message_id IS NULL")
+        # One-off markers (e.g. the backfill of files written before the index existed)
+        self.conn.execute("CREATE TABLE IF NOT EXISTS upload_meta (key TEXT PRIMARY KEY, value TEXT)")
+        self.conn.commit()
+        files, size = self.conn.execute("SELECT COUNT(*), COALESCE(SUM(size), 0) FROM uploads").fetchone()
+        self.stats = {
+            'files': files, 'bytes': size, 'uploads': 0, 'upload_bytes': 0,
+            'rejected_storage': 0, 'rejected_rate': 0,
+            'sweeps': 0, 'orphans_deleted': 0, 'bytes_reclaimed': 0, 'top_users': []
+        }
+
+    # --- quotas (caller holds self._lock) ---
+
+    def _load_usage(self, owner_id):
+        usage = self._usage.get(owner_id)
+        if usage is None:
+            usage = self._usage[owner_id] = self.conn.execute(
+                "SELECT COALESCE(SUM(size), 0) FROM uploads WHERE owner_id = ?", (owner_id,)
+            ).fetchone()[0]
+        return usage
+
+    def _bucket(self, owner_id, kind, now):
+        bucket = self._buckets.get((owner_id, kind))
+        per_hour = self.rate_bytes_per_hour if kind == 'bytes' else self.rate_files_per_hour
+        if bucket is None:
+            bucket = self._buckets[(owner_id, kind)] = TokenBucket(per_hour / 3600.0, per_hour, now)
+        else:
+            bucket.refill(now)
+        return bucket
+
+    def _reserve(self, owner_id, size):
+        """Charge an upload against the quotas or raise UploadQuotaExceeded"""
+        usage = self._load_usage(owner_id)
+        if self.quota_bytes and usage + size > self.quota_bytes:
+            self.stats['rejected_storage'] += 1
+            raise UploadQuotaExceeded(
+                'storage', f"Storage quota exceeded: {usage + size} of {self.quota_bytes} bytes"
+            )
+        now = time.monotonic()
+        demands = []
+        if self.rate_bytes_per_hour:
+            demands.append((self._bucket(owner_id, 'bytes', now), size))
+        if self.rate_files_per_hour:
+            demands.append((self._bucket(owner_id, 'files', now), 1))
+        wait = max((bucket.wait_time(amount) for bucket, amount in demands), default=0.0)
+        if wait > 0:
+            self.stats['rejected_rate'] += 1
+            raise UploadQuotaExceeded('rate', f"Upload rate limit exceeded, retry in {wait:.0f}s", retry_after=wait)
+        for bucket, amount in demands:
+            bucket.tokens -= amount
+        self._usage[owner_id] = usage + size
+
+    # --- uploads ---
+
+    def save(self, owner_id, room_id, message_type, original_filename, data):
+        """Write one upload for a message about to be sent to room_id (blocking, run in an
+        executor); returns its URL path"""
+        upload_dir = os.path.join(self.root, f"{message_type}s")
+        os.makedirs(upload_dir, exist_ok=True)
+        file_extension = os.path.splitext(original_filename or '')[1]
+        file_path = os.path.join(upload_dir, f"{uuid.uuid4().hex}{file_extension}")
+        url = f"/{file_path.replace(os.sep, '/')}"
+
+        with self._lock:
+            self._reserve(owner_id, len(data))
+        try:
+            with open(file_path, 'wb') as f:
+                f.write(data)
+            with self._lock:
+                self.conn.execute(
+                    "INSERT INTO uploads (path, owner_id, size, created_at, room_id) VALUES (?, ?, ?, ?, ?)",
+                    (url, owner_id, len(data), time.time(), str(room_id))
+                )
+                self.conn.commit()
+                self.stats['files'] += 1
+                self.stats['bytes'] += len(data)
+                self.stats['uploads'] += 1
+                self.stats['upload_bytes'] += len(data)
+        except Exception:
+            with self._lock:
+                self._usage.pop(owner_id, None)
+            if os.path.exists(file_path):
+                os.remove(file_path)
+            raise
+        return url
+
+    def attach(self, url, room_id, message_id):
+        """Record the message that references an upload (it is no longer an orphan candidate)"""
+        with self._lock:
+            self.conn.execute(
+                "UPDATE uploads SET room_id = ?, message_id = ? WHERE path = ?",
+                (str(room_id), message_id or 0, url)
+            )
+            self.conn.commit()
+
+    def usage(self, owner_id):
+        with self._lock:
+            used = self._load_usage(owner_id)
+        return {
+            'used_bytes': used,
+            'quota_bytes': self.quota_bytes,
+            'remaining_bytes': max(self.quota_bytes - used, 0) if self.quota_bytes else None
+        }
+
+    # --- garbage collection ---
+
+    def _disk_path(self, url):
+        return os.path.join(self.root, *url[len(UPLOAD_URL_PREFIX):].split('/'))
+
+    def backfill(self, store):
+        """Index files written before the index existed, from the messages that reference them.
+
+        Runs once: until it has, files unknown to the index are never treated as orphans.
+        """
+        with self._lock:
+            if self.conn.execute("SELECT 1 FROM upload_meta WHERE key = 'backfilled'").fetchone():
+                return 0
+        rows = []
+        for room_id in store.list_rooms():
+            for message in store.iter_room(room_id):
+                url = message.get('content')
+                if not isinstance(url, str) or not url.startswith(UPLOAD_URL_PREFIX):
+                    continue
+                try:
+                    size = os.path.getsize(self._disk_path(url))
+                except OSError:
+                    continue
+                rows.append((url, message.get('sender_id') or 0, size, time.time(),
+                             str(room_id), message.get('message_id') or 0))
+        with self._lock:
+            before = self.conn.total_changes
+            # A file uploaded meanwhile is already indexed with its real owner
+            self.conn.executemany(
+                "INSERT INTO uploads (path, owner_id, size, created_at, room_id, message_id) VALUES (?, ?, ?, ?, ?, ?) "
+                "ON CONFLICT (path) DO UPDATE SET room_id = excluded.room_id, message_id = excluded.message_id "
+                "WHERE uploads.message_id IS NULL",
+                rows
+            )
+            added = self.conn.total_changes - before
+            self.conn.execute("INSERT OR REPLACE INTO upload_meta (key, value) VALUES ('backfilled', ?)", (str(time.time()),))
+            self.conn.commit()
+            self._usage.clear()
+            self._refresh_totals()
+        print(f"📎 [Uploads] Indexed {added} files referenced by existing messages")
+        return added
+
+    def _refresh_totals(self):
+        self.stats['files'], self.stats['bytes'] = self.conn.execute(
+            "SELECT COUNT(*), COALESCE(SUM(size), 0) FROM uploads"
+        ).fetchone()
+        self.stats['top_users'] = [
+            {'user_id': owner_id, 'files': files, 'bytes': size}
+            for owner_id, files, size in self.conn.execute(
+                "SELECT owner_id, COUNT(*), SUM(size) FROM uploads GROUP BY owner_id ORDER BY SUM(size) DESC LIMIT 10"
+            )
+        ]
+
+    @staticmethod
+    def _find_reference(store, room_id, url, since, page_size=200):
+        """message_id of the message in room_id that references url, looking back to `since`"""
+        before_id = None
+        while True:
+            page = store.get_room_messages(room_id, limit=page_size, before_id=before_id)
+            for message in page:
+                if message.get('content') == url:
+                    return message.get('message_id') or 0
+            if len(page) < page_size:
+                return None
+            try:
+                oldest = datetime.fromisoformat(str(page[0].get('timestamp')).replace('Z', '+00:00')).timestamp()
+            except ValueError:
+                return None
+            if oldest < since:
+                return None
+            before_id = page[0].get('message_id')
+
+    def sweep(self, store):
+        """Delete orphaned uploads (run periodically in an executor); returns (files, bytes) removed"""
+        cutoff = time.time() - self.orphan_grace_seconds
+        removed = reclaimed = 0
+
+        # 1. Uploads whose message was never saved (failed send, client gone mid-upload).
+        # The room is checked first: a crash between saving a message and attach() leaves a
+        # referenced upload without its message_id.
+        with self._lock:
+            rows = self.conn.execute(
+                "SELECT path, size, room_id, created_at FROM uploads WHERE message_id IS NULL AND created_at < ?",
+                (cutoff,)
+            ).fetchall()
+        for url, size, room_id, created_at in rows:
+            message_id = self._find_reference(store, room_id, url, created_at - 60) if room_id else None
+            if message_id is not None:
+                self.attach(url, room_id, message_id)
+                continue
+            with contextlib.suppress(FileNotFoundError):
+                os.remove(self._disk_path(url))
+            with self._lock:
+                self.conn.execute("DELETE FROM uploads WHERE path = ? AND message_id IS NULL", (url,))
+                self.conn.commit()
+            removed += 1
+            reclaimed += size
+
+        # 2. Files on disk the index does not know (only once the backfill has run)
+        with self._lock:
+            backfilled = self.conn.execute("SELECT 1 FROM upload_meta WHERE key = 'backfilled'").fetchone()
+        if backfilled:
+            for message_type in ('image', 'file'):
+                upload_dir = os.path.join(self.root, f"{message_type}s")
+                if not os.path.isdir(upload_dir):
+                    continue
+                prefix = f"{UPLOAD_URL_PREFIX}{message_type}s/"
+                with self._lock:
+                    known = {row[0] for row in self.conn.execute(
+                        "SELECT path FROM uploads WHERE path LIKE ?", (prefix + '%',)
+                    )}
+                for entry in os.scandir(upload_dir):
+                    if not entry.is_file() or prefix + entry.name in known:
+                        continue
+                    stat = entry.stat()
+                    if stat.st_mtime >= cutoff:
+                        continue  # may be an upload whose index row is being written right now
+                    with contextlib.suppress(FileNotFoundError):
+                        os.remove(entry.path)
+                    removed += 1
+                    reclaimed += stat.st_size
+
+        with self._lock:
+            self._usage.clear()
+            self._refresh_totals()
+            self.stats['sweeps'] += 1
+            self.stats['orphans_deleted'] += removed
+            self.stats['bytes_reclaimed'] += reclaimed
+        return removed, reclaimed
+
+    def close(self):
+        self.conn.close()
+
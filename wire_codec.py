@@ -0,0 +1,118 @@
+"""Wire encodings untuk frame WebSocket (JSON teks atau biner MessagePack/CBOR)."""
+
+import json
+
+try:
+    import msgpack
+except ImportError:  # msgpack is optional, JSON always works
+    msgpack = None
+
+try:
+    import cbor2
+except ImportError:  # cbor2 is optional, JSON always works
+    cbor2 = None
+
+PROTOCOL_JSON = 'json'
+PROTOCOL_MSGPACK = 'msgpack'
+PROTOCOL_CBOR = 'cbor'
+
+# Server preference order when a client offers several protocols
+PREFERRED_PROTOCOLS = [PROTOCOL_MSGPACK, PROTOCOL_CBOR, PROTOCOL_JSON]
+
+
+def available_protocols():
+    """Protocols this process can actually encode/decode"""
+    protocols = []
+    if msgpack is not None:
+        protocols.append(PROTOCOL_MSGPACK)
+    if cbor2 is not None:
+        protocols.append(PROTOCOL_CBOR)
+    protocols.append(PROTOCOL_JSON)
+    return protocols
+
+
+def negotiate_protocol(requested):
+    """Pick the best protocol offered by the client (falls back to JSON)"""
+    if not requested:
+        return PROTOCOL_JSON
+    if isinstance(requested, str):
+        requested = [requested]
+    supported = available_protocols()
+    for protocol in PREFERRED_PROTOCOLS:
+        if protocol in requested and protocol in supported:
+            return protocol
+    return PROTOCOL_JSON
+
+
+def is_binary(protocol):
+    """True when frames for this protocol go out as binary WebSocket frames"""
+    return protocol in (PROTOCOL_MSGPACK, PROTOCOL_CBOR)
+
+
+def _default(obj):
+    """Fallback for values the compact encoders don't know (datetime, Decimal, ...)"""
+    if hasattr(obj, 'isoformat'):
+        return obj.isoformat()
+    return str(obj)
+
+
+def encode_frame(protocol, message):
+    """Encode a message dict; returns str for JSON and bytes for binary protocols"""
+    if protocol == PROTOCOL_MSGPACK:
+        return msgpack.packb(message, use_bin_type=True, default=_default)
+    if protocol == PROTOCOL_CBOR:
+        return cbor2.dumps(message, default=lambda encoder, obj: encoder.encode(_default(obj)))
+    return json.dumps(message, default=_default)
+
+
+def decode_frame(protocol, data):
+    """Decode an incoming frame payload (str or bytes) into a dict"""
+    if isinstance(data, str):
+        return json.loads(data)
+    if protocol == PROTOCOL_MSGPACK:
+        return msgpack.unpackb(data, raw=False)
+    if protocol == PROTOCOL_CBOR:
+        return cbor2.loads(data)
+    return json.loads(data)
+
+
+def _cbor_array_header(count):
+    if count < 24:
+        return bytes([0x80 | count])
+    if count < 0x100:
+        return bytes([0x98, count])
+    if count < 0x10000:
+        return bytes([0x99]) + count.to_bytes(2, 'big')
+    return bytes([0x9a]) + count.to_bytes(4, 'big')
+
+
+def encode_batch(protocol, frames):
+    """Wrap already-encoded frames into one {"type": "batch", "messages": [...]} frame.
+
+    The inner frames are spliced in as-is (no decode/re-encode): JSON text is joined
+    with commas, MessagePack/CBOR items are concatenated after an array header.
+    """
+    if protocol == PROTOCOL_MSGPACK:
+        head = b'\x82' + msgpack.packb('type') + msgpack.packb('batch') + msgpack.packb('messages')
+        return head + msgpack.Packer().pack_array_header(len(frames)) + b''.join(frames)
+    if protocol == PROTOCOL_CBOR:
+        head = b'\xa2' + cbor2.dumps('type') + cbor2.dumps('batch') + cbor2.dumps('messages')
+        return head + _cbor_array_header(len(frames)) + b''.join(frames)
+    return '{"type": "batch", "messages": [' + ', '.join(frames) + ']}'
+
+
+def json_array(fragments):
+    """JSON array text from already-encoded JSON values"""
+    return '[' + ','.join(fragments) + ']'
+
+
+def splice_json(message, raw_fields):
+    """JSON text of `message` plus fields whose values are already-encoded JSON text.
+
+    Lets large payloads built from cached fragments (history pages) skip a second encode.
+    """
+    head = json.dumps(message, default=_default)
+    if not raw_fields:
+        return head
+    extra = ', '.join(f"{json.dumps(key)}: {value}" for key, value in raw_fields.items())
+    return head[:-1] + (', ' if len(head) > 2 else '') + extra + '}'